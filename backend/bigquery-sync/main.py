@@ -4,6 +4,7 @@ from google.cloud import storage
 import functions_framework
 import io
 import os
+from collections import Counter, defaultdict
 
 @functions_framework.cloud_event
 def sync_to_bigquery(cloud_event):
@@ -115,6 +116,7 @@ def sync_to_bigquery(cloud_event):
         batch_size = 500
         total_inserted = 0
         total_errors = []
+        inserted_per_date = defaultdict(Counter)
         
         for i in range(0, len(rows_to_insert), batch_size):
             batch = rows_to_insert[i:i + batch_size]
@@ -125,6 +127,9 @@ def sync_to_bigquery(cloud_event):
                     total_errors.extend(errors)
                 else:
                     total_inserted += len(batch)
+                    for row in batch:
+                        if row.get('patient_entry_date'):
+                            inserted_per_date[row['patient_entry_date']].update(date_counts(row))
                     print(f"Batch {i//batch_size + 1}: Inserted {len(batch)} records")
             except Exception as e:
                 print(f"Batch {i//batch_size + 1} failed: {e}")
@@ -134,7 +139,62 @@ def sync_to_bigquery(cloud_event):
             print(f"Completed with {len(total_errors)} errors. Inserted {total_inserted} records.")
         else:
             print(f"Successfully inserted {total_inserted} new records into {table_id}")
+        
+        # Record the new rows in the per-date ledger the clustering engine claims dates from
+        if inserted_per_date:
+            update_date_ledger(bq_client, f"{PROJECT_ID}.{DATASET_ID}.smart_date_ledger", inserted_per_date)
     else:
         print("No new records to insert after deduplication.")
     
-    print(f"Processed file {file_name} with total {len(df)} rows")
\ No newline at end of file
+    print(f"Processed file {file_name} with total {len(df)} rows")
+
+def date_counts(row):
+    """The date ledger counts one inserted row contributes to"""
+    urban = row.get('pat_areatype') == 'Urban'
+    geocoded = urban and bool(row.get('latitude')) and bool(row.get('longitude'))
+    return {'row_count': 1, 'total_urban': int(urban), 'geocoded_urban': int(geocoded)}
+
+
+def update_date_ledger(bq_client, ledger_table, inserted_per_date):
+    """Add inserted row and urban geocoding counts to the date ledger; new dates start PENDING
+    
+    The ledger is created (and seeded from the whole table) by the clustering
+    engine's /smart-init, so until then there is nothing to update.
+    """
+    try:
+        bq_client.get_table(ledger_table)
+    except Exception:
+        print(f"Date ledger {ledger_table} does not exist yet; skipping ledger update")
+        return
+    
+    query = f"""
+        MERGE `{ledger_table}` l
+        USING UNNEST(@counts) c
+        ON l.date = c.date
+        WHEN MATCHED THEN UPDATE SET
+            row_count = l.row_count + c.row_count,
+            total_urban = l.total_urban + c.total_urban,
+            geocoded_urban = l.geocoded_urban + c.geocoded_urban,
+            last_ingested_at = CURRENT_TIMESTAMP()
+        WHEN NOT MATCHED THEN INSERT (date, row_count, total_urban, geocoded_urban, status, first_ingested_at, last_ingested_at)
+            VALUES (c.date, c.row_count, c.total_urban, c.geocoded_urban, 'PENDING', CURRENT_TIMESTAMP(), CURRENT_TIMESTAMP())
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ArrayQueryParameter("counts", "STRUCT", [
+                bigquery.StructQueryParameter(
+                    None,
+                    bigquery.ScalarQueryParameter("date", "DATE", date),
+                    bigquery.ScalarQueryParameter("row_count", "INT64", counts['row_count']),
+                    bigquery.ScalarQueryParameter("total_urban", "INT64", counts['total_urban']),
+                    bigquery.ScalarQueryParameter("geocoded_urban", "INT64", counts['geocoded_urban'])
+                )
+                for date, counts in sorted(inserted_per_date.items())
+            ])
+        ]
+    )
+    try:
+        bq_client.query(query, job_config=job_config).result()
+        print(f"Date ledger updated for {len(inserted_per_date)} dates")
+    except Exception as e:
+        print(f"Date ledger update failed: {e}; the clustering engine adds missing dates at /smart-init and preflight")
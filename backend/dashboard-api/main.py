@@ -21,6 +21,15 @@ AREA_TYPE = 'pat_areatype'
 
 client = bigquery.Client(project=PROJECT_ID)
 
+def labelled(stage):
+    """Job config labelling a query with this service, its endpoint and stage"""
+    from flask import request
+    return bigquery.QueryJobConfig(labels={
+        'service': 'dashboard-api',
+        'endpoint': request.endpoint or 'none',
+        'stage': stage
+    })
+
 @app.route('/api/dashboard/stats', methods=['GET'])
 def get_dashboard_stats():
     try:
@@ -50,7 +59,7 @@ def get_dashboard_stats():
         {date_filter}
         """
         
-        query_job = client.query(query)
+        query_job = client.query(query, job_config=labelled('stats'))
         results = query_job.result()
         
         for row in results:
@@ -132,7 +141,7 @@ def get_geocoding_status():
         GROUP BY o.total_records, o.total_urban, o.geocoded_urban, o.urban_geocoding_pct, o.total_geocoded, o.overall_geocoding_pct
         """
         
-        query_job = client.query(query)
+        query_job = client.query(query, job_config=labelled('daily_stats'))
         results = query_job.result()
         
         for row in results:
@@ -228,8 +237,8 @@ def get_cases():
         WHERE patient_entry_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 MONTH)
         """
         
-        query_job = client.query(query)
-        count_job = client.query(count_query)
+        query_job = client.query(query, job_config=labelled('cases'))
+        count_job = client.query(count_query, job_config=labelled('count'))
         
         results = query_job.result()
         count_result = list(count_job.result())[0]
@@ -309,7 +318,7 @@ def get_smart_cluster_stats():
         CROSS JOIN pending_stats pd
         """
         
-        query_job = client.query(query)
+        query_job = client.query(query, job_config=labelled('cluster_stats'))
         results = query_job.result()
         
         for row in results:
@@ -352,7 +361,7 @@ def check_services_health():
     # Upload Function - check by testing BigQuery connection
     try:
         query = f"SELECT COUNT(*) as count FROM `{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}` LIMIT 1"
-        query_job = client.query(query)
+        query_job = client.query(query, job_config=labelled('table_check'))
         results = list(query_job.result())
         health_status['Upload Function'] = 'healthy' if results else 'down'
     except:
@@ -390,7 +399,7 @@ def get_geocoding_progress():
         WHERE UPPER(COALESCE(pat_areatype, '')) = 'URBAN'
         """
         
-        query_job = client.query(query)
+        query_job = client.query(query, job_config=labelled('progress'))
         results = query_job.result()
         
         progress = {'total_records': 0, 'geocoded_records': 0, 'completion_pct': 0}
@@ -4,6 +4,10 @@ import pandas as pd
 from datetime import datetime, timedelta
 import io
 
+def job_labels(stage):
+    """BigQuery job labels identifying this function and the query's stage"""
+    return {'service': 'export-function', 'endpoint': 'export_data', 'stage': stage}
+
 @functions_framework.http
 def export_data(request):
     """Export patient data for past 7 days from given date"""
@@ -73,7 +77,7 @@ def export_data(request):
         ORDER BY a.smart_cluster_id, p.patient_entry_date DESC
         """
         
-        df = client.query(query).to_dataframe()
+        df = client.query(query, job_config=bigquery.QueryJobConfig(labels=job_labels('cluster_patients'))).to_dataframe()
         
         if df.empty:
             return {'message': 'No clustered data found for the specified date range'}, 404
@@ -140,7 +144,7 @@ def export_data(request):
         ORDER BY a.smart_cluster_id, a.expansion_date DESC
         """
         
-        expansion_df = client.query(expansion_query).to_dataframe()
+        expansion_df = client.query(expansion_query, job_config=bigquery.QueryJobConfig(labels=job_labels('expansions'))).to_dataframe()
         
         # Process expansion columns same as main sheet
         if not expansion_df.empty:
@@ -46,7 +46,7 @@ def geocode_addresses(request):
     # Fetch records with null latitude/longitude (limit 100 per batch)
     query = f"""
         SELECT unique_id, pat_street, pat_house, villagename, subdistrictname, 
-               districtname, statename, pat_pincode, pat_areatype
+               districtname, statename, pat_pincode, pat_areatype, patient_entry_date
         FROM `{table_id}`
         WHERE (latitude IS NULL OR longitude IS NULL)
         AND (pat_street IS NOT NULL OR pat_house IS NOT NULL OR villagename IS NOT NULL 
@@ -74,6 +74,11 @@ def geocode_addresses(request):
         # Update BigQuery table
         if total_geocoded > 0:
             update_records(bq_client, table_id, geocoded_batch)
+            
+            # Recount the urban geocoding coverage of the dates just geocoded
+            geocoded_ids = {r['unique_id'] for r in geocoded_batch}
+            touched = df[df['unique_id'].isin(geocoded_ids) & (df['pat_areatype'] == 'Urban')]
+            refresh_date_quality(bq_client, table_id, touched['patient_entry_date'].dropna().unique().tolist())
         
         return {"message": f"Geocoded {total_geocoded} records"}, 200
     
@@ -211,3 +216,44 @@ def update_records(bq_client, table_id, geocoded_records):
         AND pat_areatype = 'Rural'
     """
     bq_client.query(fallback_query).result()
+
+
+def refresh_date_quality(bq_client, table_id, dates):
+    """Recount urban geocoding coverage in the clustering engine's date ledger
+
+    The engine reads these counts for its data-quality check instead of
+    scanning the patient table, so they must follow each geocoding batch.
+    """
+    if not dates:
+        return
+    ledger_table = f"{PROJECT_ID}.{DATASET_ID}.smart_date_ledger"
+    try:
+        bq_client.get_table(ledger_table)
+    except Exception:
+        print(f"Date ledger {ledger_table} does not exist yet; skipping quality refresh")
+        return
+
+    refresh_query = f"""
+        UPDATE `{ledger_table}` l
+        SET total_urban = s.total_urban, geocoded_urban = s.geocoded_urban
+        FROM (
+            SELECT
+                patient_entry_date as date,
+                COUNTIF(pat_areatype = 'Urban') as total_urban,
+                COUNTIF(pat_areatype = 'Urban'
+                        AND latitude IS NOT NULL AND longitude IS NOT NULL
+                        AND latitude != 0 AND longitude != 0) as geocoded_urban
+            FROM `{table_id}`
+            WHERE patient_entry_date IN UNNEST(@dates)
+            GROUP BY date
+        ) s
+        WHERE l.date = s.date
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ArrayQueryParameter("dates", "DATE", dates)]
+    )
+    try:
+        bq_client.query(refresh_query, job_config=job_config).result()
+        print(f"Date ledger quality refreshed for {len(dates)} dates")
+    except Exception as e:
+        print(f"Date ledger quality refresh failed: {e}")
@@ -8,6 +8,10 @@ PROJECT_ID = os.getenv('PROJECT_ID', 'sentinel-h-5')
 DATASET_ID = os.getenv('DATASET_ID', 'sentinel_h_5')
 TABLE_ID = os.getenv('TABLE_ID', 'patient_records')
 
+def job_labels(stage):
+    """BigQuery job labels identifying this function and the query's stage"""
+    return {'service': 'report-api', 'endpoint': 'get_hebs_data', 'stage': stage}
+
 @functions_framework.http
 def get_hebs_data(request):
     """API endpoint to fetch HEBS-DSR report data"""
@@ -92,7 +96,8 @@ def get_case_summary(bq_client, start_date, end_date):
         query_parameters=[
             bigquery.ScalarQueryParameter("start_date", "DATE", start_date),
             bigquery.ScalarQueryParameter("end_date", "DATE", end_date)
-        ]
+        ],
+        labels=job_labels('case_summary')
     )
     
     result = bq_client.query(query, job_config=job_config).to_dataframe()
@@ -114,7 +119,8 @@ def get_signals_data(bq_client, start_date, end_date):
         query_parameters=[
             bigquery.ScalarQueryParameter("start_date", "DATE", start_date),
             bigquery.ScalarQueryParameter("end_date", "DATE", end_date)
-        ]
+        ],
+        labels=job_labels('signal_clusters')
     )
     
     clusters_df = bq_client.query(clusters_query, job_config=job_config).to_dataframe()
@@ -165,7 +171,8 @@ def get_signals_data(bq_client, start_date, end_date):
         patients_config = bigquery.QueryJobConfig(
             query_parameters=[
                 bigquery.ArrayQueryParameter("unique_ids", "STRING", unique_ids)
-            ]
+            ],
+            labels=job_labels('signal_patients')
         )
         
         patients_df = bq_client.query(patients_query, job_config=patients_config).to_dataframe()
@@ -1,15 +1,26 @@
 # Smart Clustering Engine - Enhanced outbreak continuity tracking
 # Implements time-based and geographic merging without overlap thresholds
 
-from flask import Flask, jsonify, request, render_template
+from flask import Flask, jsonify, request, render_template, has_request_context
 from flask_cors import CORS
 from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
 from datetime import datetime, timedelta, timezone
 import pandas as pd
 import numpy as np
 from math import radians, sin, cos, sqrt, atan2
+from optimize_clustering_queries import JOB_LABEL_TELEMETRY_QUERY, TOP_EXPENSIVE_QUERIES
+from contextlib import contextmanager
+from functools import partial
+import contextvars
 import time
 import os
+import sys
+import io
+import json
+import base64
+import hashlib
+import threading
 import logging
 import uuid
 
@@ -36,6 +47,10 @@ SOURCE_TABLE = f"{PROJECT_ID}.{DATASET_ID}.patient_records"
 SMART_CLUSTERS_TABLE = f"{PROJECT_ID}.{DATASET_ID}.smart_clusters"
 SMART_ASSIGNMENTS_TABLE = f"{PROJECT_ID}.{DATASET_ID}.smart_cluster_assignments"
 SMART_MERGE_HISTORY_TABLE = f"{PROJECT_ID}.{DATASET_ID}.smart_merge_history"
+SMART_PROCESSING_STATUS_TABLE = f"{PROJECT_ID}.{DATASET_ID}.smart_processing_status"
+SMART_DATE_LEDGER_TABLE = f"{PROJECT_ID}.{DATASET_ID}.smart_date_ledger"
+SMART_SHARD_LEDGER_TABLE = f"{PROJECT_ID}.{DATASET_ID}.smart_shard_ledger"
+SMART_JOBS_TABLE = f"{PROJECT_ID}.{DATASET_ID}.smart_jobs"
 
 # Column names
 UNIQUE_ID = os.environ.get('COL_UNIQUE_ID', 'unique_id')
@@ -51,204 +66,1735 @@ SUBDISTRICT = os.environ.get('COL_SUBDISTRICT', 'subdistrictname')
 
 # Smart Clustering Parameters
 DBSCAN_EPSILON_M = int(os.environ.get('DBSCAN_EPSILON_M', 500))
-DBSCAN_EPSILON_RADIANS = DBSCAN_EPSILON_M / 6371000
+EARTH_RADIUS_M = 6371000
+DBSCAN_EPSILON_RADIANS = DBSCAN_EPSILON_M / EARTH_RADIUS_M
 MAX_CLUSTER_RADIUS = int(os.environ.get('MAX_CLUSTER_RADIUS', 800))
 MIN_CLUSTER_SIZE = int(os.environ.get('MIN_CLUSTER_SIZE', 2))
 TIME_WINDOW_DAYS = int(os.environ.get('TIME_WINDOW_DAYS', 6))
 MAX_CLUSTER_AGE_DAYS = int(os.environ.get('MAX_CLUSTER_AGE_DAYS', 7))
 LOOKBACK_DAYS = int(os.environ.get('LOOKBACK_DAYS', 7))
 GEOCODING_THRESHOLD = float(os.environ.get('GEOCODING_THRESHOLD', 0.85))
-STREAMING_BUFFER_WAIT = int(os.environ.get('STREAMING_BUFFER_WAIT', 90))
 AUTO_ACCEPT_RADIUS_THRESHOLD = int(os.environ.get('AUTO_ACCEPT_RADIUS', 200))
+BACKFILL_FLUSH_DAYS = int(os.environ.get('BACKFILL_FLUSH_DAYS', 30))
+
+# Date claims are leases: the worker renews its lease every heartbeat while it
+# processes, and a date whose lease expired (crashed worker) can be claimed again
+CLAIM_LEASE_SECONDS = int(os.environ.get('CLAIM_LEASE_SECONDS', 300))
+CLAIM_HEARTBEAT_SECONDS = int(os.environ.get('CLAIM_HEARTBEAT_SECONDS', 60))
+CLAIM_ATTEMPTS = 3
+
+# Sharded scheduling: /smart-shard-plan splits this many dates per call into
+# (date, syndrome) shards that /smart-shard-process workers run concurrently
+SHARD_PLAN_DATES = int(os.environ.get('SHARD_PLAN_DATES', 7))
+
+# Asynchronous jobs: recorded in smart_jobs and run by Cloud Tasks, which
+# POSTs each one to SMART_JOBS_URL/smart-jobs/<job_id>/run on SMART_JOBS_QUEUE
+# (projects/<project>/locations/<region>/queues/<queue>)
+SMART_JOBS_QUEUE = os.environ.get('SMART_JOBS_QUEUE')
+SMART_JOBS_URL = os.environ.get('SMART_JOBS_URL')
+# A run starts no new date after JOB_TASK_SECONDS and queues the rest of the
+# job as a new task; a run not heard from for JOB_LEASE_SECONDS (the service
+# request timeout) has died, and a retried task takes the job over
+JOB_TASK_SECONDS = int(os.environ.get('JOB_TASK_SECONDS', 600))
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', 900))
+# Jobs listed by /smart-jobs
+JOB_HISTORY = int(os.environ.get('JOB_HISTORY', 50))
+
+# /smart-clusters responses are cached per days value until this instance
+# changes cluster state, and for at most this long (other instances' writes)
+CLUSTERS_CACHE_SECONDS = int(os.environ.get('CLUSTERS_CACHE_SECONDS', 60))
+
+# Page size of /smart-clusters when no limit is given, and the largest limit
+CLUSTERS_PAGE_SIZE = int(os.environ.get('CLUSTERS_PAGE_SIZE', 100))
+CLUSTERS_PAGE_MAX = int(os.environ.get('CLUSTERS_PAGE_MAX', 1000))
+
+# Rows per result page streamed by /smart-cluster-patients/bulk
+BULK_PATIENTS_PAGE_ROWS = int(os.environ.get('BULK_PATIENTS_PAGE_ROWS', 10000))
+
+# Response formats of the read endpoints, chosen with ?format= or the Accept
+# header; JSON unless asked otherwise
+ARROW_STREAM_MIMETYPE = 'application/vnd.apache.arrow.stream'
+PARQUET_MIMETYPE = 'application/vnd.apache.parquet'
+RESPONSE_FORMATS = {
+    'json': 'application/json',
+    'arrow': ARROW_STREAM_MIMETYPE,
+    'parquet': PARQUET_MIMETYPE
+}
+
+# Parallel DBSCAN (defaults to the CPUs available to the container)
+DBSCAN_WORKERS = int(os.environ.get('DBSCAN_WORKERS', len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1))
+DBSCAN_PARTITION_BY_STATE = os.environ.get('DBSCAN_PARTITION_BY_STATE', 'false').lower() == 'true'
+DBSCAN_PARALLEL_MIN_POINTS = int(os.environ.get('DBSCAN_PARALLEL_MIN_POINTS', 5000))
+
+# GIS clustering engine: 'sklearn' (BallTree DBSCAN) or 'grid' (grid-hash DBSCAN, same labels)
+GIS_CLUSTERING_ENGINE = os.environ.get('GIS_CLUSTERING_ENGINE', 'sklearn').lower()
+
+# Region of the dataset, for INFORMATION_SCHEMA.JOBS telemetry
+BIGQUERY_REGION = os.environ.get('BIGQUERY_REGION', 'us')
+JOBS_TABLE = f"{PROJECT_ID}.region-{BIGQUERY_REGION}.INFORMATION_SCHEMA.JOBS_BY_PROJECT"
+
+# 'service' label on every BigQuery job this service issues
+SERVICE_LABEL = 'smart-cluster-engine'
+
+# Storage backend: 'bigquery', or 'local' (DuckDB over Parquet files, see local_storage.py)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'bigquery').lower()
+LOCAL_DATA_DIR = os.environ.get('LOCAL_DATA_DIR', 'local_data')
+LOCAL_SOURCE_PATH = os.environ.get('LOCAL_SOURCE_PATH', os.path.join(LOCAL_DATA_DIR, 'patient_records*.parquet'))
+
+class LazyClient:
+    """bigquery.Client created on first use, so local runs need no credentials
+    
+    Query and load jobs are labelled with the service, endpoint and stage
+    that issued them, and recorded against the active stage profile.
+    """
+    
+    def __init__(self):
+        self._client = None
+    
+    def __getattr__(self, name):
+        if self._client is None:
+            self._client = bigquery.Client(project=PROJECT_ID)
+        return getattr(self._client, name)
+    
+    def query(self, query, job_config=None, **kwargs):
+        job_config = labelled(job_config or bigquery.QueryJobConfig())
+        return record_job(self.__getattr__('query')(query, job_config=job_config, **kwargs))
+    
+    def load_table_from_json(self, rows, destination, job_config=None, **kwargs):
+        job_config = labelled(job_config or bigquery.LoadJobConfig())
+        return record_job(self.__getattr__('load_table_from_json')(rows, destination, job_config=job_config, **kwargs))
+    
+    def load_table_from_dataframe(self, frame, destination, job_config=None, **kwargs):
+        job_config = labelled(job_config or bigquery.LoadJobConfig())
+        return record_job(self.__getattr__('load_table_from_dataframe')(frame, destination, job_config=job_config, **kwargs))
 
 # Initialize BigQuery client
-client = bigquery.Client(project=PROJECT_ID)
+client = LazyClient()
 
 # ============================================================================
-# TABLE CREATION
+# STAGE PROFILING
 # ============================================================================
 
-def create_smart_tables():
-    """Create smart clustering tables"""
-    logger.info("Creating smart clustering tables...")
+# Stage profile of the request being handled, if it is profiled, and the
+# innermost stage being run (profiled or not)
+current_profile = contextvars.ContextVar('current_profile', default=None)
+current_stage = contextvars.ContextVar('current_stage', default=None)
+
+# Stage profiles are written to stdout as one JSON object per line, which
+# Cloud Logging ingests as structured entries
+profile_logger = logging.getLogger('smart_clustering.profile')
+profile_handler = logging.StreamHandler(sys.stdout)
+profile_handler.setFormatter(logging.Formatter('%(message)s'))
+profile_logger.addHandler(profile_handler)
+profile_logger.propagate = False
+
+class StageProfile:
+    """Wall time and BigQuery jobs of each stage of one request
     
-    # Create dataset if not exists
-    dataset_ref = client.dataset(DATASET_ID)
-    try:
-        client.get_dataset(dataset_ref)
-    except Exception:
-        dataset = bigquery.Dataset(dataset_ref)
-        dataset.location = "US"
-        client.create_dataset(dataset)
-        logger.info(f"Created dataset {DATASET_ID}")
-    
-    # Smart Clusters Table
-    smart_clusters_schema = [
-        bigquery.SchemaField("smart_cluster_id", "STRING", mode="REQUIRED"),
-        bigquery.SchemaField("algorithm_type", "STRING", mode="REQUIRED"),
-        bigquery.SchemaField("input_date", "DATE", mode="REQUIRED"),
-        bigquery.SchemaField("original_creation_date", "DATE", mode="REQUIRED"),
-        bigquery.SchemaField("actual_cluster_radius", "FLOAT", mode="NULLABLE"),
-        bigquery.SchemaField("accept_status", "STRING", mode="REQUIRED"),
-        bigquery.SchemaField("patient_count", "INTEGER", mode="REQUIRED"),
-        bigquery.SchemaField("primary_syndrome", "STRING", mode="REQUIRED"),
-        bigquery.SchemaField("centroid_lat", "FLOAT", mode="NULLABLE"),
-        bigquery.SchemaField("centroid_lon", "FLOAT", mode="NULLABLE"),
-        bigquery.SchemaField("village_name", "STRING", mode="NULLABLE"),
-        bigquery.SchemaField("expansion_count", "INTEGER", mode="REQUIRED"),
-        bigquery.SchemaField("created_at", "TIMESTAMP", mode="REQUIRED"),
-    ]
+    Time spent in a nested stage is counted only against that stage, so
+    the stages add up to the request's total. Jobs count against the
+    innermost active stage, or 'other' outside any stage.
+    """
     
-    try:
-        client.get_table(SMART_CLUSTERS_TABLE)
-        logger.info("Smart clusters table exists")
-    except Exception:
-        table = bigquery.Table(SMART_CLUSTERS_TABLE, schema=smart_clusters_schema)
-        client.create_table(table)
-        logger.info("Created smart_clusters table")
-    
-    # Smart Assignments Table
-    smart_assignments_schema = [
-        bigquery.SchemaField("assignment_id", "STRING", mode="REQUIRED"),
-        bigquery.SchemaField("smart_cluster_id", "STRING", mode="REQUIRED"),
-        bigquery.SchemaField("unique_id", "STRING", mode="REQUIRED"),
-        bigquery.SchemaField("assigned_at", "TIMESTAMP", mode="REQUIRED"),
-        bigquery.SchemaField("addition_type", "STRING", mode="REQUIRED"),
-        bigquery.SchemaField("expansion_date", "DATE", mode="NULLABLE"),
-    ]
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.active = []
     
-    try:
-        client.get_table(SMART_ASSIGNMENTS_TABLE)
-        logger.info("Smart assignments table exists")
-    except Exception:
-        table = bigquery.Table(SMART_ASSIGNMENTS_TABLE, schema=smart_assignments_schema)
-        client.create_table(table)
-        logger.info("Created smart_cluster_assignments table")
-    
-    # Smart Merge History Table
-    smart_merge_schema = [
-        bigquery.SchemaField("merge_id", "STRING", mode="REQUIRED"),
-        bigquery.SchemaField("target_cluster_id", "STRING", mode="REQUIRED"),
-        bigquery.SchemaField("source_cluster_id", "STRING", mode="REQUIRED"),
-        bigquery.SchemaField("merge_reason", "STRING", mode="REQUIRED"),
-        bigquery.SchemaField("cases_added", "INTEGER", mode="REQUIRED"),
-        bigquery.SchemaField("overlap_cases_removed", "INTEGER", mode="REQUIRED"),
-        bigquery.SchemaField("performed_at", "TIMESTAMP", mode="REQUIRED"),
-    ]
+    def _entry(self, name):
+        return self.stages.setdefault(name, {'seconds': 0.0, 'jobs': []})
     
-    try:
-        client.get_table(SMART_MERGE_HISTORY_TABLE)
-        logger.info("Smart merge history table exists")
-    except Exception:
-        table = bigquery.Table(SMART_MERGE_HISTORY_TABLE, schema=smart_merge_schema)
-        client.create_table(table)
-        logger.info("Created smart_merge_history table")
-    
-    # Smart Processing Status Table
-    SMART_PROCESSING_STATUS_TABLE = f"{PROJECT_ID}.{DATASET_ID}.smart_processing_status"
-    processing_status_schema = [
-        bigquery.SchemaField("date", "DATE", mode="REQUIRED"),
-        bigquery.SchemaField("status", "STRING", mode="REQUIRED"),  # IN_PROGRESS, COMPLETED, FAILED
-        bigquery.SchemaField("worker_id", "STRING", mode="REQUIRED"),
-        bigquery.SchemaField("started_at", "TIMESTAMP", mode="REQUIRED"),
-        bigquery.SchemaField("completed_at", "TIMESTAMP", mode="NULLABLE"),
-    ]
+    @contextmanager
+    def stage(self, name):
+        frame = {'name': name, 'started': time.perf_counter(), 'nested': 0.0}
+        self.active.append(frame)
+        try:
+            yield
+        finally:
+            self.active.pop()
+            elapsed = time.perf_counter() - frame['started']
+            self._entry(name)['seconds'] += elapsed - frame['nested']
+            if self.active:
+                self.active[-1]['nested'] += elapsed
     
+    def add_job(self, job):
+        self._entry(self.active[-1]['name'] if self.active else 'other')['jobs'].append(job)
+    
+    def summary(self):
+        """Per-stage wall_ms, jobs, bytes_processed and slot_ms
+        
+        Job statistics are read from the job objects, which hold them once
+        the job has finished; nothing is fetched from BigQuery. Time outside
+        every stage is reported as 'other'.
+        """
+        total = time.perf_counter() - self.started
+        self._entry('other')['seconds'] = total - sum(
+            entry['seconds'] for name, entry in self.stages.items() if name != 'other'
+        )
+        
+        stages = {}
+        for name, entry in self.stages.items():
+            jobs = entry['jobs']
+            stages[name] = {
+                'wall_ms': round(entry['seconds'] * 1000, 1),
+                'jobs': len(jobs),
+                'bytes_processed': sum(getattr(job, 'total_bytes_processed', None) or 0 for job in jobs),
+                'slot_ms': sum(getattr(job, 'slot_millis', None) or 0 for job in jobs)
+            }
+        
+        return {
+            'total_ms': round(total * 1000, 1),
+            'jobs': sum(stage['jobs'] for stage in stages.values()),
+            'bytes_processed': sum(stage['bytes_processed'] for stage in stages.values()),
+            'slot_ms': sum(stage['slot_ms'] for stage in stages.values()),
+            'stages': stages
+        }
+
+@contextmanager
+def profiled():
+    """Profile the stages run inside the block"""
+    profile = StageProfile()
+    token = current_profile.set(profile)
     try:
-        client.get_table(SMART_PROCESSING_STATUS_TABLE)
-        logger.info("Smart processing status table exists")
-    except Exception:
-        table = bigquery.Table(SMART_PROCESSING_STATUS_TABLE, schema=processing_status_schema)
-        client.create_table(table)
-        logger.info("Created smart_processing_status table")
+        yield profile
+    finally:
+        current_profile.reset(token)
+
+@contextmanager
+def stage(name):
+    """Run the block as stage name: its jobs carry the stage label and, when
+    the request is profiled, it is timed in the active profile"""
+    token = current_stage.set(name)
+    try:
+        profile = current_profile.get()
+        if profile is None:
+            yield
+        else:
+            with profile.stage(name):
+                yield
+    finally:
+        current_stage.reset(token)
+
+def record_job(job):
+    """Count a BigQuery job against the active stage"""
+    profile = current_profile.get()
+    if profile is not None:
+        profile.add_job(job)
+    return job
+
+def labelled(job_config):
+    """job_config with service, endpoint and stage labels added
+    
+    Labels already set on the config take precedence. Work outside a
+    request (the DBSCAN pool, background runs) is labelled 'background'.
+    """
+    endpoint = request.endpoint if has_request_context() and request.endpoint else 'background'
+    job_config.labels = {
+        'service': SERVICE_LABEL,
+        'endpoint': endpoint,
+        'stage': current_stage.get() or 'none',
+        **(job_config.labels or {})
+    }
+    return job_config
+
+def log_profile(event, summary, **fields):
+    """Write a stage profile summary as one structured JSON log line"""
+    profile_logger.info(json.dumps({
+        'severity': 'INFO',
+        'message': f"{event}: {summary['total_ms']} ms, {summary['jobs']} BigQuery jobs",
+        'event': event,
+        **fields,
+        **summary
+    }, default=str))
 
 # ============================================================================
-# SMART CLUSTERING FUNCTIONS
+# TABLE SCHEMAS
 # ============================================================================
 
-def claim_next_date():
-    """Atomically claim next unprocessed date"""
-    worker_id = f"worker-{uuid.uuid4().hex[:8]}"
+SMART_CLUSTERS_SCHEMA = [
+    bigquery.SchemaField("smart_cluster_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("algorithm_type", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("input_date", "DATE", mode="REQUIRED"),
+    bigquery.SchemaField("original_creation_date", "DATE", mode="REQUIRED"),
+    bigquery.SchemaField("actual_cluster_radius", "FLOAT", mode="NULLABLE"),
+    bigquery.SchemaField("accept_status", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("patient_count", "INTEGER", mode="REQUIRED"),
+    bigquery.SchemaField("primary_syndrome", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("centroid_lat", "FLOAT", mode="NULLABLE"),
+    bigquery.SchemaField("centroid_lon", "FLOAT", mode="NULLABLE"),
+    bigquery.SchemaField("village_name", "STRING", mode="NULLABLE"),
+    bigquery.SchemaField("expansion_count", "INTEGER", mode="REQUIRED"),
+    bigquery.SchemaField("created_at", "TIMESTAMP", mode="REQUIRED"),
+    bigquery.SchemaField("most_common_site_code", "STRING", mode="NULLABLE"),  # kept by the write path
+]
+
+SMART_ASSIGNMENTS_SCHEMA = [
+    bigquery.SchemaField("assignment_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("smart_cluster_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("unique_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("assigned_at", "TIMESTAMP", mode="REQUIRED"),
+    bigquery.SchemaField("addition_type", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("expansion_date", "DATE", mode="NULLABLE"),
+    bigquery.SchemaField("latitude", "FLOAT", mode="NULLABLE"),  # GIS members only
+    bigquery.SchemaField("longitude", "FLOAT", mode="NULLABLE"),
+]
+
+SMART_MERGE_HISTORY_SCHEMA = [
+    bigquery.SchemaField("merge_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("target_cluster_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("source_cluster_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("merge_reason", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("cases_added", "INTEGER", mode="REQUIRED"),
+    bigquery.SchemaField("overlap_cases_removed", "INTEGER", mode="REQUIRED"),
+    bigquery.SchemaField("performed_at", "TIMESTAMP", mode="REQUIRED"),
+]
+
+SMART_PROCESSING_STATUS_SCHEMA = [
+    bigquery.SchemaField("date", "DATE", mode="REQUIRED"),
+    bigquery.SchemaField("status", "STRING", mode="REQUIRED"),  # IN_PROGRESS, COMPLETED, FAILED
+    bigquery.SchemaField("worker_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("started_at", "TIMESTAMP", mode="REQUIRED"),
+    bigquery.SchemaField("completed_at", "TIMESTAMP", mode="NULLABLE"),
+]
+
+# One row per source date, kept current by the ingest and geocoding functions
+# (row and urban geocoding counts) and the engine (status); claims and the
+# quality gate read it instead of scanning the source
+SMART_DATE_LEDGER_SCHEMA = [
+    bigquery.SchemaField("date", "DATE", mode="REQUIRED"),
+    bigquery.SchemaField("row_count", "INTEGER", mode="REQUIRED"),
+    bigquery.SchemaField("total_urban", "INTEGER", mode="NULLABLE"),
+    bigquery.SchemaField("geocoded_urban", "INTEGER", mode="NULLABLE"),
+    bigquery.SchemaField("status", "STRING", mode="REQUIRED"),  # PENDING, IN_PROGRESS, SHARDED, COMPLETED, FAILED
+    bigquery.SchemaField("worker_id", "STRING", mode="NULLABLE"),
+    bigquery.SchemaField("first_ingested_at", "TIMESTAMP", mode="NULLABLE"),
+    bigquery.SchemaField("last_ingested_at", "TIMESTAMP", mode="NULLABLE"),
+    bigquery.SchemaField("claimed_at", "TIMESTAMP", mode="NULLABLE"),
+    bigquery.SchemaField("completed_at", "TIMESTAMP", mode="NULLABLE"),
+    bigquery.SchemaField("heartbeat_at", "TIMESTAMP", mode="NULLABLE"),
+    bigquery.SchemaField("lease_expires_at", "TIMESTAMP", mode="NULLABLE"),
+]
+
+# One row per (date, syndrome) shard of a SHARDED date. Clusters only merge
+# within a syndrome, so a shard depends only on the same syndrome's shards
+# of the MAX_CLUSTER_AGE_DAYS dates before it
+SMART_SHARD_LEDGER_SCHEMA = [
+    bigquery.SchemaField("date", "DATE", mode="REQUIRED"),
+    bigquery.SchemaField("syndrome", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("patient_count", "INTEGER", mode="REQUIRED"),  # window patients with the syndrome
+    bigquery.SchemaField("status", "STRING", mode="REQUIRED"),  # PENDING, IN_PROGRESS, COMPLETED, FAILED
+    bigquery.SchemaField("worker_id", "STRING", mode="NULLABLE"),
+    bigquery.SchemaField("claimed_at", "TIMESTAMP", mode="NULLABLE"),
+    bigquery.SchemaField("heartbeat_at", "TIMESTAMP", mode="NULLABLE"),
+    bigquery.SchemaField("lease_expires_at", "TIMESTAMP", mode="NULLABLE"),
+    bigquery.SchemaField("completed_at", "TIMESTAMP", mode="NULLABLE"),
+]
+
+SMART_JOBS_SCHEMA = [
+    bigquery.SchemaField("job_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("status", "STRING", mode="REQUIRED"),  # QUEUED, RUNNING, COMPLETED, FAILED
+    bigquery.SchemaField("max_dates", "INTEGER", mode="REQUIRED"),
+    bigquery.SchemaField("dates_processed", "INTEGER", mode="NULLABLE"),
+    bigquery.SchemaField("last_date", "DATE", mode="NULLABLE"),
+    bigquery.SchemaField("results", "STRING", mode="NULLABLE"),  # JSON array of per-date results
+    bigquery.SchemaField("error", "STRING", mode="NULLABLE"),
+    bigquery.SchemaField("runner_id", "STRING", mode="NULLABLE"),
+    bigquery.SchemaField("submitted_at", "TIMESTAMP", mode="REQUIRED"),
+    bigquery.SchemaField("started_at", "TIMESTAMP", mode="NULLABLE"),
+    bigquery.SchemaField("heartbeat_at", "TIMESTAMP", mode="NULLABLE"),
+    bigquery.SchemaField("lease_expires_at", "TIMESTAMP", mode="NULLABLE"),
+    bigquery.SchemaField("finished_at", "TIMESTAMP", mode="NULLABLE"),
+]
+
+# Ledger rows a worker may claim: never claimed, failed, or claimed by a
+# worker whose lease has run out (claims made before leases expire
+# CLAIM_LEASE_SECONDS after claimed_at)
+CLAIMABLE_LEDGER_DATE = """(
+    {alias}status IN ('PENDING', 'FAILED')
+    OR ({alias}status = 'IN_PROGRESS'
+        AND IFNULL({alias}lease_expires_at, TIMESTAMP_ADD({alias}claimed_at, INTERVAL @lease_seconds SECOND)) < @timestamp)
+)"""
+
+LEASE_CLAIM = """
+    status = 'IN_PROGRESS',
+    worker_id = @worker_id,
+    claimed_at = @timestamp,
+    heartbeat_at = @timestamp,
+    lease_expires_at = TIMESTAMP_ADD(@timestamp, INTERVAL @lease_seconds SECOND)
+"""
+
+# The per-date counts held in the date ledger, straight from the source (the
+# ingest and geocoding functions recompute them the same way for their dates)
+SOURCE_DATE_COUNTS = f"""
+    SELECT 
+        {PATIENT_ENTRY_DATE} as date,
+        COUNT(*) as row_count,
+        COUNTIF({AREA_TYPE} = 'Urban') as total_urban,
+        COUNTIF({AREA_TYPE} = 'Urban'
+                AND {LATITUDE} IS NOT NULL AND {LONGITUDE} IS NOT NULL 
+                AND {LATITUDE} != 0 AND {LONGITUDE} != 0) as geocoded_urban
+    FROM `{SOURCE_TABLE}`
+    WHERE {PATIENT_ENTRY_DATE} IS NOT NULL
+    GROUP BY date
+"""
+
+# ============================================================================
+# STORAGE
+# ============================================================================
+
+# Each cluster's most common member site_code (ties to the lowest code), for
+# the clusters matching cluster_filter; written onto the cluster rows
+CLUSTER_SITE_CODES = f"""
+    SELECT smart_cluster_id, site_code
+    FROM (
+        SELECT 
+            a.smart_cluster_id,
+            p.site_code,
+            ROW_NUMBER() OVER (PARTITION BY a.smart_cluster_id ORDER BY COUNT(*) DESC, p.site_code) as rn
+        FROM `{SMART_ASSIGNMENTS_TABLE}` a
+        JOIN `{SOURCE_TABLE}` p ON a.unique_id = p.{UNIQUE_ID}
+        WHERE p.site_code IS NOT NULL AND {{cluster_filter}}
+        GROUP BY a.smart_cluster_id, p.site_code
+    )
+    WHERE rn = 1
+"""
+
+class BigQueryStorage:
+    """Every read and write the clustering engine makes, against BigQuery
+    
+    LocalStorage in local_storage.py implements the same methods on DuckDB
+    and Parquet files; STORAGE_BACKEND picks one.
+    """
+    
+    def create_tables(self):
+        """Create smart clustering tables"""
+        logger.info("Creating smart clustering tables...")
+        
+        # Create dataset if not exists
+        dataset_ref = client.dataset(DATASET_ID)
+        try:
+            client.get_dataset(dataset_ref)
+        except Exception:
+            dataset = bigquery.Dataset(dataset_ref)
+            dataset.location = "US"
+            client.create_dataset(dataset)
+            logger.info(f"Created dataset {DATASET_ID}")
+        
+        # Smart Clusters Table (migrated outside the try, so a failed
+        # migration surfaces instead of falling into create_table)
+        try:
+            client.get_table(SMART_CLUSTERS_TABLE)
+        except NotFound:
+            table = bigquery.Table(SMART_CLUSTERS_TABLE, schema=SMART_CLUSTERS_SCHEMA)
+            client.create_table(table)
+            logger.info("Created smart_clusters table")
+        else:
+            logger.info("Smart clusters table exists")
+            self.ensure_cluster_site_codes()
+        
+        # Smart Assignments Table (migrated outside the try, so a failed
+        # backfill surfaces instead of falling into create_table)
+        try:
+            client.get_table(SMART_ASSIGNMENTS_TABLE)
+        except NotFound:
+            table = bigquery.Table(SMART_ASSIGNMENTS_TABLE, schema=SMART_ASSIGNMENTS_SCHEMA)
+            client.create_table(table)
+            logger.info("Created smart_cluster_assignments table")
+        else:
+            logger.info("Smart assignments table exists")
+            self.ensure_assignment_coordinates()
+        
+        # Smart Merge History Table
+        try:
+            client.get_table(SMART_MERGE_HISTORY_TABLE)
+            logger.info("Smart merge history table exists")
+        except Exception:
+            table = bigquery.Table(SMART_MERGE_HISTORY_TABLE, schema=SMART_MERGE_HISTORY_SCHEMA)
+            client.create_table(table)
+            logger.info("Created smart_merge_history table")
+        
+        # Smart Processing Status Table
+        try:
+            client.get_table(SMART_PROCESSING_STATUS_TABLE)
+            logger.info("Smart processing status table exists")
+        except Exception:
+            table = bigquery.Table(SMART_PROCESSING_STATUS_TABLE, schema=SMART_PROCESSING_STATUS_SCHEMA)
+            client.create_table(table)
+            logger.info("Created smart_processing_status table")
+        
+        # Smart Date Ledger Table: seeded only when just created; an
+        # existing ledger is migrated and caught up outside the try
+        try:
+            client.get_table(SMART_DATE_LEDGER_TABLE)
+        except NotFound:
+            table = bigquery.Table(SMART_DATE_LEDGER_TABLE, schema=SMART_DATE_LEDGER_SCHEMA)
+            table.clustering_fields = ['status', 'date']
+            client.create_table(table)
+            logger.info("Created smart_date_ledger table")
+            self.seed_date_ledger()
+        else:
+            logger.info("Smart date ledger table exists")
+            self.ensure_ledger_columns()
+            self.catch_up_date_ledger()
+        
+        # Smart Shard Ledger Table
+        try:
+            client.get_table(SMART_SHARD_LEDGER_TABLE)
+            logger.info("Smart shard ledger table exists")
+        except Exception:
+            table = bigquery.Table(SMART_SHARD_LEDGER_TABLE, schema=SMART_SHARD_LEDGER_SCHEMA)
+            table.clustering_fields = ['status', 'syndrome', 'date']
+            client.create_table(table)
+            logger.info("Created smart_shard_ledger table")
+        
+        # Smart Jobs Table
+        try:
+            client.get_table(SMART_JOBS_TABLE)
+            logger.info("Smart jobs table exists")
+        except Exception:
+            table = bigquery.Table(SMART_JOBS_TABLE, schema=SMART_JOBS_SCHEMA)
+            client.create_table(table)
+            logger.info("Created smart_jobs table")
     
-    # Find next unprocessed date
-    query = f"""
-    WITH source_dates AS (
+    def seed_date_ledger(self):
+        """Fill a new date ledger from the source table and the processing status
+        
+        This is the one full scan of the source; afterwards the ingest and
+        geocoding functions recount the dates they touch. A date takes the
+        best status it reached.
+        """
+        execute_query(f"""
+        MERGE `{SMART_DATE_LEDGER_TABLE}` l
+        USING (
+            SELECT s.*, p.latest.*
+            FROM ({SOURCE_DATE_COUNTS}) s
+            LEFT JOIN (
+                SELECT date, ARRAY_AGG(
+                    STRUCT(status, worker_id, started_at AS claimed_at, completed_at)
+                    ORDER BY CASE status WHEN 'COMPLETED' THEN 0 WHEN 'IN_PROGRESS' THEN 1 ELSE 2 END, started_at DESC
+                    LIMIT 1
+                )[OFFSET(0)] as latest
+                FROM `{SMART_PROCESSING_STATUS_TABLE}`
+                GROUP BY date
+            ) p ON s.date = p.date
+        ) s
+        ON l.date = s.date
+        WHEN MATCHED THEN UPDATE SET row_count = s.row_count, total_urban = s.total_urban, geocoded_urban = s.geocoded_urban
+        WHEN NOT MATCHED THEN INSERT (date, row_count, total_urban, geocoded_urban, status, worker_id, claimed_at, completed_at)
+            VALUES (s.date, s.row_count, s.total_urban, s.geocoded_urban, IFNULL(s.status, 'PENDING'), s.worker_id, s.claimed_at, s.completed_at)
+        """)
+        logger.info("Seeded smart_date_ledger from the source table")
+    
+    def catch_up_date_ledger(self):
+        """Add source dates missing from the date ledger as PENDING
+        
+        The ingest function records new dates, but a date whose ledger MERGE
+        failed there would otherwise never be claimed. Finding missing dates
+        scans only the date column; their counts are read for those dates.
+        Returns the number of dates added.
+        """
+        missing = execute_query(f"""
         SELECT DISTINCT {PATIENT_ENTRY_DATE} as date
+        FROM `{SOURCE_TABLE}` s
+        WHERE {PATIENT_ENTRY_DATE} IS NOT NULL
+          AND {PATIENT_ENTRY_DATE} NOT IN (SELECT date FROM `{SMART_DATE_LEDGER_TABLE}`)
+        """)
+        if missing is None or len(missing) == 0:
+            return 0
+        
+        dates = sorted(to_date(d) for d in missing.date)
+        execute_query(f"""
+        MERGE `{SMART_DATE_LEDGER_TABLE}` l
+        USING (
+            SELECT * FROM ({SOURCE_DATE_COUNTS}) WHERE date IN UNNEST(@dates)
+        ) s
+        ON l.date = s.date
+        WHEN NOT MATCHED THEN INSERT (date, row_count, total_urban, geocoded_urban, status, first_ingested_at, last_ingested_at)
+            VALUES (s.date, s.row_count, s.total_urban, s.geocoded_urban, 'PENDING', CURRENT_TIMESTAMP(), CURRENT_TIMESTAMP())
+        """, array_parameters=[('dates', 'DATE', dates)])
+        logger.info(f"Added {len(dates)} missing dates to smart_date_ledger")
+        return len(dates)
+    
+    def ensure_ledger_columns(self):
+        """Add the lease and quality columns to an existing date ledger
+        
+        Dates recorded before the ledger held quality counts get them
+        counted from the source once.
+        """
+        execute_query(f"""
+        ALTER TABLE `{SMART_DATE_LEDGER_TABLE}`
+        ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP,
+        ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP,
+        ADD COLUMN IF NOT EXISTS total_urban INT64,
+        ADD COLUMN IF NOT EXISTS geocoded_urban INT64
+        """)
+        
+        execute_query(f"""
+        UPDATE `{SMART_DATE_LEDGER_TABLE}` l
+        SET total_urban = s.total_urban, geocoded_urban = s.geocoded_urban
+        FROM ({SOURCE_DATE_COUNTS}) s
+        WHERE l.date = s.date AND l.total_urban IS NULL
+        """)
+    
+    def ensure_cluster_site_codes(self):
+        """Add the most_common_site_code column to an existing clusters table
+        
+        Clusters written before the column existed get their site code
+        computed from their assignments once.
+        """
+        execute_query(f"""
+        ALTER TABLE `{SMART_CLUSTERS_TABLE}`
+        ADD COLUMN IF NOT EXISTS most_common_site_code STRING
+        """)
+        
+        execute_query(f"""
+        UPDATE `{SMART_CLUSTERS_TABLE}` c
+        SET most_common_site_code = s.site_code
+        FROM ({CLUSTER_SITE_CODES.format(cluster_filter='TRUE')}) s
+        WHERE c.smart_cluster_id = s.smart_cluster_id
+          AND c.most_common_site_code IS NULL
+        """)
+        logger.info("Cluster site code column ready")
+    
+    def ensure_assignment_coordinates(self):
+        """Add the member coordinate columns to an existing assignments table
+        
+        GIS assignments written before the columns existed get their
+        coordinates copied from the patient records once.
+        """
+        execute_query(f"""
+        ALTER TABLE `{SMART_ASSIGNMENTS_TABLE}`
+        ADD COLUMN IF NOT EXISTS latitude FLOAT64,
+        ADD COLUMN IF NOT EXISTS longitude FLOAT64
+        """)
+        
+        execute_query(f"""
+        UPDATE `{SMART_ASSIGNMENTS_TABLE}` a
+        SET latitude = p.{LATITUDE}, longitude = p.{LONGITUDE}
+        FROM `{SOURCE_TABLE}` p
+        WHERE a.unique_id = p.unique_id
+          AND a.latitude IS NULL
+          AND a.smart_cluster_id LIKE 'SMART-GIS-%'
+          AND p.{LATITUDE} IS NOT NULL AND p.{LONGITUDE} IS NOT NULL
+        """)
+        logger.info("Assignment coordinate columns ready")
+    
+    def fetch_patient_days(self, days, syndrome=None):
+        """Fetch clustering candidates entered on the given days in one query,
+        optionally only those with one primary syndrome"""
+        query = f"""
+        SELECT 
+            {UNIQUE_ID},
+            {PATIENT_ENTRY_DATE},
+            {AREA_TYPE},
+            {STATE},
+            {DISTRICT},
+            {SUBDISTRICT},
+            {VILLAGE_NAME},
+            {CLINICAL_PRIMARY_SYNDROME},
+            {LATITUDE},
+            {LONGITUDE}
         FROM `{SOURCE_TABLE}`
-    ),
-    processed_dates AS (
-        SELECT DISTINCT date
-        FROM `{PROJECT_ID}.{DATASET_ID}.smart_processing_status`
-        WHERE status IN ('IN_PROGRESS', 'COMPLETED')
-    )
-    SELECT s.date
-    FROM source_dates s
-    LEFT JOIN processed_dates p ON s.date = p.date
-    WHERE p.date IS NULL
-    ORDER BY s.date ASC
-    LIMIT 1
-    """
+        WHERE 
+            {PATIENT_ENTRY_DATE} BETWEEN @start_date AND @end_date
+            AND {PATIENT_ENTRY_DATE} IN UNNEST(@days)
+            AND (@syndrome IS NULL OR {CLINICAL_PRIMARY_SYNDROME} = @syndrome)
+            AND (
+                ({AREA_TYPE} = 'Rural' AND {VILLAGE_NAME} IS NOT NULL)
+                OR (
+                    {AREA_TYPE} = 'Urban'
+                    AND {LATITUDE} BETWEEN 8 AND 37
+                    AND {LONGITUDE} BETWEEN 68 AND 97
+                    AND {LATITUDE} != 0.0
+                    AND {LONGITUDE} != 0.0
+                    AND (pat_street IS NOT NULL AND pat_street != '' OR villagename IS NOT NULL AND villagename != '')
+                )
+            )
+        """
+        
+        return execute_query(
+            query,
+            [('start_date', 'DATE', min(days)), ('end_date', 'DATE', max(days)), ('syndrome', 'STRING', syndrome)],
+            array_parameters=[('days', 'DATE', sorted(days))]
+        )
     
-    df = client.query(query).to_dataframe()
-    if len(df) == 0:
-        return None, None
+    def fetch_date_quality(self, start_date, end_date):
+        """Per-date status and urban geocoding counts over a date range, from the date ledger"""
+        query = f"""
+        SELECT 
+            date,
+            status,
+            IFNULL(total_urban, 0) as total_urban,
+            IFNULL(geocoded_urban, 0) as geocoded_urban
+        FROM `{SMART_DATE_LEDGER_TABLE}`
+        WHERE date BETWEEN @start_date AND @end_date
+        ORDER BY date
+        """
+        
+        return execute_query(query, [
+            ('start_date', 'DATE', start_date),
+            ('end_date', 'DATE', end_date)
+        ])
     
-    next_date = df.date[0].strftime('%Y-%m-%d')
+    def fetch_pending_date_quality(self):
+        """Status, row count and urban geocoding counts of every claimable date"""
+        query = f"""
+        SELECT 
+            date,
+            status,
+            row_count,
+            IFNULL(total_urban, 0) as total_urban,
+            IFNULL(geocoded_urban, 0) as geocoded_urban
+        FROM `{SMART_DATE_LEDGER_TABLE}`
+        WHERE {CLAIMABLE_LEDGER_DATE.format(alias='')}
+        ORDER BY date
+        """
+        
+        return execute_query(query, [
+            ('timestamp', 'TIMESTAMP', datetime.now(timezone.utc)),
+            ('lease_seconds', 'INT64', CLAIM_LEASE_SECONDS)
+        ])
     
-    # Try to claim the date atomically
-    try:
-        claim_query = f"""
-        INSERT INTO `{PROJECT_ID}.{DATASET_ID}.smart_processing_status`
-        (date, status, worker_id, started_at)
-        VALUES (@date, 'IN_PROGRESS', @worker_id, @timestamp)
+    def load_active_abc_clusters(self, processing_date):
+        """Load every ABC cluster young enough to be merged with, in one query"""
+        query = f"""
+        SELECT 
+            c.smart_cluster_id,
+            c.original_creation_date,
+            c.patient_count,
+            c.expansion_count,
+            c.village_name,
+            c.primary_syndrome,
+            c.created_at
+        FROM `{SMART_CLUSTERS_TABLE}` c
+        WHERE c.algorithm_type = 'ABC'
+          AND DATE_DIFF(@processing_date, c.original_creation_date, DAY) <= @max_age_days
+        """
+        
+        return execute_query(query, [
+            ('processing_date', 'DATE', processing_date),
+            ('max_age_days', 'INT64', MAX_CLUSTER_AGE_DAYS)
+        ])
+    
+    def load_active_gis_clusters(self, processing_date):
+        """Load every GIS cluster young enough to be merged with, in one query"""
+        query = f"""
+        SELECT 
+            c.smart_cluster_id,
+            c.original_creation_date,
+            c.patient_count,
+            c.expansion_count,
+            c.centroid_lat,
+            c.centroid_lon,
+            c.actual_cluster_radius,
+            c.primary_syndrome,
+            c.created_at
+        FROM `{SMART_CLUSTERS_TABLE}` c
+        WHERE c.algorithm_type = 'GIS'
+          AND c.centroid_lat IS NOT NULL
+          AND c.centroid_lon IS NOT NULL
+          AND DATE_DIFF(@processing_date, c.original_creation_date, DAY) <= @max_age_days
+        """
+        
+        return execute_query(query, [
+            ('processing_date', 'DATE', processing_date),
+            ('max_age_days', 'INT64', MAX_CLUSTER_AGE_DAYS)
+        ])
+    
+    def load_cluster_members(self, cluster_ids):
+        """Load the assigned unique_ids of many clusters in one query"""
+        members = {cluster_id: set() for cluster_id in cluster_ids}
+        if not members:
+            return members
+        
+        query = f"""
+        SELECT smart_cluster_id, unique_id
+        FROM `{SMART_ASSIGNMENTS_TABLE}`
+        WHERE smart_cluster_id IN UNNEST(@cluster_ids)
         """
         
         job_config = bigquery.QueryJobConfig(
             query_parameters=[
-                bigquery.ScalarQueryParameter('date', 'DATE', next_date),
-                bigquery.ScalarQueryParameter('worker_id', 'STRING', worker_id),
-                bigquery.ScalarQueryParameter('timestamp', 'TIMESTAMP', datetime.now(timezone.utc))
+                bigquery.ArrayQueryParameter('cluster_ids', 'STRING', sorted(members))
             ]
         )
         
-        client.query(claim_query, job_config=job_config)
+        df = client.query(query, job_config=job_config).to_dataframe()
+        for cluster_id, unique_ids in df.groupby('smart_cluster_id')['unique_id']:
+            members[cluster_id].update(unique_ids)
+        return members
+    
+    def load_gis_cluster_members(self, cluster_ids):
+        """Existing members of many GIS clusters with their coordinates, in one query
+        
+        Coordinates are read from the assignment rows, so no join with the
+        patient records is needed.
+        """
+        columns = ['unique_id', LATITUDE, LONGITUDE]
+        members = {cluster_id: pd.DataFrame(columns=columns) for cluster_id in cluster_ids}
+        if not members:
+            return members
+        
+        query = f"""
+        SELECT smart_cluster_id, unique_id, latitude AS {LATITUDE}, longitude AS {LONGITUDE}
+        FROM `{SMART_ASSIGNMENTS_TABLE}`
+        WHERE smart_cluster_id IN UNNEST(@cluster_ids)
+          AND latitude IS NOT NULL AND longitude IS NOT NULL
+        """
+        
+        df = execute_query(query, array_parameters=[('cluster_ids', 'STRING', sorted(members))])
+        for cluster_id, coords in df.groupby('smart_cluster_id'):
+            members[cluster_id] = coords[columns].reset_index(drop=True)
+        return members
+    
+    def write_date(self, clusters, assignments, merge_history, cluster_updates):
+        """Write one date's clusters, assignments, merge history and expansions atomically
+        
+        The new rows are loaded into staging tables first; one multi-statement
+        transaction then copies them into place, applies the expansion MERGE
+        and refreshes the site codes. A flush that fails anywhere writes
+        nothing, so retrying the date can't duplicate rows or double-count
+        expansions.
+        """
+        run_id = uuid.uuid4().hex
+        staged = [
+            (SMART_CLUSTERS_TABLE, SMART_CLUSTERS_SCHEMA, clusters),
+            (SMART_ASSIGNMENTS_TABLE, SMART_ASSIGNMENTS_SCHEMA, assignments),
+            (SMART_MERGE_HISTORY_TABLE, SMART_MERGE_HISTORY_SCHEMA, merge_history)
+        ]
+        staging_tables = []
+        statements = []
+        try:
+            for table_name, schema, rows in staged:
+                if rows is None or len(rows) == 0:
+                    continue
+                
+                staging_table = f"{table_name}_staging_{run_id}"
+                table = bigquery.Table(staging_table, schema=schema)
+                table.expires = datetime.now(timezone.utc) + timedelta(days=1)
+                client.create_table(table)
+                staging_tables.append(staging_table)
+                if isinstance(rows, pd.DataFrame):
+                    self._load_frame(staging_table, schema, rows)
+                else:
+                    self._load_rows(staging_table, schema, rows)
+                
+                columns = ', '.join(field.name for field in schema)
+                statements.append(f"INSERT INTO `{table_name}` ({columns}) SELECT {columns} FROM `{staging_table}`;")
+            
+            query_parameters = []
+            if cluster_updates:
+                statements.append(f"""
+                MERGE `{SMART_CLUSTERS_TABLE}` c
+                USING UNNEST(@updates) u
+                ON c.smart_cluster_id = u.smart_cluster_id
+                WHEN MATCHED THEN UPDATE SET
+                    patient_count = c.patient_count + u.patient_count,
+                    expansion_count = c.expansion_count + u.expansion_count,
+                    input_date = u.input_date,
+                    centroid_lat = COALESCE(u.centroid_lat, c.centroid_lat),
+                    centroid_lon = COALESCE(u.centroid_lon, c.centroid_lon),
+                    actual_cluster_radius = COALESCE(u.actual_cluster_radius, c.actual_cluster_radius);
+                """)
+                query_parameters.append(bigquery.ArrayQueryParameter('updates', 'STRUCT', [
+                    bigquery.StructQueryParameter(
+                        None,
+                        bigquery.ScalarQueryParameter('smart_cluster_id', 'STRING', u['smart_cluster_id']),
+                        bigquery.ScalarQueryParameter('patient_count', 'INT64', u['patient_count']),
+                        bigquery.ScalarQueryParameter('expansion_count', 'INT64', u['expansion_count']),
+                        bigquery.ScalarQueryParameter('input_date', 'DATE', u['input_date']),
+                        bigquery.ScalarQueryParameter('centroid_lat', 'FLOAT64', u.get('centroid_lat')),
+                        bigquery.ScalarQueryParameter('centroid_lon', 'FLOAT64', u.get('centroid_lon')),
+                        bigquery.ScalarQueryParameter('actual_cluster_radius', 'FLOAT64', u.get('actual_cluster_radius'))
+                    )
+                    for u in cluster_updates
+                ]))
+            
+            # Recompute most_common_site_code of every cluster that gained members
+            touched_ids = [row['smart_cluster_id'] for row in clusters] + [u['smart_cluster_id'] for u in cluster_updates]
+            if touched_ids:
+                statements.append(f"""
+                UPDATE `{SMART_CLUSTERS_TABLE}` c
+                SET most_common_site_code = s.site_code
+                FROM ({CLUSTER_SITE_CODES.format(cluster_filter='a.smart_cluster_id IN UNNEST(@cluster_ids)')}) s
+                WHERE c.smart_cluster_id = s.smart_cluster_id
+                  AND c.smart_cluster_id IN UNNEST(@cluster_ids);
+                """)
+                query_parameters.append(bigquery.ArrayQueryParameter('cluster_ids', 'STRING', sorted(touched_ids)))
+            
+            if not statements:
+                return
+            
+            body = '\n'.join(statements)
+            query = f"""
+            BEGIN
+                BEGIN TRANSACTION;
+                {body}
+                COMMIT TRANSACTION;
+            EXCEPTION WHEN ERROR THEN
+                ROLLBACK TRANSACTION;
+                RAISE USING MESSAGE = @@error.message;
+            END;
+            """
+            
+            # A transaction aborted by a concurrent update to the clusters
+            # table left nothing behind, so it is safe to run again
+            job_config = bigquery.QueryJobConfig(query_parameters=query_parameters)
+            for attempt in range(CLAIM_ATTEMPTS):
+                try:
+                    client.query(query, job_config=job_config).result()
+                    break
+                except Exception as e:
+                    if attempt == CLAIM_ATTEMPTS - 1:
+                        raise
+                    logger.info(f"Write transaction failed (attempt {attempt + 1}): {str(e)}")
+        finally:
+            for staging_table in staging_tables:
+                client.delete_table(staging_table, not_found_ok=True)
+    
+    def claim_next_date(self):
+        """Lease the earliest claimable date in the date ledger
+        
+        The MERGE re-checks that the date is still claimable as it updates
+        it, and BigQuery serializes DML on the ledger, so two workers never
+        hold the same date; a claim that loses a conflict is tried again.
+        """
+        worker_id = f"worker-{uuid.uuid4().hex[:8]}"
+        
+        # One script: lease the date in the ledger, then log the claim
+        query = f"""
+        MERGE `{SMART_DATE_LEDGER_TABLE}` l
+        USING (
+            SELECT date
+            FROM `{SMART_DATE_LEDGER_TABLE}`
+            WHERE {CLAIMABLE_LEDGER_DATE.format(alias='')}
+            ORDER BY date
+            LIMIT 1
+        ) c
+        ON l.date = c.date AND {CLAIMABLE_LEDGER_DATE.format(alias='l.')}
+        WHEN MATCHED THEN UPDATE SET {LEASE_CLAIM};
+        
+        {self._log_claims_sql()}
+        
+        SELECT date
+        FROM `{SMART_DATE_LEDGER_TABLE}`
+        WHERE worker_id = @worker_id AND status = 'IN_PROGRESS';
+        """
+        
+        for attempt in range(CLAIM_ATTEMPTS):
+            try:
+                df = execute_query(query, [
+                    ('worker_id', 'STRING', worker_id),
+                    ('timestamp', 'TIMESTAMP', datetime.now(timezone.utc)),
+                    ('lease_seconds', 'INT64', CLAIM_LEASE_SECONDS)
+                ])
+                break
+            except Exception as e:
+                logger.info(f"Failed to claim a date (attempt {attempt + 1}): {str(e)}")
+        else:
+            return None, None
+        
+        if len(df) == 0:
+            return None, None
+        
+        next_date = df.date[0].strftime('%Y-%m-%d')
         logger.info(f"Worker {worker_id} claimed date {next_date}")
         return next_date, worker_id
+    
+    def claim_date_range(self, start_date, end_date):
+        """Lease every claimable ledger date in a range for one backfill worker"""
+        worker_id = f"backfill-{uuid.uuid4().hex[:8]}"
         
-    except Exception as e:
-        logger.info(f"Failed to claim date {next_date}: {str(e)}")
-        return None, None
+        query = f"""
+        UPDATE `{SMART_DATE_LEDGER_TABLE}`
+        SET {LEASE_CLAIM}
+        WHERE date BETWEEN @start_date AND @end_date AND {CLAIMABLE_LEDGER_DATE.format(alias='')};
+        
+        {self._log_claims_sql()}
+        
+        SELECT date
+        FROM `{SMART_DATE_LEDGER_TABLE}`
+        WHERE worker_id = @worker_id AND status = 'IN_PROGRESS'
+        ORDER BY date;
+        """
+        
+        claimed = execute_query(query, [
+            ('start_date', 'DATE', start_date),
+            ('end_date', 'DATE', end_date),
+            ('worker_id', 'STRING', worker_id),
+            ('timestamp', 'TIMESTAMP', datetime.now(timezone.utc)),
+            ('lease_seconds', 'INT64', CLAIM_LEASE_SECONDS)
+        ])
+        return [d.strftime('%Y-%m-%d') for d in claimed['date']], worker_id
+    
+    def _log_claims_sql(self):
+        """Script statements logging the dates just leased by @worker_id
+        
+        Log rows left IN_PROGRESS by a worker whose lease expired are closed
+        as FAILED before the new claim is appended.
+        """
+        return f"""
+        UPDATE `{SMART_PROCESSING_STATUS_TABLE}`
+        SET status = 'FAILED', completed_at = @timestamp
+        WHERE status = 'IN_PROGRESS' AND worker_id != @worker_id
+          AND date IN (SELECT date FROM `{SMART_DATE_LEDGER_TABLE}` WHERE worker_id = @worker_id AND status = 'IN_PROGRESS');
+        
+        INSERT INTO `{SMART_PROCESSING_STATUS_TABLE}` (date, status, worker_id, started_at)
+        SELECT date, 'IN_PROGRESS', @worker_id, @timestamp
+        FROM `{SMART_DATE_LEDGER_TABLE}`
+        WHERE worker_id = @worker_id AND status = 'IN_PROGRESS';
+        """
+    
+    def renew_leases(self, dates, worker_id):
+        """Extend worker_id's lease on dates; returns how many it no longer holds"""
+        df = execute_query(
+            f"""
+            UPDATE `{SMART_DATE_LEDGER_TABLE}`
+            SET heartbeat_at = @timestamp, lease_expires_at = TIMESTAMP_ADD(@timestamp, INTERVAL @lease_seconds SECOND)
+            WHERE date IN UNNEST(@dates) AND worker_id = @worker_id AND status = 'IN_PROGRESS';
+            
+            SELECT @date_count - COUNT(*) as lost
+            FROM `{SMART_DATE_LEDGER_TABLE}`
+            WHERE date IN UNNEST(@dates) AND worker_id = @worker_id AND status = 'IN_PROGRESS';
+            """,
+            [
+                ('worker_id', 'STRING', worker_id),
+                ('timestamp', 'TIMESTAMP', datetime.now(timezone.utc)),
+                ('lease_seconds', 'INT64', CLAIM_LEASE_SECONDS),
+                ('date_count', 'INT64', len(set(dates)))
+            ],
+            array_parameters=[('dates', 'DATE', sorted(set(dates)))]
+        )
+        return int(df.lost[0])
+    
+    def date_ledger_status(self):
+        """Next claimable date, claimable date count, expired leases and
+        watermark from the ledger
+        
+        The watermark is the latest date up to which every date is COMPLETED.
+        """
+        return execute_query(f"""
+        SELECT 
+            MIN(IF({CLAIMABLE_LEDGER_DATE.format(alias='')}, date, NULL)) as next_date,
+            COUNTIF({CLAIMABLE_LEDGER_DATE.format(alias='')}) as pending_dates,
+            COUNTIF(status = 'IN_PROGRESS' AND {CLAIMABLE_LEDGER_DATE.format(alias='')}) as expired_leases,
+            MAX(IF(status = 'COMPLETED' AND date < first_open, date, NULL)) as watermark
+        FROM `{SMART_DATE_LEDGER_TABLE}`
+        CROSS JOIN (
+            SELECT IFNULL(MIN(date), DATE '9999-12-31') as first_open
+            FROM `{SMART_DATE_LEDGER_TABLE}`
+            WHERE status != 'COMPLETED'
+        )
+        """, [
+            ('timestamp', 'TIMESTAMP', datetime.now(timezone.utc)),
+            ('lease_seconds', 'INT64', CLAIM_LEASE_SECONDS)
+        ])
+    
+    def mark_date_completed(self, processing_date, worker_id):
+        """Mark date as completed"""
+        self.mark_dates_completed([processing_date], worker_id)
+    
+    def mark_dates_completed(self, dates, worker_id):
+        """Mark many dates as completed in the ledger and the status log"""
+        if not dates:
+            return
+        execute_query(
+            f"""
+            UPDATE `{SMART_DATE_LEDGER_TABLE}` SET status = 'COMPLETED', completed_at = @timestamp WHERE date IN UNNEST(@dates) AND worker_id = @worker_id;
+            UPDATE `{SMART_PROCESSING_STATUS_TABLE}` SET status = 'COMPLETED', completed_at = @timestamp WHERE date IN UNNEST(@dates) AND worker_id = @worker_id;
+            """,
+            [
+                ('worker_id', 'STRING', worker_id),
+                ('timestamp', 'TIMESTAMP', datetime.now(timezone.utc))
+            ],
+            array_parameters=[('dates', 'DATE', dates)]
+        )
+    
+    def mark_date_failed(self, processing_date, worker_id, error_message):
+        """Mark date as failed with error details"""
+        execute_query(
+            f"""
+            UPDATE `{SMART_DATE_LEDGER_TABLE}` SET status = 'FAILED', completed_at = @timestamp WHERE date = @date AND worker_id = @worker_id;
+            UPDATE `{SMART_PROCESSING_STATUS_TABLE}` SET status = 'FAILED', completed_at = @timestamp WHERE date = @date AND worker_id = @worker_id;
+            """,
+            [
+                ('date', 'DATE', processing_date),
+                ('worker_id', 'STRING', worker_id),
+                ('timestamp', 'TIMESTAMP', datetime.now(timezone.utc))
+            ]
+        )
+        logger.error(f"Processing failed for {processing_date} by {worker_id}: {error_message}")
+    
+    def claim_next_dates(self, count):
+        """Lease the earliest count claimable dates for one shard planner"""
+        worker_id = f"planner-{uuid.uuid4().hex[:8]}"
+        
+        query = f"""
+        UPDATE `{SMART_DATE_LEDGER_TABLE}`
+        SET {LEASE_CLAIM}
+        WHERE {CLAIMABLE_LEDGER_DATE.format(alias='')}
+          AND date IN (
+            SELECT date FROM `{SMART_DATE_LEDGER_TABLE}`
+            WHERE {CLAIMABLE_LEDGER_DATE.format(alias='')}
+            ORDER BY date
+            LIMIT @count
+          );
+        
+        {self._log_claims_sql()}
+        
+        SELECT date
+        FROM `{SMART_DATE_LEDGER_TABLE}`
+        WHERE worker_id = @worker_id AND status = 'IN_PROGRESS'
+        ORDER BY date;
+        """
+        
+        claimed = execute_query(query, [
+            ('count', 'INT64', count),
+            ('worker_id', 'STRING', worker_id),
+            ('timestamp', 'TIMESTAMP', datetime.now(timezone.utc)),
+            ('lease_seconds', 'INT64', CLAIM_LEASE_SECONDS)
+        ])
+        return [d.strftime('%Y-%m-%d') for d in claimed['date']], worker_id
+    
+    def shard_dates(self, dates, worker_id):
+        """Split dates leased by worker_id into (date, syndrome) shards
+        
+        Each date gets one PENDING shard per primary syndrome in its patient
+        window and becomes SHARDED, in one transaction. Returns the shards.
+        """
+        query = f"""
+        BEGIN TRANSACTION;
+        
+        INSERT INTO `{SMART_SHARD_LEDGER_TABLE}` (date, syndrome, patient_count, status)
+        SELECT d.date, p.{CLINICAL_PRIMARY_SYNDROME}, COUNT(*), 'PENDING'
+        FROM `{SOURCE_TABLE}` p
+        JOIN `{SMART_DATE_LEDGER_TABLE}` d
+          ON p.{PATIENT_ENTRY_DATE} BETWEEN DATE_SUB(d.date, INTERVAL @lookback_days DAY) AND DATE_SUB(d.date, INTERVAL 1 DAY)
+        WHERE d.date IN UNNEST(@dates) AND d.worker_id = @worker_id AND d.status = 'IN_PROGRESS'
+          AND p.{PATIENT_ENTRY_DATE} BETWEEN DATE_SUB(@start_date, INTERVAL @lookback_days DAY) AND @end_date
+          AND p.{CLINICAL_PRIMARY_SYNDROME} IS NOT NULL
+          AND d.date NOT IN (SELECT date FROM `{SMART_SHARD_LEDGER_TABLE}`)
+        GROUP BY d.date, p.{CLINICAL_PRIMARY_SYNDROME};
+        
+        UPDATE `{SMART_DATE_LEDGER_TABLE}`
+        SET status = 'SHARDED'
+        WHERE date IN UNNEST(@dates) AND worker_id = @worker_id AND status = 'IN_PROGRESS'
+          AND date IN (SELECT date FROM `{SMART_SHARD_LEDGER_TABLE}`);
+        
+        COMMIT TRANSACTION;
+        
+        SELECT date, syndrome, patient_count
+        FROM `{SMART_SHARD_LEDGER_TABLE}`
+        WHERE date IN UNNEST(@dates)
+        ORDER BY date, syndrome;
+        """
+        
+        return execute_query(
+            query,
+            [
+                ('worker_id', 'STRING', worker_id),
+                ('start_date', 'DATE', min(dates)),
+                ('end_date', 'DATE', max(dates)),
+                ('lookback_days', 'INT64', LOOKBACK_DAYS)
+            ],
+            array_parameters=[('dates', 'DATE', sorted(dates))]
+        )
+    
+    def claim_next_shard(self):
+        """Lease the earliest runnable shard
+        
+        A shard is runnable once every shard of its syndrome in the
+        MAX_CLUSTER_AGE_DAYS dates before it is COMPLETED and none of those
+        dates is still waiting to be processed or sharded.
+        """
+        worker_id = f"shard-{uuid.uuid4().hex[:8]}"
+        
+        query = f"""
+        MERGE `{SMART_SHARD_LEDGER_TABLE}` s
+        USING (
+            SELECT c.date, c.syndrome
+            FROM `{SMART_SHARD_LEDGER_TABLE}` c
+            WHERE {CLAIMABLE_LEDGER_DATE.format(alias='c.')}
+              AND NOT EXISTS (
+                SELECT 1 FROM `{SMART_SHARD_LEDGER_TABLE}` p
+                WHERE p.syndrome = c.syndrome AND p.status != 'COMPLETED'
+                  AND p.date BETWEEN DATE_SUB(c.date, INTERVAL @max_age_days DAY) AND DATE_SUB(c.date, INTERVAL 1 DAY)
+              )
+              AND NOT EXISTS (
+                SELECT 1 FROM `{SMART_DATE_LEDGER_TABLE}` d
+                WHERE d.status NOT IN ('SHARDED', 'COMPLETED')
+                  AND d.date BETWEEN DATE_SUB(c.date, INTERVAL @max_age_days DAY) AND DATE_SUB(c.date, INTERVAL 1 DAY)
+              )
+            ORDER BY c.date, c.syndrome
+            LIMIT 1
+        ) n
+        ON s.date = n.date AND s.syndrome = n.syndrome AND {CLAIMABLE_LEDGER_DATE.format(alias='s.')}
+        WHEN MATCHED THEN UPDATE SET {LEASE_CLAIM};
+        
+        SELECT date, syndrome
+        FROM `{SMART_SHARD_LEDGER_TABLE}`
+        WHERE worker_id = @worker_id AND status = 'IN_PROGRESS';
+        """
+        
+        for attempt in range(CLAIM_ATTEMPTS):
+            try:
+                df = execute_query(query, [
+                    ('worker_id', 'STRING', worker_id),
+                    ('timestamp', 'TIMESTAMP', datetime.now(timezone.utc)),
+                    ('lease_seconds', 'INT64', CLAIM_LEASE_SECONDS),
+                    ('max_age_days', 'INT64', MAX_CLUSTER_AGE_DAYS)
+                ])
+                break
+            except Exception as e:
+                logger.info(f"Failed to claim a shard (attempt {attempt + 1}): {str(e)}")
+        else:
+            return None, None, None
+        
+        if len(df) == 0:
+            return None, None, None
+        
+        shard_date = df.date[0].strftime('%Y-%m-%d')
+        logger.info(f"Worker {worker_id} claimed shard {shard_date}/{df.syndrome[0]}")
+        return shard_date, df.syndrome[0], worker_id
+    
+    def renew_shard_leases(self, dates, worker_id, syndrome):
+        """Extend worker_id's lease on a syndrome's shards; returns how many it no longer holds"""
+        df = execute_query(
+            f"""
+            UPDATE `{SMART_SHARD_LEDGER_TABLE}`
+            SET heartbeat_at = @timestamp, lease_expires_at = TIMESTAMP_ADD(@timestamp, INTERVAL @lease_seconds SECOND)
+            WHERE date IN UNNEST(@dates) AND syndrome = @syndrome AND worker_id = @worker_id AND status = 'IN_PROGRESS';
+            
+            SELECT @date_count - COUNT(*) as lost
+            FROM `{SMART_SHARD_LEDGER_TABLE}`
+            WHERE date IN UNNEST(@dates) AND syndrome = @syndrome AND worker_id = @worker_id AND status = 'IN_PROGRESS';
+            """,
+            [
+                ('syndrome', 'STRING', syndrome),
+                ('worker_id', 'STRING', worker_id),
+                ('timestamp', 'TIMESTAMP', datetime.now(timezone.utc)),
+                ('lease_seconds', 'INT64', CLAIM_LEASE_SECONDS),
+                ('date_count', 'INT64', len(set(dates)))
+            ],
+            array_parameters=[('dates', 'DATE', sorted(set(dates)))]
+        )
+        return int(df.lost[0])
+    
+    def mark_shard_completed(self, shard_date, syndrome, worker_id):
+        """Mark a shard completed; its date (and the planner's log row)
+        completes with its last shard"""
+        execute_query(
+            f"""
+            UPDATE `{SMART_SHARD_LEDGER_TABLE}`
+            SET status = 'COMPLETED', completed_at = @timestamp
+            WHERE date = @date AND syndrome = @syndrome AND worker_id = @worker_id;
+            
+            IF NOT EXISTS (SELECT 1 FROM `{SMART_SHARD_LEDGER_TABLE}` WHERE date = @date AND status != 'COMPLETED') THEN
+                UPDATE `{SMART_PROCESSING_STATUS_TABLE}`
+                SET status = 'COMPLETED', completed_at = @timestamp
+                WHERE date = @date AND status = 'IN_PROGRESS'
+                  AND worker_id IN (SELECT worker_id FROM `{SMART_DATE_LEDGER_TABLE}` WHERE date = @date AND status = 'SHARDED');
+                
+                UPDATE `{SMART_DATE_LEDGER_TABLE}`
+                SET status = 'COMPLETED', completed_at = @timestamp
+                WHERE date = @date AND status = 'SHARDED';
+            END IF;
+            """,
+            [
+                ('date', 'DATE', shard_date),
+                ('syndrome', 'STRING', syndrome),
+                ('worker_id', 'STRING', worker_id),
+                ('timestamp', 'TIMESTAMP', datetime.now(timezone.utc))
+            ]
+        )
+    
+    def mark_shard_failed(self, shard_date, syndrome, worker_id, error_message):
+        """Mark a shard failed; it can be claimed again"""
+        execute_query(
+            f"""
+            UPDATE `{SMART_SHARD_LEDGER_TABLE}`
+            SET status = 'FAILED', completed_at = @timestamp
+            WHERE date = @date AND syndrome = @syndrome AND worker_id = @worker_id
+            """,
+            [
+                ('date', 'DATE', shard_date),
+                ('syndrome', 'STRING', syndrome),
+                ('worker_id', 'STRING', worker_id),
+                ('timestamp', 'TIMESTAMP', datetime.now(timezone.utc))
+            ]
+        )
+        logger.error(f"Processing failed for shard {shard_date}/{syndrome} by {worker_id}: {error_message}")
+    
+    def create_job(self, job_id, max_dates):
+        """Record a QUEUED job"""
+        execute_query(
+            f"""
+            INSERT INTO `{SMART_JOBS_TABLE}` (job_id, status, max_dates, dates_processed, submitted_at)
+            VALUES (@job_id, 'QUEUED', @max_dates, 0, @timestamp)
+            """,
+            [
+                ('job_id', 'STRING', job_id),
+                ('max_dates', 'INT64', max_dates),
+                ('timestamp', 'TIMESTAMP', datetime.now(timezone.utc))
+            ]
+        )
+    
+    def claim_job(self, job_id, runner_id):
+        """Lease a QUEUED job, or a RUNNING one whose runner has gone quiet
+        
+        Returns the job row, or None if it is finished, unknown or held by
+        a live runner. Cloud Tasks delivers a task at least once, so two
+        runs of the same task race here and only one wins.
+        """
+        query = f"""
+        UPDATE `{SMART_JOBS_TABLE}`
+        SET status = 'RUNNING',
+            runner_id = @runner_id,
+            started_at = IFNULL(started_at, @timestamp),
+            heartbeat_at = @timestamp,
+            lease_expires_at = TIMESTAMP_ADD(@timestamp, INTERVAL @lease_seconds SECOND)
+        WHERE job_id = @job_id
+          AND (status = 'QUEUED' OR (status = 'RUNNING' AND lease_expires_at < @timestamp));
+        
+        SELECT *
+        FROM `{SMART_JOBS_TABLE}`
+        WHERE job_id = @job_id AND runner_id = @runner_id AND status = 'RUNNING';
+        """
+        
+        for attempt in range(CLAIM_ATTEMPTS):
+            try:
+                df = execute_query(query, [
+                    ('job_id', 'STRING', job_id),
+                    ('runner_id', 'STRING', runner_id),
+                    ('timestamp', 'TIMESTAMP', datetime.now(timezone.utc)),
+                    ('lease_seconds', 'INT64', JOB_LEASE_SECONDS)
+                ])
+                break
+            except Exception as e:
+                logger.info(f"Failed to claim job {job_id} (attempt {attempt + 1}): {str(e)}")
+        else:
+            return None
+        
+        return df.iloc[0] if len(df) else None
+    
+    def update_job(self, job_id, runner_id, status, progress):
+        """Record runner_id's progress on a job and renew its lease
+        
+        progress holds dates_processed, last_date, results (JSON) and error.
+        A QUEUED status hands the job back for its next task; COMPLETED and
+        FAILED finish it.
+        """
+        execute_query(
+            f"""
+            UPDATE `{SMART_JOBS_TABLE}`
+            SET status = @status,
+                dates_processed = @dates_processed,
+                last_date = @last_date,
+                results = @results,
+                error = @error,
+                runner_id = IF(@status = 'QUEUED', NULL, runner_id),
+                heartbeat_at = @timestamp,
+                lease_expires_at = TIMESTAMP_ADD(@timestamp, INTERVAL @lease_seconds SECOND),
+                finished_at = IF(@status IN ('COMPLETED', 'FAILED'), @timestamp, NULL)
+            WHERE job_id = @job_id AND runner_id = @runner_id
+            """,
+            [
+                ('job_id', 'STRING', job_id),
+                ('runner_id', 'STRING', runner_id),
+                ('status', 'STRING', status),
+                ('dates_processed', 'INT64', progress['dates_processed']),
+                ('last_date', 'DATE', progress['last_date']),
+                ('results', 'STRING', progress['results']),
+                ('error', 'STRING', progress['error']),
+                ('timestamp', 'TIMESTAMP', datetime.now(timezone.utc)),
+                ('lease_seconds', 'INT64', JOB_LEASE_SECONDS)
+            ]
+        )
+    
+    def fetch_job(self, job_id):
+        """A job's row (no rows if there is no such job)"""
+        return execute_query(
+            f"SELECT * FROM `{SMART_JOBS_TABLE}` WHERE job_id = @job_id",
+            [('job_id', 'STRING', job_id)]
+        )
+    
+    def list_jobs(self, limit):
+        """The most recent jobs, newest first, without their results"""
+        return execute_query(
+            f"""
+            SELECT * EXCEPT (results)
+            FROM `{SMART_JOBS_TABLE}`
+            ORDER BY submitted_at DESC
+            LIMIT @limit
+            """,
+            [('limit', 'INT64', limit)]
+        )
+    
+    def _load_rows(self, table_name, schema, rows):
+        """Append rows to a table with a single load job"""
+        if not rows:
+            return
+        
+        job_config = bigquery.LoadJobConfig(
+            schema=schema,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND
+        )
+        job = client.load_table_from_json(rows, table_name, job_config=job_config)
+        try:
+            job.result()
+        except Exception:
+            logger.error(f"BigQuery load failed for {table_name}: {job.errors}")
+            raise Exception(f"Load failed for {table_name}: {job.errors}")
+    
+    def _load_frame(self, table_name, schema, frame):
+        """Append a DataFrame to a table with a single load job (sent as Arrow/Parquet)"""
+        if frame is None or len(frame) == 0:
+            return
+        
+        job_config = bigquery.LoadJobConfig(
+            schema=schema,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND
+        )
+        job = client.load_table_from_dataframe(frame, table_name, job_config=job_config)
+        try:
+            job.result()
+        except Exception:
+            logger.error(f"BigQuery load failed for {table_name}: {job.errors}")
+            raise Exception(f"Load failed for {table_name}: {job.errors}")
 
-def check_data_quality(processing_date):
-    """Check geocoding quality and streaming buffer before processing"""
-    logger.info(f"Checking data quality for {processing_date}")
+def create_storage():
+    """Storage backend selected by STORAGE_BACKEND"""
+    if STORAGE_BACKEND == 'local':
+        from local_storage import LocalStorage
+        return LocalStorage(
+            LOCAL_DATA_DIR,
+            LOCAL_SOURCE_PATH,
+            schemas={
+                'smart_clusters': SMART_CLUSTERS_SCHEMA,
+                'smart_cluster_assignments': SMART_ASSIGNMENTS_SCHEMA,
+                'smart_merge_history': SMART_MERGE_HISTORY_SCHEMA,
+                'smart_processing_status': SMART_PROCESSING_STATUS_SCHEMA,
+                'smart_date_ledger': SMART_DATE_LEDGER_SCHEMA,
+                'smart_shard_ledger': SMART_SHARD_LEDGER_SCHEMA,
+                'smart_jobs': SMART_JOBS_SCHEMA
+            },
+            columns={
+                'unique_id': UNIQUE_ID,
+                'entry_date': PATIENT_ENTRY_DATE,
+                'area_type': AREA_TYPE,
+                'state': STATE,
+                'district': DISTRICT,
+                'subdistrict': SUBDISTRICT,
+                'village': VILLAGE_NAME,
+                'syndrome': CLINICAL_PRIMARY_SYNDROME,
+                'latitude': LATITUDE,
+                'longitude': LONGITUDE
+            },
+            max_cluster_age_days=MAX_CLUSTER_AGE_DAYS,
+            lookback_days=LOOKBACK_DAYS,
+            lease_seconds=CLAIM_LEASE_SECONDS,
+            job_lease_seconds=JOB_LEASE_SECONDS
+        )
+    return BigQueryStorage()
+
+storage = create_storage()
+
+# ============================================================================
+# CLAIM LEASES
+# ============================================================================
+
+class LeaseHeartbeat:
+    """Keep a worker's claimed dates leased while it processes them
     
-    # Check geocoding completeness
-    geocoding_query = f"""
-    SELECT 
-        COUNT(*) as total_urban,
-        COUNTIF({LATITUDE} IS NOT NULL AND {LONGITUDE} IS NOT NULL 
-                AND {LATITUDE} != 0 AND {LONGITUDE} != 0) as geocoded_urban,
-        CASE 
-            WHEN COUNT(*) > 0 
-            THEN COUNTIF({LATITUDE} IS NOT NULL AND {LONGITUDE} IS NOT NULL 
-                         AND {LATITUDE} != 0 AND {LONGITUDE} != 0) / COUNT(*)
-            ELSE 1.0 
-        END as geocoding_pct
-    FROM `{SOURCE_TABLE}`
-    WHERE {PATIENT_ENTRY_DATE} = @processing_date
-      AND {AREA_TYPE} = 'Urban'
+    A daemon thread renews the lease every CLAIM_HEARTBEAT_SECONDS, through
+    storage.renew_leases or, for shards, the renew_leases given. Once a
+    renewal finds a date taken over by another worker (this worker stalled
+    past its lease), the lease is lost and check() raises, so results are
+    never written for a date someone else now owns.
+    """
+    
+    def __init__(self, dates, worker_id, renew_leases=None):
+        self.dates = set(dates)
+        self.worker_id = worker_id
+        self.renew_leases = renew_leases or storage.renew_leases
+        self.lost = False
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"lease-{worker_id}", daemon=True)
+    
+    def start(self):
+        self._thread.start()
+        return self
+    
+    def stop(self):
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+    
+    def release(self, dates):
+        """Stop renewing dates that are finished (completed or failed)"""
+        with self._lock:
+            self.dates -= set(dates)
+    
+    def _run(self):
+        while not self._stopped.wait(CLAIM_HEARTBEAT_SECONDS):
+            try:
+                self.renew()
+            except Exception as e:
+                logger.warning(f"Lease heartbeat for {self.worker_id} failed: {str(e)}")
+    
+    def renew(self):
+        """Extend the lease on the unfinished dates now"""
+        with self._lock:
+            dates = sorted(self.dates)
+        if not dates or self.lost:
+            return
+        with stage('heartbeat'):
+            lost = self.renew_leases(dates, self.worker_id)
+        if lost:
+            self.lost = True
+            logger.error(f"Worker {self.worker_id} lost its lease on {lost} of {len(dates)} dates")
+    
+    def check(self):
+        """Renew the lease and raise if it was lost; call before writing results"""
+        self.renew()
+        if self.lost:
+            raise Exception(f"Lease of {self.worker_id} expired and its dates were reclaimed; results discarded")
+
+# ============================================================================
+# WRITE BUFFER
+# ============================================================================
+
+class WriteBuffer:
+    """Unit of work collecting one date's cluster writes
+    
+    New clusters, assignments and merge-history rows, count/centroid
+    changes to existing clusters and the site codes of every touched
+    cluster are written together by storage.write_date() when flush() is
+    called, so a date is either fully written or not at all.
+    """
+    
+    def __init__(self):
+        self.clusters = {}
+        self.assignments = []
+        self.merge_history = []
+        self.cluster_updates = {}
+    
+    def add_cluster(self, cluster_record):
+        self.clusters[cluster_record['smart_cluster_id']] = cluster_record
+    
+    def add_assignments(self, assignments):
+        """Buffer a frame of assignment rows built by build_assignments"""
+        self.assignments.append(assignments)
+    
+    def add_merge(self, merge_record):
+        self.merge_history.append(merge_record)
+    
+    def update_cluster(self, cluster_id, new_patients, processing_date, centroid_lat=None, centroid_lon=None, radius=None):
+        """Record one expansion of a cluster"""
+        pending = self.clusters.get(cluster_id)
+        if pending is None:
+            pending = self.cluster_updates.setdefault(cluster_id, {
+                'smart_cluster_id': cluster_id,
+                'patient_count': 0,
+                'expansion_count': 0
+            })
+        
+        pending['patient_count'] += new_patients
+        pending['expansion_count'] += 1
+        pending['input_date'] = processing_date
+        if centroid_lat is not None:
+            pending['centroid_lat'] = float(centroid_lat)
+            pending['centroid_lon'] = float(centroid_lon)
+            pending['actual_cluster_radius'] = float(radius)
+    
+    def flush(self):
+        """Write everything buffered in one transaction and reset"""
+        assignments = pd.concat(self.assignments, ignore_index=True) if self.assignments else None
+        try:
+            storage.write_date(
+                list(self.clusters.values()),
+                assignments,
+                self.merge_history,
+                list(self.cluster_updates.values())
+            )
+        finally:
+            # A failed commit may still have landed server-side
+            cluster_cache.invalidate()
+        
+        logger.info(
+            f"Flushed {len(self.clusters)} clusters, {0 if assignments is None else len(assignments)} assignments, "
+            f"{len(self.merge_history)} merge records, {len(self.cluster_updates)} cluster updates"
+        )
+        self.__init__()
+
+def build_assignments(cluster_id, patients, original_creation_date=None, processing_date=None, with_coords=False):
+    """Assignment rows for a cluster's new members, built column by column
+    
+    Without original_creation_date every member is ORIGINAL (a new cluster).
+    Otherwise members whose entry date precedes the cluster's creation are
+    ORIGINAL and the rest are EXPANSION on processing_date.
+    """
+    count = len(patients)
+    if original_creation_date is None:
+        is_original = np.ones(count, dtype=bool)
+    else:
+        entry_dates = pd.to_datetime(patients[PATIENT_ENTRY_DATE]).values
+        is_original = entry_dates < np.datetime64(to_date(original_creation_date))
+    
+    assignments = pd.DataFrame({
+        'assignment_id': bulk_uuid4(count),
+        'smart_cluster_id': cluster_id,
+        'unique_id': patients[UNIQUE_ID].values,
+        'assigned_at': pd.Timestamp.now(tz='UTC'),
+        'addition_type': np.where(is_original, 'ORIGINAL', 'EXPANSION'),
+        'expansion_date': np.where(is_original, None, to_date(processing_date) if processing_date else None)
+    })
+    if with_coords:
+        assignments['latitude'] = patients[LATITUDE].values.astype(float)
+        assignments['longitude'] = patients[LONGITUDE].values.astype(float)
+    return assignments
+
+def bulk_uuid4(count):
+    """count random (version 4) UUID strings generated in one pass"""
+    raw = np.frombuffer(os.urandom(16 * count), dtype=np.uint8).reshape(count, 16).copy()
+    raw[:, 6] = (raw[:, 6] & 0x0F) | 0x40
+    raw[:, 8] = (raw[:, 8] & 0x3F) | 0x80
+    
+    hex_digits = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+    nibbles = np.stack([raw >> 4, raw & 0x0F], axis=2).reshape(count, 32)
+    text = np.full((count, 36), ord('-'), dtype=np.uint8)
+    text[:, [i for i in range(36) if i not in (8, 13, 18, 23)]] = hex_digits[nibbles]
+    return text.view('S36').ravel().astype(str)
+
+# ============================================================================
+# PATIENT WINDOW
+# ============================================================================
+
+class PatientWindow:
+    """Date-bucketed cache of the source patients in the lookback window
+    
+    Each processing date needs the LOOKBACK_DAYS days before it. Keeping one
+    window across the dates of a batch means a new date only fetches the day
+    that entered the window and drops the one that left it. A shard's window
+    holds only its syndrome's patients.
     """
     
-    df = execute_query(geocoding_query, [('processing_date', 'DATE', processing_date)])
+    def __init__(self, syndrome=None):
+        self.syndrome = syndrome
+        self.days = {}
     
-    if len(df) == 0 or df.total_urban[0] == 0:
+    def load(self, processing_date):
+        """Patients entered in [processing_date - LOOKBACK_DAYS, processing_date - 1]"""
+        processing_day = to_date(processing_date)
+        window_days = [processing_day - timedelta(days=offset) for offset in range(LOOKBACK_DAYS, 0, -1)]
+        
+        for day in list(self.days):
+            if day < window_days[0]:
+                del self.days[day]
+        
+        missing_days = [day for day in window_days if day not in self.days]
+        if missing_days:
+            fetched = storage.fetch_patient_days(missing_days, syndrome=self.syndrome)
+            fetched_days = fetched[PATIENT_ENTRY_DATE].map(to_date)
+            for day in missing_days:
+                self.days[day] = fetched[fetched_days == day]
+            logger.info(f"Patient window fetched {len(missing_days)} day(s), {len(fetched)} rows")
+        
+        return pd.concat([self.days[day] for day in window_days], ignore_index=True)
+    
+    def prefetch(self, start_date, end_date):
+        """Fetch the windows of every date in [start_date, end_date] with one scan"""
+        first_day = to_date(start_date) - timedelta(days=LOOKBACK_DAYS)
+        last_day = to_date(end_date) - timedelta(days=1)
+        days = [first_day + timedelta(days=offset) for offset in range((last_day - first_day).days + 1)]
+        
+        fetched = storage.fetch_patient_days(days, syndrome=self.syndrome)
+        fetched_days = fetched[PATIENT_ENTRY_DATE].map(to_date)
+        for day, day_df in fetched.groupby(fetched_days):
+            self.days[day] = day_df
+        empty = fetched.iloc[0:0]
+        for day in days:
+            self.days.setdefault(day, empty)
+        logger.info(f"Patient window prefetched {len(days)} day(s), {len(fetched)} rows")
+
+def select_abc_patients(window_df):
+    """Rural patients whose (state, district, subdistrict, village, syndrome) group reaches MIN_CLUSTER_SIZE"""
+    rural_df = window_df[window_df[AREA_TYPE] == 'Rural']
+    group_sizes = rural_df.groupby(
+        [STATE, DISTRICT, SUBDISTRICT, VILLAGE_NAME, CLINICAL_PRIMARY_SYNDROME], dropna=False
+    )[UNIQUE_ID].transform('size')
+    return rural_df[group_sizes >= MIN_CLUSTER_SIZE]
+
+def select_gis_patients(window_df):
+    """Geocoded urban patients"""
+    return window_df.loc[
+        window_df[AREA_TYPE] == 'Urban',
+        [UNIQUE_ID, CLINICAL_PRIMARY_SYNDROME, LATITUDE, LONGITUDE, PATIENT_ENTRY_DATE, STATE]
+    ].reset_index(drop=True)
+
+# ============================================================================
+# CLUSTER STATE
+# ============================================================================
+
+class ClusterState:
+    """Mergeable clusters and their members, held in memory for a run
+    
+    smart_process loads one per date and a shard one for its syndrome. A
+    backfill loads one for its whole range and keeps it current while it
+    replays each day.
+    """
+    
+    def __init__(self, processing_date, syndrome=None):
+        abc_clusters = storage.load_active_abc_clusters(processing_date)
+        gis_clusters = storage.load_active_gis_clusters(processing_date)
+        if syndrome is not None:
+            abc_clusters = abc_clusters[abc_clusters['primary_syndrome'] == syndrome]
+            gis_clusters = gis_clusters[gis_clusters['primary_syndrome'] == syndrome]
+        self.abc_index = build_abc_cluster_index(abc_clusters)
+        self.gis_index = build_gis_cluster_index(gis_clusters)
+        self.members = {}
+        self.member_coords = {}
+    
+    def load_members(self, cluster_ids):
+        """Fetch the member sets of clusters not held yet, in one query"""
+        missing = [cluster_id for cluster_id in cluster_ids if cluster_id not in self.members]
+        self.members.update(storage.load_cluster_members(missing))
+    
+    def load_gis_members(self, cluster_ids):
+        """Fetch the member coordinates of GIS clusters not held yet, in one query"""
+        missing = [cluster_id for cluster_id in cluster_ids if cluster_id not in self.member_coords]
+        for cluster_id, coords in storage.load_gis_cluster_members(missing).items():
+            self.member_coords[cluster_id] = coords
+            self.members[cluster_id] = set(coords['unique_id'])
+    
+    def gis_members(self, cluster_id):
+        """Geocoded members of a GIS cluster (unique_id, latitude, longitude)"""
+        self.load_gis_members([cluster_id])
+        return self.member_coords[cluster_id]
+    
+    def add_members(self, cluster_id, patients, with_coords=False):
+        """Record new members; existing GIS clusters must have been read with gis_members first"""
+        self.members.setdefault(cluster_id, set()).update(patients[UNIQUE_ID])
+        if with_coords:
+            coords = patients[[UNIQUE_ID, LATITUDE, LONGITUDE]].rename(columns={UNIQUE_ID: 'unique_id'})
+            self.member_coords[cluster_id] = pd.concat(
+                [self.member_coords.get(cluster_id), coords], ignore_index=True
+            )
+
+# ============================================================================
+# SMART CLUSTERING FUNCTIONS
+# ============================================================================
+
+def evaluate_geocoding_quality(total_urban, geocoded_urban):
+    """Apply GEOCODING_THRESHOLD to one date's urban geocoding counts"""
+    if total_urban == 0:
         logger.info("No urban patients found - geocoding check passed")
         return {'passed': True, 'reason': 'no_urban_data', 'total_urban': 0, 'geocoded_urban': 0, 'geocoding_pct': 100.0}
     
-    geocoding_pct = df.geocoding_pct[0]
-    total_urban = df.total_urban[0]
-    geocoded_urban = df.geocoded_urban[0]
+    total_urban = int(total_urban)
+    geocoded_urban = int(geocoded_urban)
+    geocoding_pct = geocoded_urban / total_urban
     
     logger.info(f"Geocoding quality: {geocoded_urban}/{total_urban} ({geocoding_pct*100:.1f}%)")
     
@@ -256,73 +1802,107 @@ def check_data_quality(processing_date):
         logger.warning(f"Geocoding quality {geocoding_pct*100:.1f}% below threshold {GEOCODING_THRESHOLD*100:.1f}%")
         return {'passed': False, 'reason': 'insufficient_geocoding', 'total_urban': total_urban, 'geocoded_urban': geocoded_urban, 'geocoding_pct': geocoding_pct*100}
     
-    # Check streaming buffer
-    try:
-        buffer_query = f"""
-        SELECT COUNT(*) as recent_inserts
-        FROM `{SMART_CLUSTERS_TABLE}`
-        WHERE TIMESTAMP_DIFF(CURRENT_TIMESTAMP(), created_at, SECOND) < 120
-        """
-        buffer_df = execute_query(buffer_query)
-        recent_inserts = buffer_df.recent_inserts[0] if len(buffer_df) > 0 else 0
-        
-        if recent_inserts > 0:
-            logger.warning(f"Streaming buffer active: {recent_inserts} recent inserts")
-            time.sleep(STREAMING_BUFFER_WAIT)
-            logger.info(f"Waited {STREAMING_BUFFER_WAIT}s for streaming buffer")
-    except Exception as e:
-        logger.warning(f"Could not check streaming buffer: {str(e)}")
-    
-    logger.info("Data quality checks passed")
     return {'passed': True, 'reason': 'quality_sufficient', 'total_urban': total_urban, 'geocoded_urban': geocoded_urban, 'geocoding_pct': geocoding_pct*100}
 
-def mark_date_completed(processing_date, worker_id):
-    """Mark date as completed"""
-    execute_query(
-        f"UPDATE `{PROJECT_ID}.{DATASET_ID}.smart_processing_status` SET status = 'COMPLETED', completed_at = @timestamp WHERE date = @date AND worker_id = @worker_id",
-        [
-            ('date', 'DATE', processing_date),
-            ('worker_id', 'STRING', worker_id),
-            ('timestamp', 'TIMESTAMP', datetime.now(timezone.utc))
-        ]
-    )
-
-def mark_date_failed(processing_date, worker_id, error_message):
-    """Mark date as failed with error details"""
-    execute_query(
-        f"UPDATE `{PROJECT_ID}.{DATASET_ID}.smart_processing_status` SET status = 'FAILED', completed_at = @timestamp WHERE date = @date AND worker_id = @worker_id",
-        [
-            ('date', 'DATE', processing_date),
-            ('worker_id', 'STRING', worker_id),
-            ('timestamp', 'TIMESTAMP', datetime.now(timezone.utc))
-        ]
-    )
-    logger.error(f"Processing failed for {processing_date} by {worker_id}: {error_message}")
+def check_data_quality(processing_date):
+    """Check geocoding quality before processing
+    
+    The engine writes with load jobs and DML, never streaming inserts, so
+    its tables have no streaming buffer to wait for.
+    """
+    logger.info(f"Checking data quality for {processing_date}")
+    
+    # Check geocoding completeness
+    df = storage.fetch_date_quality(processing_date, processing_date)
+    if len(df) == 0:
+        result = evaluate_geocoding_quality(0, 0)
+    else:
+        result = evaluate_geocoding_quality(df.total_urban[0], df.geocoded_urban[0])
+    if not result['passed']:
+        return result
+    
+    logger.info("Data quality checks passed")
+    return result
 
-def execute_query(query, parameters=None):
-    """Execute BigQuery with parameterization and error handling"""
+def execute_query(query, parameters=None, array_parameters=None, arrow=False):
+    """Execute BigQuery with parameterization and error handling
+    
+    The result is a DataFrame, or with arrow=True the Arrow table BigQuery
+    returned, unconverted.
+    """
     job_config = None
-    if parameters:
+    if parameters or array_parameters:
         job_config = bigquery.QueryJobConfig(
             query_parameters=[
                 bigquery.ScalarQueryParameter(name, param_type, value)
-                for name, param_type, value in parameters
+                for name, param_type, value in parameters or []
+            ] + [
+                bigquery.ArrayQueryParameter(name, param_type, values)
+                for name, param_type, values in array_parameters or []
             ]
         )
     
     result = client.query(query, job_config=job_config)
+    if arrow:
+        return result.to_arrow()
     return result.to_dataframe() if result.result() else None
 
-def insert_rows_safe(table_name, rows):
-    """Safe BigQuery insert with error handling"""
-    errors = client.insert_rows_json(client.get_table(table_name), rows)
-    if errors:
-        logger.error(f"BigQuery insert failed for {table_name}: {errors}")
-        raise Exception(f"Insert failed: {len(errors)} errors in {table_name}")
+def to_date(value):
+    """Normalize a 'YYYY-MM-DD' string, datetime or date to a date"""
+    if isinstance(value, str):
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+def ledger_status_record(df):
+    """next_date, pending_dates, expired_leases and watermark from a one-row ledger summary"""
+    row = df.iloc[0] if len(df) else {}
+    return {
+        'next_date': to_date(row['next_date']).strftime('%Y-%m-%d') if len(df) and pd.notna(row['next_date']) else None,
+        'pending_dates': int(row['pending_dates']) if len(df) and pd.notna(row['pending_dates']) else 0,
+        'expired_leases': int(row['expired_leases']) if len(df) and pd.notna(row['expired_leases']) else 0,
+        'watermark': to_date(row['watermark']).strftime('%Y-%m-%d') if len(df) and pd.notna(row['watermark']) else None
+    }
+
+def date_readiness_records(df):
+    """Per-date geocoding readiness from the ledger's pending-date quality counts"""
+    records = []
+    for row in df.itertuples(index=False):
+        total_urban = int(row.total_urban)
+        geocoded_urban = int(row.geocoded_urban)
+        geocoding_pct = geocoded_urban / total_urban * 100 if total_urban else 100.0
+        records.append({
+            'date': to_date(row.date).strftime('%Y-%m-%d'),
+            'status': row.status,
+            'row_count': int(row.row_count) if pd.notna(row.row_count) else 0,
+            'total_urban': total_urban,
+            'geocoded_urban': geocoded_urban,
+            'geocoding_pct': round(geocoding_pct, 1),
+            'passed': geocoding_pct >= GEOCODING_THRESHOLD * 100
+        })
+    return records
+
+def frame_to_records(df, date_columns=(), timestamp_columns=(), int_columns=()):
+    """JSON-ready records from a query result, converted column by column
+    
+    Dates become ISO dates, timestamps ISO UTC timestamps, int_columns
+    whole numbers, and every missing value None.
+    """
+    df = df.copy()
+    for column in date_columns:
+        df[column] = pd.to_datetime(df[column]).dt.strftime('%Y-%m-%d')
+    for column in timestamp_columns:
+        df[column] = pd.to_datetime(df[column], utc=True).dt.strftime('%Y-%m-%dT%H:%M:%S.%f+00:00')
+    for column in int_columns:
+        df[column] = np.trunc(pd.to_numeric(df[column])).astype('Int64')
+    
+    df = df.astype(object)
+    return df.where(df.notna(), None).to_dict('records')
 
 def validate_config():
     """Validate environment variables at startup"""
-    required_vars = ['GCP_PROJECT_ID', 'DATASET_ID']
+    required_vars = ['GCP_PROJECT_ID', 'DATASET_ID'] if STORAGE_BACKEND == 'bigquery' else []
     missing = [var for var in required_vars if not os.environ.get(var)]
     if missing:
         raise ValueError(f"Missing required environment variables: {missing}")
@@ -332,39 +1912,20 @@ def validate_config():
         assert MIN_CLUSTER_SIZE >= 2, "MIN_CLUSTER_SIZE must be >= 2"
         assert MAX_CLUSTER_AGE_DAYS > 0, "MAX_CLUSTER_AGE_DAYS must be > 0"
         assert MAX_CLUSTER_RADIUS > 0, "MAX_CLUSTER_RADIUS must be > 0"
+        assert GIS_CLUSTERING_ENGINE in ('sklearn', 'grid'), "GIS_CLUSTERING_ENGINE must be 'sklearn' or 'grid'"
+        assert STORAGE_BACKEND in ('bigquery', 'local'), "STORAGE_BACKEND must be 'bigquery' or 'local'"
         logger.info("Configuration validation passed")
     except AssertionError as e:
         raise ValueError(f"Invalid configuration: {e}")
 
-def smart_abc_clustering(processing_date):
+def smart_abc_clustering(processing_date, write_buffer, patient_window, cluster_state):
     """Smart ABC clustering with merge detection"""
     logger.info("Running smart ABC clustering...")
     
-    # Get rural patients for 7 days before processing date
-    abc_query = f"""
-    WITH base_clusters AS (
-        SELECT 
-            t.*,
-            COUNT(*) OVER (
-                PARTITION BY 
-                    t.{STATE},
-                    t.{DISTRICT},
-                    t.{SUBDISTRICT},
-                    t.{VILLAGE_NAME},
-                    t.{CLINICAL_PRIMARY_SYNDROME}
-            ) AS cluster_count
-        FROM `{SOURCE_TABLE}` AS t
-        WHERE 
-            t.{PATIENT_ENTRY_DATE} BETWEEN DATE_SUB(DATE('{processing_date}'), INTERVAL 7 DAY) AND DATE_SUB(DATE('{processing_date}'), INTERVAL 1 DAY)
-            AND t.{AREA_TYPE} = 'Rural'
-            AND t.{VILLAGE_NAME} IS NOT NULL
-    )
-    SELECT *
-    FROM base_clusters
-    WHERE cluster_count >= {MIN_CLUSTER_SIZE}
-    """
-    
-    abc_df = client.query(abc_query).to_dataframe()
+    # Get rural patients for the lookback window before processing date
+    with stage('abc_query'):
+        window_df = patient_window.load(processing_date)
+    abc_df = select_abc_patients(window_df)
     
     if len(abc_df) == 0:
         logger.info("No ABC clusters found")
@@ -373,77 +1934,74 @@ def smart_abc_clustering(processing_date):
     clusters_created = 0
     expansions_performed = 0
     
-    # Group by village + syndrome
-    for (state, district, subdistrict, village, syndrome), group in abc_df.groupby([
+    groups = abc_df.groupby([
         STATE, DISTRICT, SUBDISTRICT, VILLAGE_NAME, CLINICAL_PRIMARY_SYNDROME
-    ]):
+    ])
+    
+    # Match groups against the in-memory ABC index and fetch the members
+    # of every matched cluster in one query
+    abc_index = cluster_state.abc_index
+    matched_ids = set()
+    for (_, _, _, village, syndrome) in groups.groups.keys():
+        existing_cluster = find_mergeable_abc_cluster(abc_index, processing_date, village, syndrome)
+        if existing_cluster:
+            matched_ids.add(existing_cluster['smart_cluster_id'])
+    with stage('merge_lookups'):
+        cluster_state.load_members(matched_ids)
+    
+    # Group by village + syndrome
+    for (state, district, subdistrict, village, syndrome), group in groups:
         
         # Check for existing cluster to merge with
-        existing_cluster = find_mergeable_abc_cluster(
-            processing_date, state, district, subdistrict, village, syndrome
-        )
+        existing_cluster = find_mergeable_abc_cluster(abc_index, processing_date, village, syndrome)
         
         if existing_cluster:
             # Expand existing cluster
-            expand_abc_cluster(existing_cluster, group, processing_date)
+            expand_abc_cluster(existing_cluster, group, processing_date, cluster_state, write_buffer)
             expansions_performed += 1
         else:
             # Create new cluster
-            create_new_abc_cluster(group, processing_date, village)
+            new_cluster = create_new_abc_cluster(group, processing_date, village, write_buffer)
+            add_to_abc_cluster_index(abc_index, new_cluster)
+            cluster_state.add_members(new_cluster['smart_cluster_id'], group)
             clusters_created += 1
     
     logger.info(f"ABC: Created {clusters_created} clusters, expanded {expansions_performed}")
     return {'clusters': clusters_created, 'expansions': expansions_performed}
 
-def find_mergeable_abc_cluster(processing_date, state, district, subdistrict, village, syndrome):
-    """Find existing ABC cluster that can be merged with"""
-    query = f"""
-    SELECT 
-        c.smart_cluster_id,
-        c.original_creation_date,
-        c.patient_count,
-        c.expansion_count
-    FROM `{SMART_CLUSTERS_TABLE}` c
-    WHERE c.algorithm_type = 'ABC'
-      AND c.village_name = @village
-      AND c.primary_syndrome = @syndrome
-      AND DATE_DIFF(@processing_date, c.original_creation_date, DAY) <= @max_age_days
-    ORDER BY c.original_creation_date ASC
-    LIMIT 1
-    """
-    
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter('village', 'STRING', village),
-            bigquery.ScalarQueryParameter('syndrome', 'STRING', syndrome),
-            bigquery.ScalarQueryParameter('processing_date', 'DATE', processing_date),
-            bigquery.ScalarQueryParameter('max_age_days', 'INT64', MAX_CLUSTER_AGE_DAYS)
-        ]
-    )
+def build_abc_cluster_index(clusters_df):
+    """Hash ABC clusters by (village, syndrome), oldest first"""
+    abc_index = {}
+    if clusters_df is None or len(clusters_df) == 0:
+        return abc_index
     
-    df = client.query(query, job_config=job_config).to_dataframe()
-    return df.iloc[0].to_dict() if len(df) > 0 else None
+    clusters_df = clusters_df.sort_values(['original_creation_date', 'created_at'], kind='stable')
+    for cluster in clusters_df.to_dict('records'):
+        add_to_abc_cluster_index(abc_index, cluster)
+    return abc_index
 
-def expand_abc_cluster(existing_cluster, new_patients, processing_date):
-    """Expand existing ABC cluster with new patients"""
-    cluster_id = existing_cluster['smart_cluster_id']
-    original_creation_date = existing_cluster['original_creation_date']
+def add_to_abc_cluster_index(abc_index, cluster):
+    """Register a cluster in the ABC index, keeping each bucket oldest first"""
+    bucket = abc_index.setdefault((cluster['village_name'], cluster['primary_syndrome']), [])
+    bucket.append(cluster)
+    bucket.sort(key=lambda c: to_date(c['original_creation_date']))
+
+def find_mergeable_abc_cluster(abc_index, processing_date, village, syndrome):
+    """Find existing ABC cluster that can be merged with"""
+    processing_day = to_date(processing_date)
+    for cluster in abc_index.get((village, syndrome), []):
+        if (processing_day - to_date(cluster['original_creation_date'])).days <= MAX_CLUSTER_AGE_DAYS:
+            return cluster
+    return None
+
+def expand_abc_cluster(existing_cluster, new_patients, processing_date, cluster_state, write_buffer):
+    """Expand existing ABC cluster with new patients
     
-    # Get existing patients
-    existing_query = f"""
-    SELECT unique_id
-    FROM `{SMART_ASSIGNMENTS_TABLE}`
-    WHERE smart_cluster_id = @cluster_id
+    existing_cluster and cluster_state are updated in place.
     """
-    
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter('cluster_id', 'STRING', cluster_id)
-        ]
-    )
-    
-    existing_df = client.query(existing_query, job_config=job_config).to_dataframe()
-    existing_patients = set(existing_df['unique_id']) if len(existing_df) > 0 else set()
+    cluster_id = existing_cluster['smart_cluster_id']
+    existing_patients = cluster_state.members.setdefault(cluster_id, set())
+    original_creation_date = to_date(existing_cluster['original_creation_date'])
     
     # Find new patients (remove overlaps)
     new_patient_ids = set(new_patients[UNIQUE_ID])
@@ -455,49 +2013,18 @@ def expand_abc_cluster(existing_cluster, new_patients, processing_date):
         return
     
     # Add new assignments with chronological labeling
-    assignments_to_insert = []
-    for _, patient in new_patients[new_patients[UNIQUE_ID].isin(truly_new_patients)].iterrows():
-        patient_disease_date = patient[PATIENT_ENTRY_DATE]
-        
-        # Label based on disease date vs cluster creation date
-        # original_creation_date is the processing_date when cluster was first created
-        if patient_disease_date < original_creation_date:
-            addition_type = 'ORIGINAL'
-            expansion_date = None
-        else:
-            addition_type = 'EXPANSION'
-            expansion_date = processing_date
-        
-        assignments_to_insert.append({
-            'assignment_id': str(uuid.uuid4()),
-            'smart_cluster_id': cluster_id,
-            'unique_id': patient[UNIQUE_ID],
-            'assigned_at': datetime.now(timezone.utc).isoformat(),
-            'addition_type': addition_type,
-            'expansion_date': expansion_date
-        })
-    
-    insert_rows_safe(SMART_ASSIGNMENTS_TABLE, assignments_to_insert)
+    # original_creation_date is the processing_date when cluster was first created
+    write_buffer.add_assignments(build_assignments(
+        cluster_id, new_patients[new_patients[UNIQUE_ID].isin(truly_new_patients)],
+        original_creation_date, processing_date
+    ))
     
     # Update cluster
-    update_query = f"""
-    UPDATE `{SMART_CLUSTERS_TABLE}`
-    SET 
-        patient_count = patient_count + @new_patient_count,
-        expansion_count = expansion_count + 1,
-        input_date = @processing_date
-    WHERE smart_cluster_id = @cluster_id
-    """
-    
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter('new_patient_count', 'INT64', len(truly_new_patients)),
-            bigquery.ScalarQueryParameter('processing_date', 'DATE', processing_date),
-            bigquery.ScalarQueryParameter('cluster_id', 'STRING', cluster_id)
-        ]
-    )
+    write_buffer.update_cluster(cluster_id, len(truly_new_patients), processing_date)
     
-    client.query(update_query, job_config=job_config)
+    existing_patients.update(truly_new_patients)
+    existing_cluster['patient_count'] += len(truly_new_patients)
+    existing_cluster['expansion_count'] += 1
     
     # Log merge history
     merge_record = {
@@ -509,11 +2036,11 @@ def expand_abc_cluster(existing_cluster, new_patients, processing_date):
         'overlap_cases_removed': len(overlap_patients),
         'performed_at': datetime.now(timezone.utc).isoformat()
     }
-    insert_rows_safe(SMART_MERGE_HISTORY_TABLE, [merge_record])
+    write_buffer.add_merge(merge_record)
     
     logger.info(f"Expanded {cluster_id}: +{len(truly_new_patients)} patients, -{len(overlap_patients)} overlaps")
 
-def create_new_abc_cluster(patients_group, processing_date, village):
+def create_new_abc_cluster(patients_group, processing_date, village, write_buffer):
     """Create new ABC cluster"""
     cluster_id = f"SMART-ABC-{int(time.time())}-{uuid.uuid4().hex[:8]}"
     
@@ -534,57 +2061,27 @@ def create_new_abc_cluster(patients_group, processing_date, village):
         'created_at': datetime.now(timezone.utc).isoformat()
     }
     
-    insert_rows_safe(SMART_CLUSTERS_TABLE, [cluster_record])
+    write_buffer.add_cluster(cluster_record)
     
     # Create assignments - all are ORIGINAL since this is the first detection
-    assignments_to_insert = []
-    for _, patient in patients_group.iterrows():
-        assignments_to_insert.append({
-            'assignment_id': str(uuid.uuid4()),
-            'smart_cluster_id': cluster_id,
-            'unique_id': patient[UNIQUE_ID],
-            'assigned_at': datetime.now(timezone.utc).isoformat(),
-            'addition_type': 'ORIGINAL',
-            'expansion_date': None
-        })
-    
-    insert_rows_safe(SMART_ASSIGNMENTS_TABLE, assignments_to_insert)
+    write_buffer.add_assignments(build_assignments(cluster_id, patients_group))
     
     logger.info(f"Created new ABC cluster {cluster_id} with {len(patients_group)} patients")
+    
+    return {
+        **cluster_record,
+        'original_creation_date': to_date(processing_date),
+        'created_at': datetime.now(timezone.utc)
+    }
 
-def smart_gis_clustering(processing_date):
+def smart_gis_clustering(processing_date, write_buffer, patient_window, cluster_state):
     """Smart GIS clustering with merge detection"""
     logger.info("Running smart GIS clustering...")
     
-    from sklearn.cluster import DBSCAN
-    from sklearn.metrics.pairwise import haversine_distances
-    
-    # Get urban patients for 7 days before processing date
-    gis_query = f"""
-    SELECT 
-        {UNIQUE_ID},
-        {CLINICAL_PRIMARY_SYNDROME},
-        {LATITUDE},
-        {LONGITUDE},
-        {PATIENT_ENTRY_DATE}
-    FROM `{SOURCE_TABLE}`
-    WHERE 
-        {PATIENT_ENTRY_DATE} BETWEEN DATE_SUB(DATE(@processing_date), INTERVAL 7 DAY) AND DATE_SUB(DATE(@processing_date), INTERVAL 1 DAY)
-        AND {AREA_TYPE} = 'Urban'
-        AND {LATITUDE} BETWEEN 8 AND 37
-        AND {LONGITUDE} BETWEEN 68 AND 97
-        AND {LATITUDE} != 0.0
-        AND {LONGITUDE} != 0.0
-        AND (pat_street IS NOT NULL AND pat_street != '' OR villagename IS NOT NULL AND villagename != '')
-    """
-    
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter('processing_date', 'DATE', processing_date)
-        ]
-    )
-    
-    patients_df = client.query(gis_query, job_config=job_config).to_dataframe()
+    # Get urban patients for the lookback window before processing date
+    with stage('gis_query'):
+        window_df = patient_window.load(processing_date)
+    patients_df = select_gis_patients(window_df)
     
     if len(patients_df) == 0:
         logger.info("No GIS patients found")
@@ -593,69 +2090,69 @@ def smart_gis_clustering(processing_date):
     clusters_created = 0
     expansions_performed = 0
     
+    # Mergeable GIS clusters, indexed by centroid per syndrome
+    gis_index = cluster_state.gis_index
+    
     syndromes = patients_df[CLINICAL_PRIMARY_SYNDROME].unique()
     dbscan_assigned_patients = set()
     
-    # DBSCAN clustering by syndrome
+    syndrome_frames = {}
     for syndrome in syndromes:
         syndrome_df = patients_df[patients_df[CLINICAL_PRIMARY_SYNDROME] == syndrome].copy()
+        if len(syndrome_df) >= MIN_CLUSTER_SIZE:
+            syndrome_frames[syndrome] = syndrome_df
+    
+    # DBSCAN every syndrome up front (in parallel when configured)
+    with stage('dbscan'):
+        labels_by_syndrome = run_dbscan_by_syndrome(syndrome_frames)
+    
+    # Merge or create clusters syndrome by syndrome
+    for syndrome, syndrome_df in syndrome_frames.items():
+        cluster_labels = labels_by_syndrome[syndrome]
         
-        if len(syndrome_df) < MIN_CLUSTER_SIZE:
-            continue
+        # Size, centroid and radius of every label in one grouped pass
+        with stage('dbscan'):
+            positions, summary = summarize_dbscan_clusters(
+                syndrome_df[LATITUDE].values, syndrome_df[LONGITUDE].values, cluster_labels
+            )
         
-        coords = syndrome_df[[LATITUDE, LONGITUDE]].values
-        coords_rad = np.radians(coords)
+        within_radius = summary['radius'].values <= MAX_CLUSTER_RADIUS
+        for cluster_radius in summary['radius'].values[~within_radius]:
+            logger.info(f"Cluster radius {cluster_radius}m exceeds limit, skipping")
         
-        clusterer = DBSCAN(
-            eps=DBSCAN_EPSILON_RADIANS,
-            min_samples=MIN_CLUSTER_SIZE,
-            metric='haversine'
-        )
+        candidates = [
+            (syndrome_df.iloc[positions[row.start:row.start + row.size]], row.centroid_lat, row.centroid_lon, row.radius)
+            for row in summary[within_radius].itertuples(index=False)
+        ]
         
-        cluster_labels = clusterer.fit_predict(coords_rad)
-        syndrome_df['dbscan_label'] = cluster_labels
+        # One radius query against the index for every candidate centroid
+        with stage('merge_lookups'):
+            base_matches = query_gis_cluster_index(
+                gis_index, syndrome,
+                [c[1] for c in candidates], [c[2] for c in candidates]
+            )
+            cluster_state.load_gis_members({c['smart_cluster_id'] for matches in base_matches for c in matches})
         
-        for label in set(cluster_labels):
-            if label == -1:
-                continue
-            
-            cluster_patients = syndrome_df[syndrome_df['dbscan_label'] == label].copy()
-            
-            centroid_lat = cluster_patients[LATITUDE].mean()
-            centroid_lon = cluster_patients[LONGITUDE].mean()
-            
-            # Calculate cluster radius
-            cluster_coords = cluster_patients[[LATITUDE, LONGITUDE]].values
-            centroid_coords = np.array([[centroid_lat, centroid_lon]])
-            
-            distances = haversine_distances(
-                np.radians(cluster_coords),
-                np.radians(centroid_coords)
-            ) * 6371000
-            
-            cluster_radius = distances.max()
-            
-            if cluster_radius > MAX_CLUSTER_RADIUS:
-                logger.info(f"Cluster radius {cluster_radius}m exceeds limit, skipping")
-                continue
-            
+        for (cluster_patients, centroid_lat, centroid_lon, cluster_radius), base_match in zip(candidates, base_matches):
             # Check for existing cluster to merge with
             existing_cluster = find_mergeable_gis_cluster(
-                processing_date, syndrome, centroid_lat, centroid_lon, cluster_radius
+                gis_index, processing_date, syndrome, centroid_lat, centroid_lon, base_match
             )
             
             if existing_cluster:
                 # Expand existing cluster
-                expand_gis_cluster(existing_cluster, cluster_patients, processing_date, centroid_lat, centroid_lon)
+                expand_gis_cluster(existing_cluster, cluster_patients, processing_date, centroid_lat, centroid_lon, cluster_state, write_buffer)
+                mark_gis_cluster_moved(gis_index, existing_cluster)
                 expansions_performed += 1
             else:
                 # Create new cluster
-                create_new_gis_cluster(cluster_patients, processing_date, syndrome, centroid_lat, centroid_lon, cluster_radius)
+                new_cluster = create_new_gis_cluster(cluster_patients, processing_date, syndrome, centroid_lat, centroid_lon, cluster_radius, write_buffer)
+                add_to_gis_cluster_index(gis_index, new_cluster)
+                cluster_state.add_members(new_cluster['smart_cluster_id'], cluster_patients, with_coords=True)
                 clusters_created += 1
             
             # Mark patients as assigned
-            for idx, patient in cluster_patients.iterrows():
-                dbscan_assigned_patients.add(patient[UNIQUE_ID])
+            dbscan_assigned_patients.update(cluster_patients[UNIQUE_ID])
     
     # Handle exact coordinate clustering for unassigned patients
     unassigned_df = patients_df[~patients_df[UNIQUE_ID].isin(dbscan_assigned_patients)].copy()
@@ -665,83 +2162,238 @@ def smart_gis_clustering(processing_date):
         
         for syndrome in syndromes_unassigned:
             syndrome_df = unassigned_df[unassigned_df[CLINICAL_PRIMARY_SYNDROME] == syndrome].copy()
-            coord_groups = syndrome_df.groupby([LATITUDE, LONGITUDE])
+            coord_groups = [
+                ((lat, lon), group)
+                for (lat, lon), group in syndrome_df.groupby([LATITUDE, LONGITUDE])
+                if len(group) >= MIN_CLUSTER_SIZE
+            ]
             
-            for (lat, lon), group in coord_groups:
-                if len(group) >= MIN_CLUSTER_SIZE:
-                    # Check for existing cluster to merge with
-                    existing_cluster = find_mergeable_gis_cluster(
-                        processing_date, syndrome, lat, lon, 0.0
-                    )
-                    
-                    if existing_cluster:
-                        expand_gis_cluster(existing_cluster, group, processing_date, lat, lon)
-                        expansions_performed += 1
-                    else:
-                        create_new_gis_cluster(group, processing_date, syndrome, lat, lon, 0.0)
-                        clusters_created += 1
+            with stage('merge_lookups'):
+                base_matches = query_gis_cluster_index(
+                    gis_index, syndrome,
+                    [lat for (lat, _), _ in coord_groups], [lon for (_, lon), _ in coord_groups]
+                )
+                cluster_state.load_gis_members({c['smart_cluster_id'] for matches in base_matches for c in matches})
+            
+            for ((lat, lon), group), base_match in zip(coord_groups, base_matches):
+                # Check for existing cluster to merge with
+                existing_cluster = find_mergeable_gis_cluster(
+                    gis_index, processing_date, syndrome, lat, lon, base_match
+                )
+                
+                if existing_cluster:
+                    expand_gis_cluster(existing_cluster, group, processing_date, lat, lon, cluster_state, write_buffer)
+                    mark_gis_cluster_moved(gis_index, existing_cluster)
+                    expansions_performed += 1
+                else:
+                    new_cluster = create_new_gis_cluster(group, processing_date, syndrome, lat, lon, 0.0, write_buffer)
+                    add_to_gis_cluster_index(gis_index, new_cluster)
+                    cluster_state.add_members(new_cluster['smart_cluster_id'], group, with_coords=True)
+                    clusters_created += 1
     
     logger.info(f"GIS: Created {clusters_created} clusters, expanded {expansions_performed}")
     return {'clusters': clusters_created, 'expansions': expansions_performed}
 
-def find_mergeable_gis_cluster(processing_date, syndrome, lat, lon, radius):
-    """Find existing GIS cluster that can be merged with"""
-    query = f"""
-    SELECT 
-        c.smart_cluster_id,
-        c.original_creation_date,
-        c.patient_count,
-        c.expansion_count,
-        c.centroid_lat,
-        c.centroid_lon,
-        c.actual_cluster_radius
-    FROM `{SMART_CLUSTERS_TABLE}` c
-    WHERE c.algorithm_type = 'GIS'
-      AND c.primary_syndrome = @syndrome
-      AND DATE_DIFF(@processing_date, c.original_creation_date, DAY) <= @max_age_days
-      AND ST_DISTANCE(
-          ST_GEOGPOINT(c.centroid_lon, c.centroid_lat),
-          ST_GEOGPOINT(@lon, @lat)
-      ) <= @epsilon_m
-    ORDER BY c.original_creation_date ASC
-    LIMIT 1
+def build_gis_cluster_index(clusters_df):
+    """Index GIS cluster centroids per syndrome in a haversine BallTree
+    
+    Clusters created or moved after the tree is built are kept in a small
+    per-syndrome overlay that is scanned directly.
     """
+    from sklearn.neighbors import BallTree
     
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter('syndrome', 'STRING', syndrome),
-            bigquery.ScalarQueryParameter('processing_date', 'DATE', processing_date),
-            bigquery.ScalarQueryParameter('max_age_days', 'INT64', MAX_CLUSTER_AGE_DAYS),
-            bigquery.ScalarQueryParameter('lat', 'FLOAT64', lat),
-            bigquery.ScalarQueryParameter('lon', 'FLOAT64', lon),
-            bigquery.ScalarQueryParameter('epsilon_m', 'INT64', DBSCAN_EPSILON_M)
-        ]
-    )
+    gis_index = {}
+    if clusters_df is None or len(clusters_df) == 0:
+        return gis_index
     
-    df = client.query(query, job_config=job_config).to_dataframe()
-    return df.iloc[0].to_dict() if len(df) > 0 else None
+    clusters_df = clusters_df.sort_values(['original_creation_date', 'created_at'], kind='stable')
+    for syndrome, syndrome_clusters in clusters_df.groupby('primary_syndrome', sort=False):
+        coords = np.radians(syndrome_clusters[['centroid_lat', 'centroid_lon']].values.astype(float))
+        gis_index[syndrome] = {
+            'clusters': syndrome_clusters.to_dict('records'),
+            'tree': BallTree(coords, metric='haversine'),
+            'overlay': [],
+            'moved': set()
+        }
+    return gis_index
 
-def expand_gis_cluster(existing_cluster, new_patients, processing_date, new_centroid_lat, new_centroid_lon):
-    """Expand existing GIS cluster with new patients"""
-    cluster_id = existing_cluster['smart_cluster_id']
-    original_creation_date = existing_cluster['original_creation_date']
+def _gis_index_entry(gis_index, syndrome):
+    return gis_index.setdefault(syndrome, {'clusters': [], 'tree': None, 'overlay': [], 'moved': set()})
+
+def add_to_gis_cluster_index(gis_index, cluster):
+    """Register a newly created GIS cluster in the index overlay"""
+    _gis_index_entry(gis_index, cluster['primary_syndrome'])['overlay'].append(cluster)
+
+def mark_gis_cluster_moved(gis_index, cluster):
+    """Move an expanded cluster to the overlay so its new centroid is searched"""
+    entry = _gis_index_entry(gis_index, cluster['primary_syndrome'])
+    if cluster['smart_cluster_id'] not in entry['moved']:
+        entry['moved'].add(cluster['smart_cluster_id'])
+        if not any(c is cluster for c in entry['overlay']):
+            entry['overlay'].append(cluster)
+
+def query_gis_cluster_index(gis_index, syndrome, lats, lons):
+    """Vectorized radius query of many centroids against the indexed clusters
     
-    # Get existing patients with coordinates
-    existing_query = f"""
-    SELECT p.unique_id, p.{LATITUDE}, p.{LONGITUDE}
-    FROM `{SMART_ASSIGNMENTS_TABLE}` a
-    JOIN `{SOURCE_TABLE}` p ON a.unique_id = p.unique_id
-    WHERE a.smart_cluster_id = @cluster_id
-      AND p.{LATITUDE} IS NOT NULL AND p.{LONGITUDE} IS NOT NULL
+    Returns, per point, the list of indexed clusters within DBSCAN_EPSILON_M.
     """
+    entry = gis_index.get(syndrome)
+    if len(lats) == 0:
+        return []
+    if entry is None or entry['tree'] is None:
+        return [[] for _ in lats]
     
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter('cluster_id', 'STRING', cluster_id)
-        ]
+    points = np.radians(np.column_stack([lats, lons]).astype(float))
+    positions = entry['tree'].query_radius(points, r=DBSCAN_EPSILON_RADIANS)
+    return [[entry['clusters'][i] for i in sorted(p)] for p in positions]
+
+def dbscan_labels(coords_rad):
+    """DBSCAN labels for one partition of radian coordinates"""
+    if GIS_CLUSTERING_ENGINE == 'grid':
+        from grid_dbscan import grid_dbscan
+        return grid_dbscan(coords_rad, DBSCAN_EPSILON_RADIANS, MIN_CLUSTER_SIZE)
+    
+    from sklearn.cluster import DBSCAN
+    
+    clusterer = DBSCAN(
+        eps=DBSCAN_EPSILON_RADIANS,
+        min_samples=MIN_CLUSTER_SIZE,
+        metric='haversine'
     )
+    return clusterer.fit_predict(coords_rad)
+
+_dbscan_pool = None
+
+def get_dbscan_pool():
+    """Process pool shared by all DBSCAN runs in this worker"""
+    global _dbscan_pool
+    if _dbscan_pool is None:
+        from concurrent.futures import ProcessPoolExecutor
+        import multiprocessing
+        
+        # Spawned, not forked: lease heartbeat threads are running in this
+        # process, and a fork would copy their locks mid-use
+        _dbscan_pool = ProcessPoolExecutor(max_workers=DBSCAN_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _dbscan_pool
+
+def run_dbscan_by_syndrome(syndrome_frames):
+    """DBSCAN labels for every syndrome frame, keyed by syndrome
+    
+    Each syndrome (and, with DBSCAN_PARTITION_BY_STATE, each state within
+    it) is an independent partition. Partitions go to a process pool when
+    DBSCAN_WORKERS > 1 and there is enough work to pay for it.
+    """
+    tasks = []
+    for syndrome, syndrome_df in syndrome_frames.items():
+        if DBSCAN_PARTITION_BY_STATE:
+            states = syndrome_df[STATE].fillna('').values
+            for state in pd.unique(states):
+                tasks.append((syndrome, np.flatnonzero(states == state)))
+        else:
+            tasks.append((syndrome, np.arange(len(syndrome_df))))
+    
+    coords = [
+        np.radians(syndrome_frames[syndrome][[LATITUDE, LONGITUDE]].values[positions])
+        for syndrome, positions in tasks
+    ]
     
-    existing_df = client.query(existing_query, job_config=job_config).to_dataframe()
+    total_points = sum(len(c) for c in coords)
+    if DBSCAN_WORKERS > 1 and len(tasks) > 1 and total_points >= DBSCAN_PARALLEL_MIN_POINTS:
+        partition_labels = list(get_dbscan_pool().map(dbscan_labels, coords))
+    else:
+        partition_labels = [dbscan_labels(c) for c in coords]
+    
+    # Stitch partition labels back together, keeping them unique per syndrome
+    labels_by_syndrome = {
+        syndrome: np.full(len(syndrome_df), -1, dtype=int)
+        for syndrome, syndrome_df in syndrome_frames.items()
+    }
+    next_label = {syndrome: 0 for syndrome in syndrome_frames}
+    for (syndrome, positions), labels in zip(tasks, partition_labels):
+        clustered = labels >= 0
+        labels_by_syndrome[syndrome][positions[clustered]] = labels[clustered] + next_label[syndrome]
+        if clustered.any():
+            next_label[syndrome] += labels.max() + 1
+    return labels_by_syndrome
+
+def summarize_dbscan_clusters(lats, lons, labels):
+    """Size, centroid and max haversine radius of every DBSCAN label at once
+    
+    Returns the clustered point positions sorted by label, and one summary
+    row per label whose points are positions[start:start + size].
+    """
+    positions = np.flatnonzero(labels >= 0)
+    positions = positions[np.argsort(labels[positions], kind='stable')]
+    cluster_labels, starts, sizes = np.unique(labels[positions], return_index=True, return_counts=True)
+    
+    lats = np.asarray(lats, dtype=float)[positions]
+    lons = np.asarray(lons, dtype=float)[positions]
+    if len(positions) == 0:
+        centroid_lat = centroid_lon = radius = np.array([], dtype=float)
+    else:
+        centroid_lat = np.add.reduceat(lats, starts) / sizes
+        centroid_lon = np.add.reduceat(lons, starts) / sizes
+        distances = haversine_m(np.repeat(centroid_lat, sizes), np.repeat(centroid_lon, sizes), lats, lons)
+        radius = np.maximum.reduceat(distances, starts)
+    
+    return positions, pd.DataFrame({
+        'label': cluster_labels,
+        'start': starts,
+        'size': sizes,
+        'centroid_lat': centroid_lat,
+        'centroid_lon': centroid_lon,
+        'radius': radius
+    })
+
+def find_mergeable_gis_cluster(gis_index, processing_date, syndrome, lat, lon, base_match=None):
+    """Find existing GIS cluster that can be merged with
+    
+    base_match is the point's result from query_gis_cluster_index; it is
+    recomputed when omitted.
+    """
+    entry = gis_index.get(syndrome)
+    if entry is None:
+        return None
+    if base_match is None:
+        base_match = query_gis_cluster_index(gis_index, syndrome, [lat], [lon])[0]
+    
+    candidates = [c for c in base_match if c['smart_cluster_id'] not in entry['moved']]
+    
+    overlay = entry['overlay']
+    if overlay:
+        distances = haversine_m(
+            lat, lon,
+            np.array([c['centroid_lat'] for c in overlay], dtype=float),
+            np.array([c['centroid_lon'] for c in overlay], dtype=float)
+        )
+        candidates.extend(c for c, d in zip(overlay, distances) if d <= DBSCAN_EPSILON_M)
+    
+    processing_day = to_date(processing_date)
+    candidates = [
+        c for c in candidates
+        if (processing_day - to_date(c['original_creation_date'])).days <= MAX_CLUSTER_AGE_DAYS
+    ]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda c: (to_date(c['original_creation_date']), pd.Timestamp(c['created_at'])))
+
+def haversine_m(lat, lon, lats, lons):
+    """Haversine distance in metres from one point to arrays of points"""
+    lat1, lon1 = np.radians(lat), np.radians(lon)
+    lat2, lon2 = np.radians(lats), np.radians(lons)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+def expand_gis_cluster(existing_cluster, new_patients, processing_date, new_centroid_lat, new_centroid_lon, cluster_state, write_buffer):
+    """Expand existing GIS cluster with new patients
+    
+    existing_cluster is updated in place with the new count, centroid and radius.
+    """
+    cluster_id = existing_cluster['smart_cluster_id']
+    original_creation_date = to_date(existing_cluster['original_creation_date'])
+    
+    # Get existing patients with coordinates
+    existing_df = cluster_state.gis_members(cluster_id)
     existing_patients = set(existing_df['unique_id']) if len(existing_df) > 0 else set()
     
     # Find new patients (remove overlaps)
@@ -753,169 +2405,617 @@ def expand_gis_cluster(existing_cluster, new_patients, processing_date, new_cent
         logger.info(f"No new patients to add to GIS cluster {cluster_id}")
         return
     
+    added_patients = new_patients[new_patients[UNIQUE_ID].isin(truly_new_patients)]
+    
+    # Calculate new centroid
+    old_count = existing_cluster['patient_count']
+    new_count = len(truly_new_patients)
+    total_count = old_count + new_count
+    
+    old_lat = existing_cluster['centroid_lat']
+    old_lon = existing_cluster['centroid_lon']
+    
+    weighted_lat = (old_lat * old_count + new_centroid_lat * new_count) / total_count
+    weighted_lon = (old_lon * old_count + new_centroid_lon * new_count) / total_count
+    
+    # Potential new radius: the new members are always measured; existing
+    # members only when the old bounding circle, shifted to the new
+    # centroid, could reach beyond them
+    new_radius = float(haversine_m(
+        weighted_lat, weighted_lon, added_patients[LATITUDE].values, added_patients[LONGITUDE].values
+    ).max())
+    old_radius = existing_cluster.get('actual_cluster_radius')
+    if len(existing_df) > 0 and new_radius <= 1000:
+        if pd.isna(old_radius) or haversine_m(weighted_lat, weighted_lon, old_lat, old_lon) + old_radius > new_radius:
+            new_radius = max(new_radius, float(haversine_m(
+                weighted_lat, weighted_lon, existing_df[LATITUDE].values, existing_df[LONGITUDE].values
+            ).max()))
+    
     # Check if expansion would exceed 1000m radius limit
-    from sklearn.metrics.pairwise import haversine_distances
-    all_coords = []
+    if new_radius > 1000:
+        logger.info(f"Expansion blocked: radius would be {new_radius:.1f}m (>1000m limit)")
+        return
+    
+    # Add new assignments with chronological labeling
+    # original_creation_date is the processing_date when cluster was first created
+    write_buffer.add_assignments(build_assignments(
+        cluster_id, added_patients, original_creation_date, processing_date, with_coords=True
+    ))
+    cluster_state.add_members(cluster_id, added_patients, with_coords=True)
+    
+    # Update cluster with new centroid, count, and radius
+    write_buffer.update_cluster(
+        cluster_id, len(truly_new_patients), processing_date,
+        weighted_lat, weighted_lon, new_radius
+    )
+    
+    existing_cluster.update({
+        'patient_count': existing_cluster['patient_count'] + len(truly_new_patients),
+        'expansion_count': existing_cluster['expansion_count'] + 1,
+        'centroid_lat': weighted_lat,
+        'centroid_lon': weighted_lon,
+        'actual_cluster_radius': new_radius
+    })
+    
+    # Log merge history
+    merge_record = {
+        'merge_id': f"GIS-EXP-{cluster_id}-{processing_date.replace('-', '')}",
+        'target_cluster_id': cluster_id,
+        'source_cluster_id': f"NEW-{processing_date}",
+        'merge_reason': 'GEOGRAPHIC_PROXIMITY',
+        'cases_added': len(truly_new_patients),
+        'overlap_cases_removed': len(overlap_patients),
+        'performed_at': datetime.now(timezone.utc).isoformat()
+    }
+    
+    write_buffer.add_merge(merge_record)
+    
+    logger.info(f"Expanded GIS {cluster_id}: +{len(truly_new_patients)} patients, -{len(overlap_patients)} overlaps, radius: {new_radius:.1f}m")
+
+def create_new_gis_cluster(patients_group, processing_date, syndrome, centroid_lat, centroid_lon, radius, write_buffer):
+    """Create new GIS cluster"""
+    cluster_id = f"SMART-GIS-{int(time.time())}-{uuid.uuid4().hex[:8]}"
+    
+    # Create cluster record with processing_date as original_creation_date
+    cluster_record = {
+        'smart_cluster_id': cluster_id,
+        'algorithm_type': 'GIS',
+        'input_date': processing_date,
+        'original_creation_date': processing_date,
+        'actual_cluster_radius': float(radius),
+        'accept_status': 'Accepted' if radius < AUTO_ACCEPT_RADIUS_THRESHOLD else 'Pending',
+        'patient_count': len(patients_group),
+        'primary_syndrome': syndrome,
+        'centroid_lat': float(centroid_lat),
+        'centroid_lon': float(centroid_lon),
+        'village_name': None,
+        'expansion_count': 0,
+        'created_at': datetime.now(timezone.utc).isoformat()
+    }
+    
+    # All assignments are ORIGINAL since this is the first detection
+    write_buffer.add_assignments(build_assignments(cluster_id, patients_group, with_coords=True))
+    write_buffer.add_cluster(cluster_record)
+    
+    logger.info(f"Created new GIS cluster {cluster_id} with {len(patients_group)} patients")
+    
+    return {
+        **cluster_record,
+        'original_creation_date': to_date(processing_date),
+        'created_at': datetime.now(timezone.utc)
+    }
+
+def split_backfill_runs(dates, ledger):
+    """Split a backfill's claimed dates into runs with no other ledger date inside
     
-    # Add existing patient coordinates
-    for _, patient in existing_df.iterrows():
-        all_coords.append([patient[LATITUDE], patient[LONGITUDE]])
+    A ledger date between two claimed dates that the backfill did not claim
+    was either completed already, so the run after it must load cluster state
+    afresh, or is leased by another worker, so nothing after it can be
+    replayed yet. Returns the runs, the claimed dates left waiting and the
+    leased date they wait for (None when nothing waits).
+    """
+    claimed = {to_date(d) for d in dates}
+    runs = [[]]
+    for row in ledger.to_dict('records'):
+        ledger_date = to_date(row['date'])
+        if ledger_date in claimed:
+            runs[-1].append(ledger_date.strftime('%Y-%m-%d'))
+        elif row['status'] != 'COMPLETED':
+            processed = {d for run in runs for d in run}
+            return [run for run in runs if run], [d for d in dates if d not in processed], ledger_date.strftime('%Y-%m-%d')
+        elif runs[-1]:
+            runs.append([])
+    return [run for run in runs if run], [], None
+
+def smart_backfill_range(start_date, end_date):
+    """Replay every unprocessed date in [start_date, end_date] in memory
+    
+    Patients are read with one scan. The claimed dates are split into runs
+    of consecutive ledger dates (split_backfill_runs); cluster state is
+    loaded once per run, and each date then runs the same ABC/GIS
+    create-or-expand steps as smart_process, in date order, against the
+    in-memory state. Writes are flushed every BACKFILL_FLUSH_DAYS dates and
+    at the end of each run, together with the dates' completion. Dates after
+    one leased by another worker are handed back (marked FAILED) unprocessed.
+    The claimed dates stay leased until they are completed or failed.
+    """
+    dates, worker_id = storage.claim_date_range(start_date, end_date)
+    if not dates:
+        return {'worker_id': worker_id, 'dates': []}
     
-    # Add new patient coordinates
-    for _, patient in new_patients.iterrows():
-        if patient[UNIQUE_ID] in truly_new_patients:
-            all_coords.append([patient[LATITUDE], patient[LONGITUDE]])
+    logger.info(f"Backfill {worker_id} claimed {len(dates)} dates {dates[0]}..{dates[-1]}")
     
-    if len(all_coords) > 0:
-        # Calculate new centroid
-        old_count = existing_cluster['patient_count']
-        new_count = len(truly_new_patients)
-        total_count = old_count + new_count
+    results = []
+    pending_dates = []
+    lease = LeaseHeartbeat(dates, worker_id).start()
+    try:
+        ledger_df = storage.fetch_date_quality(dates[0], dates[-1])
+        quality_by_date = {
+            to_date(row['date']): (row['total_urban'], row['geocoded_urban'])
+            for row in ledger_df.to_dict('records')
+        }
+        
+        runs, waiting_dates, leased_date = split_backfill_runs(dates, ledger_df)
+        for processing_date in waiting_dates:
+            storage.mark_date_failed(processing_date, worker_id, f"Backfill stopped at {leased_date}, leased by another worker")
+            results.append({'date': processing_date, 'success': False, 'waiting_for': leased_date})
+        lease.release(waiting_dates)
+        
+        patient_window = PatientWindow()
+        if runs:
+            patient_window.prefetch(runs[0][0], runs[-1][-1])
+        write_buffer = WriteBuffer()
         
-        old_lat = existing_cluster['centroid_lat']
-        old_lon = existing_cluster['centroid_lon']
+        for run in runs:
+            cluster_state = ClusterState(run[0])
+            for processing_date in run:
+                quality_result = evaluate_geocoding_quality(*quality_by_date.get(to_date(processing_date), (0, 0)))
+                if not quality_result['passed']:
+                    storage.mark_date_failed(processing_date, worker_id, f"Data quality checks failed: {quality_result['reason']}")
+                    lease.release([processing_date])
+                    results.append({'date': processing_date, 'success': False, 'quality_details': quality_result})
+                else:
+                    abc_result = smart_abc_clustering(processing_date, write_buffer, patient_window, cluster_state)
+                    gis_result = smart_gis_clustering(processing_date, write_buffer, patient_window, cluster_state)
+                    pending_dates.append(processing_date)
+                    results.append({
+                        'date': processing_date,
+                        'success': True,
+                        'abc_clusters': abc_result['clusters'],
+                        'abc_expansions': abc_result['expansions'],
+                        'gis_clusters': gis_result['clusters'],
+                        'gis_expansions': gis_result['expansions']
+                    })
+                
+                if pending_dates and (len(pending_dates) >= BACKFILL_FLUSH_DAYS or processing_date == run[-1]):
+                    lease.check()
+                    write_buffer.flush()
+                    storage.mark_dates_completed(pending_dates, worker_id)
+                    lease.release(pending_dates)
+                    pending_dates = []
         
-        weighted_lat = (old_lat * old_count + new_centroid_lat * new_count) / total_count
-        weighted_lon = (old_lon * old_count + new_centroid_lon * new_count) / total_count
+    except Exception as e:
+        failed_dates = [d for d in dates if d not in {r['date'] for r in results}] + pending_dates
+        for processing_date in failed_dates:
+            storage.mark_date_failed(processing_date, worker_id, str(e))
+        raise
+    finally:
+        lease.stop()
+    
+    results.sort(key=lambda r: r['date'])
+    return {'worker_id': worker_id, 'dates': results}
+
+def plan_shards(max_dates):
+    """Claim the next max_dates dates and split them into (date, syndrome) shards
+    
+    Dates failing the geocoding check are marked FAILED as in smart_process;
+    dates with no patients in their window have nothing to shard and are
+    completed straight away.
+    """
+    dates, worker_id = storage.claim_next_dates(max_dates)
+    if not dates:
+        return {'worker_id': worker_id, 'shards': [], 'failed_dates': [], 'completed_dates': []}
+    
+    logger.info(f"Planner {worker_id} claimed {len(dates)} dates {dates[0]}..{dates[-1]}")
+    
+    unplanned = list(dates)
+    failed_dates = []
+    try:
+        quality_df = storage.fetch_date_quality(dates[0], dates[-1])
+        quality_by_date = {
+            to_date(row['date']): (row['total_urban'], row['geocoded_urban'])
+            for row in quality_df.to_dict('records')
+        }
+        for processing_date in dates:
+            quality_result = evaluate_geocoding_quality(*quality_by_date.get(to_date(processing_date), (0, 0)))
+            if not quality_result['passed']:
+                storage.mark_date_failed(processing_date, worker_id, f"Data quality checks failed: {quality_result['reason']}")
+                unplanned.remove(processing_date)
+                failed_dates.append({'date': processing_date, 'quality_details': quality_result})
         
-        # Calculate potential new radius
-        all_coords_array = np.array(all_coords)
-        centroid_coords = np.array([[weighted_lat, weighted_lon]])
+        shards_df = storage.shard_dates(unplanned, worker_id) if unplanned else pd.DataFrame(columns=['date', 'syndrome', 'patient_count'])
+        sharded_dates = {to_date(d) for d in shards_df['date']}
+        completed_dates = [d for d in unplanned if to_date(d) not in sharded_dates]
+        unplanned = completed_dates
+        storage.mark_dates_completed(completed_dates, worker_id)
+    except Exception as e:
+        for processing_date in unplanned:
+            storage.mark_date_failed(processing_date, worker_id, str(e))
+        raise
+    
+    logger.info(f"Planner {worker_id} created {len(shards_df)} shards")
+    return {
+        'worker_id': worker_id,
+        'shards': frame_to_records(shards_df, date_columns=['date'], int_columns=['patient_count']),
+        'failed_dates': failed_dates,
+        'completed_dates': completed_dates
+    }
+
+def run_next_shard():
+    """Claim the earliest runnable (date, syndrome) shard and cluster it
+    
+    The shard runs the same ABC/GIS create-or-expand steps as smart_process
+    on its syndrome's patients and clusters only. Returns None when no
+    shard is runnable.
+    """
+    with stage('claim'):
+        shard_date, syndrome, worker_id = storage.claim_next_shard()
+    if not shard_date:
+        return None
+    
+    lease = LeaseHeartbeat([shard_date], worker_id, renew_leases=partial(storage.renew_shard_leases, syndrome=syndrome)).start()
+    try:
+        write_buffer = WriteBuffer()
+        patient_window = PatientWindow(syndrome=syndrome)
+        with stage('merge_lookups'):
+            cluster_state = ClusterState(shard_date, syndrome=syndrome)
         
-        distances = haversine_distances(
-            np.radians(all_coords_array),
-            np.radians(centroid_coords)
-        ) * 6371000
+        with stage('abc_grouping'):
+            abc_result = smart_abc_clustering(shard_date, write_buffer, patient_window, cluster_state)
         
-        potential_radius = float(distances.max())
+        with stage('gis_clustering'):
+            gis_result = smart_gis_clustering(shard_date, write_buffer, patient_window, cluster_state)
         
-        if potential_radius > 1000:
-            logger.info(f"Expansion blocked: radius would be {potential_radius:.1f}m (>1000m limit)")
-            return
+        with stage('writes'):
+            lease.check()
+            write_buffer.flush()
+            storage.mark_shard_completed(shard_date, syndrome, worker_id)
+    except Exception as e:
+        storage.mark_shard_failed(shard_date, syndrome, worker_id, str(e))
+        raise
+    finally:
+        lease.stop()
     
-    # Use already calculated values from radius check
-    new_radius = potential_radius
+    return {
+        'date': shard_date,
+        'syndrome': syndrome,
+        'worker_id': worker_id,
+        'abc_clusters': abc_result['clusters'],
+        'abc_expansions': abc_result['expansions'],
+        'gis_clusters': gis_result['clusters'],
+        'gis_expansions': gis_result['expansions']
+    }
+
+# ============================================================================
+# BACKGROUND JOBS
+# ============================================================================
+
+def run_batch(max_dates, progress=None, deadline=None):
+    """Process up to max_dates dates with one shared PatientWindow
     
-    # Add new assignments with chronological labeling
-    assignments_to_insert = []
-    for _, patient in new_patients[new_patients[UNIQUE_ID].isin(truly_new_patients)].iterrows():
-        patient_disease_date = patient[PATIENT_ENTRY_DATE]
-        
-        # Label based on disease date vs cluster creation date
-        # original_creation_date is the processing_date when cluster was first created
-        if patient_disease_date < original_creation_date:
-            addition_type = 'ORIGINAL'
-            expansion_date = None
-        else:
-            addition_type = 'EXPANSION'
-            expansion_date = processing_date
-        
-        assignments_to_insert.append({
-            'assignment_id': str(uuid.uuid4()),
-            'smart_cluster_id': cluster_id,
-            'unique_id': patient[UNIQUE_ID],
-            'assigned_at': datetime.now(timezone.utc).isoformat(),
-            'addition_type': addition_type,
-            'expansion_date': expansion_date
-        })
+    Stops at the first failure, when no date is left, or (with a
+    time.monotonic() deadline) before starting a date after the deadline.
+    progress, if given, is called with each date's result (failures
+    included) as soon as the date is done. Returns the successful results.
+    """
+    # Consecutive dates share all but one day of their lookback window
+    patient_window = PatientWindow()
     
-    errors = client.insert_rows_json(client.get_table(SMART_ASSIGNMENTS_TABLE), assignments_to_insert)
-    if errors:
-        logger.error(f"Failed to insert GIS assignments: {errors}")
-        raise Exception(f"BigQuery insert failed: {len(errors)} assignment errors")
+    results = []
+    for i in range(max_dates):
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+        response = smart_process(patient_window=patient_window)
+        result = (response[0] if isinstance(response, tuple) else response).get_json()
+        if progress and (result.get('date_processed') or not result.get('success')):
+            progress(result)
+        if not result.get('success') or not result.get('date_processed'):
+            break
+        results.append(result)
+    return results
+
+def job_progress(results, error=None):
+    """smart_jobs columns recording a job's per-date results so far"""
+    dates = [r['date_processed'] for r in results if r.get('success') and r.get('date_processed')]
+    return {
+        'dates_processed': len(dates),
+        'last_date': to_date(dates[-1]) if dates else None,
+        'results': json.dumps(results, default=str),
+        'error': error
+    }
+
+def job_records(df):
+    """JSON-ready job rows, with their per-date results when selected"""
+    records = frame_to_records(
+        df,
+        date_columns=['last_date'],
+        timestamp_columns=['submitted_at', 'started_at', 'heartbeat_at', 'lease_expires_at', 'finished_at'],
+        int_columns=['max_dates', 'dates_processed']
+    ) if len(df) else []
+    for record in records:
+        if 'results' in record:
+            record['results'] = json.loads(record['results'] or '[]')
+    return records
+
+_tasks_client = None
+
+def enqueue_job(job_id):
+    """Queue the Cloud Tasks task that runs a job (or the rest of it)
     
-    # Update cluster with new centroid, count, and radius
-    update_query = f"""
-    UPDATE `{SMART_CLUSTERS_TABLE}`
-    SET 
-        patient_count = patient_count + @new_patient_count,
-        expansion_count = expansion_count + 1,
-        input_date = @processing_date,
-        centroid_lat = @new_lat,
-        centroid_lon = @new_lon,
-        actual_cluster_radius = @new_radius
-    WHERE smart_cluster_id = @cluster_id
+    The task POSTs to the job's run endpoint, so each run is one request
+    handled start to finish by whichever instance receives it.
     """
+    from google.cloud import tasks_v2
+    from google.protobuf import duration_pb2
     
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter('new_patient_count', 'INT64', len(truly_new_patients)),
-            bigquery.ScalarQueryParameter('processing_date', 'DATE', processing_date),
-            bigquery.ScalarQueryParameter('new_lat', 'FLOAT64', weighted_lat),
-            bigquery.ScalarQueryParameter('new_lon', 'FLOAT64', weighted_lon),
-            bigquery.ScalarQueryParameter('new_radius', 'FLOAT64', new_radius),
-            bigquery.ScalarQueryParameter('cluster_id', 'STRING', cluster_id)
-        ]
-    )
+    global _tasks_client
+    if _tasks_client is None:
+        _tasks_client = tasks_v2.CloudTasksClient()
+    _tasks_client.create_task(parent=SMART_JOBS_QUEUE, task={
+        'http_request': {
+            'http_method': tasks_v2.HttpMethod.POST,
+            'url': f"{SMART_JOBS_URL.rstrip('/')}/smart-jobs/{job_id}/run"
+        },
+        'dispatch_deadline': duration_pb2.Duration(seconds=JOB_LEASE_SECONDS)
+    })
+
+def queue_job(job_id, results=()):
+    """enqueue_job, recording the job FAILED if its task cannot be queued"""
+    try:
+        enqueue_job(job_id)
+    except Exception as e:
+        logger.error(f"Could not queue job {job_id}: {str(e)}")
+        runner_id = f"runner-{uuid.uuid4().hex[:8]}"
+        if storage.claim_job(job_id, runner_id) is not None:
+            storage.update_job(job_id, runner_id, 'FAILED', job_progress(list(results), f"Could not queue job: {str(e)}"))
+        raise
+
+def submit_batch_job(max_dates):
+    """202 response for a batch recorded in smart_jobs and queued on Cloud Tasks"""
+    if not SMART_JOBS_QUEUE or not SMART_JOBS_URL:
+        return jsonify({
+            'success': False,
+            'error': 'Async jobs need SMART_JOBS_QUEUE and SMART_JOBS_URL (a Cloud Tasks queue and this service\'s URL)'
+        }), 503
+    
+    job_id = f"job-{uuid.uuid4().hex[:12]}"
+    storage.create_job(job_id, max_dates)
+    queue_job(job_id)
+    logger.info(f"Submitted {job_id} for up to {max_dates} dates")
+    return jsonify({
+        'success': True,
+        'message': 'Job submitted',
+        'job_id': job_id,
+        'status': 'QUEUED',
+        'status_url': f"/smart-jobs/{job_id}"
+    }), 202
+
+def async_requested():
+    """Whether the request asks to run as a background job (?async=true or "async": true)"""
+    if request.args.get('async', '').lower() == 'true':
+        return True
+    data = request.get_json(silent=True) or {}
+    return data.get('async') is True
+
+# ============================================================================
+# RESPONSE CACHE
+# ============================================================================
+
+class ResponseCache:
+    """JSON response bodies and their ETags by key
+    
+    invalidate() drops every entry. A body computed from a read that
+    started before the last invalidate() is not stored, since it may
+    predate the change; entries also expire after ttl seconds.
+    """
+    
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.generation = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        """(body, etag) for key, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry['stored_at'] > self.ttl:
+            return None
+        return entry['body'], entry['etag']
+    
+    def put(self, key, body, generation):
+        """Store body under key if nothing was invalidated since generation; returns its ETag"""
+        etag = hashlib.sha1(body).hexdigest()
+        with self._lock:
+            if generation == self.generation:
+                self._entries[key] = {'body': body, 'etag': etag, 'stored_at': time.monotonic()}
+        return etag
+    
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+cluster_cache = ResponseCache(CLUSTERS_CACHE_SECONDS)
+
+# Columns /smart-clusters can return, in response order
+CLUSTER_LIST_FIELDS = [
+    'smart_cluster_id', 'algorithm_type', 'input_date', 'original_creation_date',
+    'actual_cluster_radius', 'accept_status', 'patient_count', 'primary_syndrome',
+    'centroid_lat', 'centroid_lon', 'village_name', 'expansion_count', 'created_at',
+    'most_common_site_code'
+]
+
+def encode_cluster_cursor(created_at, cluster_id):
+    """Opaque /smart-clusters cursor for the page after the given cluster"""
+    token = json.dumps([pd.Timestamp(created_at).isoformat(), cluster_id])
+    return base64.urlsafe_b64encode(token.encode()).decode()
+
+def decode_cluster_cursor(cursor):
+    """(created_at, smart_cluster_id) from a /smart-clusters cursor"""
+    created_at, cluster_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return pd.Timestamp(created_at).to_pydatetime(), cluster_id
+
+def conditional_response(body, etag, mimetype='application/json'):
+    """Response with an ETag, answered 304 when If-None-Match matches it"""
+    response = app.response_class(body, mimetype=mimetype)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+# ============================================================================
+# STREAMED RESPONSES
+# ============================================================================
+
+def ndjson_clusters(rows):
+    """NDJSON lines, one per cluster with its patients, from member rows
+    sorted by cluster; a cluster split across result pages is held back
+    until its last member is read"""
+    cluster = None
+    for frame in rows.to_dataframe_iterable():
+        for record in cluster_patient_records(frame):
+            cluster_id = record.pop('smart_cluster_id')
+            algorithm_type = record.pop('algorithm_type')
+            cluster_status = record.pop('cluster_status')
+            if cluster is None or cluster['smart_cluster_id'] != cluster_id:
+                if cluster is not None:
+                    yield json.dumps(cluster) + '\n'
+                cluster = {
+                    'smart_cluster_id': cluster_id,
+                    'algorithm_type': algorithm_type,
+                    'accept_status': cluster_status,
+                    'patients': []
+                }
+            cluster['patients'].append(record)
+    if cluster is not None:
+        yield json.dumps(cluster) + '\n'
+
+def negotiated_format():
+    """'json', 'arrow' or 'parquet' from ?format= or the Accept header
+    
+    None for a ?format= that is not one of them.
+    """
+    requested = request.args.get('format') or (request.get_json(silent=True) or {}).get('format')
+    if requested:
+        return requested if requested in RESPONSE_FORMATS else None
+    best = request.accept_mimetypes.best_match(list(RESPONSE_FORMATS.values()), default='application/json')
+    return next(name for name, mimetype in RESPONSE_FORMATS.items() if mimetype == best)
+
+def vary_on_accept(response):
+    """response, marked for caches as chosen by the Accept header"""
+    response.vary.add('Accept')
+    return response
+
+def unsupported_format():
+    return jsonify({'success': False, 'error': f"format must be one of {', '.join(RESPONSE_FORMATS)}"}), 400
+
+class StreamSink(io.RawIOBase):
+    """Write-only file whose contents are taken out with drain()
+    
+    tell() keeps counting across drains, so Parquet footers still record
+    the right offsets.
+    """
+    
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+    
+    def writable(self):
+        return True
     
-    client.query(update_query, job_config=job_config)
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
     
-    # Log merge history
-    merge_record = {
-        'merge_id': f"GIS-EXP-{cluster_id}-{processing_date.replace('-', '')}",
-        'target_cluster_id': cluster_id,
-        'source_cluster_id': f"NEW-{processing_date}",
-        'merge_reason': 'GEOGRAPHIC_PROXIMITY',
-        'cases_added': len(truly_new_patients),
-        'overlap_cases_removed': len(overlap_patients),
-        'performed_at': datetime.now(timezone.utc).isoformat()
-    }
+    def tell(self):
+        return self.position
     
-    errors = client.insert_rows_json(client.get_table(SMART_MERGE_HISTORY_TABLE), [merge_record])
-    if errors:
-        logger.error(f"Failed to insert GIS merge history: {errors}")
-        raise Exception(f"BigQuery merge history insert failed: {errors}")
+    def drain(self):
+        """Bytes written since the last drain"""
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def table_writer(sink, schema, response_format):
+    """Arrow IPC stream or Parquet writer of schema over sink"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
     
-    logger.info(f"Expanded GIS {cluster_id}: +{len(truly_new_patients)} patients, -{len(overlap_patients)} overlaps, radius: {new_radius:.1f}m")
+    if response_format == 'parquet':
+        return pq.ParquetWriter(sink, schema)
+    return pa.ipc.new_stream(sink, schema)
 
-def create_new_gis_cluster(patients_group, processing_date, syndrome, centroid_lat, centroid_lon, radius):
-    """Create new GIS cluster"""
-    cluster_id = f"SMART-GIS-{int(time.time())}-{uuid.uuid4().hex[:8]}"
+def table_body(table, response_format, **metadata):
+    """An Arrow table as one Arrow IPC stream or Parquet file
     
-    # Create cluster record with processing_date as original_creation_date
-    cluster_record = {
-        'smart_cluster_id': cluster_id,
-        'algorithm_type': 'GIS',
-        'input_date': processing_date,
-        'original_creation_date': processing_date,
-        'actual_cluster_radius': float(radius),
-        'accept_status': 'Accepted' if radius < AUTO_ACCEPT_RADIUS_THRESHOLD else 'Pending',
-        'patient_count': len(patients_group),
-        'primary_syndrome': syndrome,
-        'centroid_lat': float(centroid_lat),
-        'centroid_lon': float(centroid_lon),
-        'village_name': None,
-        'expansion_count': 0,
-        'created_at': datetime.now(timezone.utc).isoformat()
-    }
+    metadata (None values left out) is added to the schema, where
+    readers of either format find it.
+    """
+    metadata = {key: str(value) for key, value in metadata.items() if value is not None}
+    if metadata:
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), **metadata})
+    sink = StreamSink()
+    writer = table_writer(sink, table.schema, response_format)
+    writer.write_table(table)
+    writer.close()
+    return sink.drain()
+
+def arrow_schema(fields):
+    """Arrow schema of BigQuery schema fields, typed as BigQuery's Arrow
+    results are (an empty result has no batch to take it from)"""
+    import pyarrow as pa
     
-    # Create assignments first - all are ORIGINAL since this is the first detection
-    assignments_to_insert = []
-    for _, patient in patients_group.iterrows():
-        assignments_to_insert.append({
-            'assignment_id': str(uuid.uuid4()),
-            'smart_cluster_id': cluster_id,
-            'unique_id': patient[UNIQUE_ID],
-            'assigned_at': datetime.now(timezone.utc).isoformat(),
-            'addition_type': 'ORIGINAL',
-            'expansion_date': None
-        })
+    types = {
+        'STRING': pa.string(), 'BYTES': pa.binary(),
+        'INTEGER': pa.int64(), 'INT64': pa.int64(),
+        'FLOAT': pa.float64(), 'FLOAT64': pa.float64(),
+        'NUMERIC': pa.decimal128(38, 9), 'BIGNUMERIC': pa.decimal256(76, 38),
+        'BOOLEAN': pa.bool_(), 'BOOL': pa.bool_(),
+        'DATE': pa.date32(), 'TIME': pa.time64('us'),
+        'DATETIME': pa.timestamp('us'), 'TIMESTAMP': pa.timestamp('us', tz='UTC'),
+        'GEOGRAPHY': pa.string(), 'JSON': pa.string()
+    }
     
-    # Insert assignments first
-    errors = client.insert_rows_json(client.get_table(SMART_ASSIGNMENTS_TABLE), assignments_to_insert)
-    if errors:
-        logger.error(f"Failed to insert GIS cluster assignments: {errors}")
-        raise Exception(f"BigQuery assignment insert failed: {len(errors)} errors")
+    def arrow_field(field):
+        if field.field_type in ('RECORD', 'STRUCT'):
+            arrow_type = pa.struct([arrow_field(f) for f in field.fields])
+        else:
+            arrow_type = types[field.field_type]
+        if field.mode == 'REPEATED':
+            return pa.field(field.name, pa.list_(arrow_type), nullable=False)
+        return pa.field(field.name, arrow_type, nullable=field.mode != 'REQUIRED')
     
-    # Only create cluster if assignments succeeded
-    errors = client.insert_rows_json(client.get_table(SMART_CLUSTERS_TABLE), [cluster_record])
-    if errors:
-        logger.error(f"Failed to insert GIS cluster: {errors}")
-        # Clean up assignments if cluster creation fails
-        client.query(f"DELETE FROM `{SMART_ASSIGNMENTS_TABLE}` WHERE smart_cluster_id = '{cluster_id}'")
-        raise Exception(f"BigQuery cluster insert failed: {errors}")
+    return pa.schema([arrow_field(f) for f in fields])
+
+def table_stream(rows, response_format):
+    """Arrow IPC stream or Parquet file of a query result, written and
+    sent one result page (record batch or row group) at a time"""
+    import pyarrow as pa
     
-    logger.info(f"Created new GIS cluster {cluster_id} with {len(patients_group)} patients")
+    sink = StreamSink()
+    writer = None
+    for batch in rows.to_arrow_iterable():
+        if writer is None:
+            writer = table_writer(sink, batch.schema, response_format)
+        writer.write_table(pa.Table.from_batches([batch]))
+        yield sink.drain()
+    if writer is None:
+        # No rows: the schema comes from the result's BigQuery schema, as
+        # the iterator has already been started and cannot be read again
+        writer = table_writer(sink, arrow_schema(rows.schema), response_format)
+    writer.close()
+    yield sink.drain()
 
 # ============================================================================
 # API ENDPOINTS
@@ -933,11 +3033,20 @@ def api_info():
         'status': 'running',
         'endpoints': {
             'health': '/health (GET) - Health check and system status',
-            'smart-process': '/smart-process (POST) - Process next date',
+            'smart-process': '/smart-process (POST) - Process next date ("async": true runs it as a job)',
+            'smart-batch': '/smart-batch (POST) - Process several dates ("async": true runs them as a job)',
+            'smart-jobs': '/smart-jobs[/<job_id>] (GET) - Status and per-date progress of async jobs',
+            'smart-job-run': '/smart-jobs/<job_id>/run (POST) - Run an async job (called by Cloud Tasks)',
             'smart-preflight': '/smart-preflight (GET/POST) - Data quality check and test',
+            'smart-backfill': '/smart-backfill (POST) - Process a date range in one pass',
+            'smart-shard-plan': '/smart-shard-plan (POST) - Split the next dates into (date, syndrome) shards',
+            'smart-shard-process': '/smart-shard-process (POST) - Process the earliest runnable shard',
+            'smart-shard-batch': '/smart-shard-batch (POST) - Process runnable shards until none is left',
             'smart-config': '/smart-config (GET/POST) - Configuration management',
-            'smart-clusters': '/smart-clusters (GET) - Get clusters',
-            'smart-cluster-patients': '/smart-cluster-patients (GET) - Get cluster patients'
+            'smart-telemetry': '/smart-telemetry (GET) - BigQuery cost and latency per job label',
+            'smart-clusters': '/smart-clusters (GET) - Get clusters (filters, fields, limit/cursor pages; JSON, Arrow or Parquet)',
+            'smart-cluster-patients': '/smart-cluster-patients (GET) - Get cluster patients (JSON, Arrow or Parquet)',
+            'smart-cluster-patients-bulk': '/smart-cluster-patients/bulk (GET/POST) - Patients of many clusters in one query (NDJSON, Arrow or Parquet)'
         }
     })
 
@@ -954,14 +3063,14 @@ def health():
             status,
             COUNT(*) as count,
             MAX(started_at) as last_activity
-        FROM `{PROJECT_ID}.{DATASET_ID}.smart_processing_status`
+        FROM `{SMART_PROCESSING_STATUS_TABLE}`
         WHERE started_at >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 24 HOUR)
         GROUP BY status
         """
         
         try:
             status_df = client.query(status_query).to_dataframe()
-            status_summary = {row.status: int(row.count) for _, row in status_df.iterrows()}
+            status_summary = dict(zip(status_df['status'], status_df['count'].astype(int).tolist()))
         except:
             status_summary = {}
         
@@ -1038,71 +3147,110 @@ def health():
 
 
 @app.route('/smart-process', methods=['POST'])
-def smart_process():
-    """Process next date with smart clustering"""
-    try:
-        processing_date, worker_id = claim_next_date()
-        if not processing_date:
-            return jsonify({
-                'success': True,
-                'message': 'All dates processed or claimed by other workers',
-                'date_processed': None
-            })
-        
-        logger.info(f"Worker {worker_id} processing date: {processing_date}")
-        
+def smart_process(patient_window=None):
+    """Process next date with smart clustering
+    
+    /smart-batch passes one PatientWindow for all of its dates. The
+    response and a structured log line break the request down by stage.
+    """
+    if patient_window is None:
+        if has_request_context() and async_requested():
+            return submit_batch_job(1)
+        patient_window = PatientWindow()
+    
+    with profiled() as profile:
+        processing_date, worker_id = None, None
         try:
-            # Check data quality before processing
-            quality_result = check_data_quality(processing_date)
-            if not quality_result['passed']:
-                mark_date_failed(processing_date, worker_id, f"Data quality checks failed: {quality_result['reason']}")
+            with stage('claim'):
+                processing_date, worker_id = storage.claim_next_date()
+            if not processing_date:
                 return jsonify({
-                    'success': False,
-                    'message': f"Data quality checks failed: {quality_result['reason']}",
-                    'date_processed': processing_date,
-                    'worker_id': worker_id,
-                    'quality_details': quality_result
+                    'success': True,
+                    'message': 'All dates processed or claimed by other workers',
+                    'date_processed': None
                 })
             
-            # ABC Clustering
-            abc_result = smart_abc_clustering(processing_date)
+            logger.info(f"Worker {worker_id} processing date: {processing_date}")
             
-            # GIS Clustering
-            gis_result = smart_gis_clustering(processing_date)
-            
-            # Mark as completed
-            mark_date_completed(processing_date, worker_id)
+            lease = LeaseHeartbeat([processing_date], worker_id).start()
+            try:
+                # Check data quality before processing
+                with stage('quality_check'):
+                    quality_result = check_data_quality(processing_date)
+                if not quality_result['passed']:
+                    with stage('writes'):
+                        storage.mark_date_failed(processing_date, worker_id, f"Data quality checks failed: {quality_result['reason']}")
+                    profile_summary = profile.summary()
+                    log_profile('smart_process', profile_summary, date=processing_date, worker_id=worker_id, success=False)
+                    return jsonify({
+                        'success': False,
+                        'message': f"Data quality checks failed: {quality_result['reason']}",
+                        'date_processed': processing_date,
+                        'worker_id': worker_id,
+                        'quality_details': quality_result,
+                        'profile': profile_summary
+                    })
+                
+                write_buffer = WriteBuffer()
+                with stage('merge_lookups'):
+                    cluster_state = ClusterState(processing_date)
+                
+                # ABC Clustering
+                with stage('abc_grouping'):
+                    abc_result = smart_abc_clustering(processing_date, write_buffer, patient_window, cluster_state)
+                
+                # GIS Clustering
+                with stage('gis_clustering'):
+                    gis_result = smart_gis_clustering(processing_date, write_buffer, patient_window, cluster_state)
+                
+                # Write all clusters, assignments and merge history for the date
+                with stage('writes'):
+                    lease.check()
+                    write_buffer.flush()
+                    
+                    # Mark as completed
+                    storage.mark_date_completed(processing_date, worker_id)
+                
+                profile_summary = profile.summary()
+                log_profile('smart_process', profile_summary, date=processing_date, worker_id=worker_id, success=True)
+                
+                return jsonify({
+                    'success': True,
+                    'message': 'Smart processing complete',
+                    'date_processed': processing_date,
+                    'worker_id': worker_id,
+                    'abc_clusters': abc_result['clusters'],
+                    'abc_expansions': abc_result['expansions'],
+                    'gis_clusters': gis_result['clusters'],
+                    'gis_expansions': gis_result['expansions'],
+                    'cluster_limits': {
+                        'max_cluster_age_days': MAX_CLUSTER_AGE_DAYS,
+                        'dbscan_epsilon_m': DBSCAN_EPSILON_M,
+                        'max_cluster_radius_m': MAX_CLUSTER_RADIUS,
+                        'min_cluster_size': MIN_CLUSTER_SIZE,
+                        'auto_accept_radius_m': AUTO_ACCEPT_RADIUS_THRESHOLD
+                    },
+                    'profile': profile_summary,
+                    'timestamp': datetime.now(timezone.utc).isoformat()
+                })
             
+            except Exception as processing_error:
+                # Mark as failed with error details
+                storage.mark_date_failed(processing_date, worker_id, str(processing_error))
+                raise processing_error
+            finally:
+                lease.stop()
+        
+        except Exception as e:
+            logger.error(f"Error in smart processing: {str(e)}")
+            profile_summary = profile.summary()
+            log_profile('smart_process', profile_summary, date=processing_date, worker_id=worker_id, success=False, error=str(e))
             return jsonify({
-                'success': True,
-                'message': 'Smart processing complete',
+                'success': False,
+                'error': str(e),
                 'date_processed': processing_date,
-                'worker_id': worker_id,
-                'abc_clusters': abc_result['clusters'],
-                'abc_expansions': abc_result['expansions'],
-                'gis_clusters': gis_result['clusters'],
-                'gis_expansions': gis_result['expansions'],
-                'cluster_limits': {
-                    'max_cluster_age_days': MAX_CLUSTER_AGE_DAYS,
-                    'dbscan_epsilon_m': DBSCAN_EPSILON_M,
-                    'max_cluster_radius_m': MAX_CLUSTER_RADIUS,
-                    'min_cluster_size': MIN_CLUSTER_SIZE,
-                    'auto_accept_radius_m': AUTO_ACCEPT_RADIUS_THRESHOLD
-                },
-                'timestamp': datetime.now(timezone.utc).isoformat()
-            })
-            
-        except Exception as processing_error:
-            # Mark as failed with error details
-            mark_date_failed(processing_date, worker_id, str(processing_error))
-            raise processing_error
-        
-    except Exception as e:
-        logger.error(f"Error in smart processing: {str(e)}")
-        return jsonify({
-            'success': False,
-            'error': str(e)
-        }), 500
+                'profile': profile_summary
+            }), 500
 
 
 
@@ -1134,47 +3282,41 @@ def smart_preflight():
         except:
             pending_count = 0
         
-        # Get next unprocessed date
-        query = f"""
-        WITH source_dates AS (
-            SELECT DISTINCT {PATIENT_ENTRY_DATE} as date
-            FROM `{SOURCE_TABLE}`
-        ),
-        processed_dates AS (
-            SELECT DISTINCT date
-            FROM `{PROJECT_ID}.{DATASET_ID}.smart_processing_status`
-            WHERE status IN ('IN_PROGRESS', 'COMPLETED')
-        )
-        SELECT s.date
-        FROM source_dates s
-        LEFT JOIN processed_dates p ON s.date = p.date
-        WHERE p.date IS NULL
-        ORDER BY s.date ASC
-        LIMIT 1
-        """
-        
-        df = client.query(query).to_dataframe()
-        if len(df) == 0:
+        # Get next unprocessed date from the date ledger, once any source
+        # dates the ingest function failed to record are added to it
+        missing_dates = storage.catch_up_date_ledger()
+        ledger = ledger_status_record(storage.date_ledger_status())
+        if not ledger['next_date']:
             return jsonify({
                 'success': True, 
                 'message': 'All dates processed', 
                 'overall_passed': pending_count == 0,
-                'pending_clusters': pending_count
+                'pending_clusters': pending_count,
+                'watermark': ledger['watermark']
             })
         
-        test_date = df.date[0].strftime('%Y-%m-%d')
+        test_date = ledger['next_date']
         quality_result = check_data_quality(test_date)
         quality_passed = quality_result['passed']
         overall_passed = quality_passed and pending_count == 0
         
+        # Readiness of every pending date, read from the ledger in one lookup
+        date_readiness = date_readiness_records(storage.fetch_pending_date_quality())
+        
         return jsonify({
             'success': True,
             'test_date': test_date,
             'overall_passed': overall_passed,
             'data_quality_passed': quality_passed,
             'pending_clusters': pending_count,
+            'pending_dates': ledger['pending_dates'],
+            'expired_leases': ledger['expired_leases'],
+            'watermark': ledger['watermark'],
+            'missing_dates_added': missing_dates,
             'geocoding_threshold': GEOCODING_THRESHOLD * 100,
             'quality_details': quality_result,
+            'date_readiness': date_readiness,
+            'ready_dates': sum(1 for r in date_readiness if r['passed']),
             'message': 'Preflight check and test completed'
         })
         
@@ -1186,7 +3328,7 @@ def smart_init():
     """Initialize smart clustering tables"""
     try:
         validate_config()
-        create_smart_tables()
+        storage.create_tables()
         return jsonify({
             'success': True,
             'message': 'Smart clustering tables created successfully'
@@ -1198,20 +3340,204 @@ def smart_init():
 
 @app.route('/smart-batch', methods=['POST'])
 def smart_batch():
-    """Process multiple dates"""
+    """Process multiple dates
+    
+    With "async": true the batch is queued as a job on Cloud Tasks instead
+    of running inside the request; poll /smart-jobs/<job_id> for its progress.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        max_dates = data.get('max_dates', 5)
+        
+        if async_requested():
+            return submit_batch_job(max_dates)
+        
+        results = run_batch(max_dates)
+        
+        return jsonify({
+            'success': True,
+            'dates_processed': len(results),
+            'results': results
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/smart-jobs', methods=['GET'])
+def smart_jobs():
+    """Status of the most recent async jobs, newest first"""
+    try:
+        return jsonify({
+            'success': True,
+            'jobs': job_records(storage.list_jobs(JOB_HISTORY))
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/smart-jobs/<job_id>', methods=['GET'])
+def smart_job_status(job_id):
+    """Status, per-date progress and stage timings of one async job"""
+    try:
+        jobs = job_records(storage.fetch_job(job_id))
+        if not jobs:
+            return jsonify({'success': False, 'error': f"Unknown job {job_id}"}), 404
+        return jsonify({'success': True, **jobs[0]})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/smart-jobs/<job_id>/run', methods=['POST'])
+def smart_job_run(job_id):
+    """Run a job's next task; called by Cloud Tasks
+    
+    Processes dates until the job is done or JOB_TASK_SECONDS have passed,
+    recording each date's result in smart_jobs, then queues the rest of the
+    job as a new task. A job leased by another run answers 409, and storage
+    errors 500, so Cloud Tasks retries the task; a retry takes the job over
+    once the lease of a run that died has run out.
+    """
+    runner_id = f"runner-{uuid.uuid4().hex[:8]}"
+    job = storage.claim_job(job_id, runner_id)
+    if job is None:
+        jobs = job_records(storage.fetch_job(job_id))
+        if jobs and jobs[0]['status'] == 'RUNNING':
+            return jsonify({'success': False, 'error': f"Job {job_id} is running elsewhere"}), 409
+        return jsonify({'success': True, 'message': f"Job {job_id} is finished or unknown"})
+    
+    results = json.loads(job['results']) if isinstance(job['results'], str) else []
+    remaining = int(job['max_dates']) - job_progress(results)['dates_processed']
+    deadline = time.monotonic() + JOB_TASK_SECONDS
+    logger.info(f"Runner {runner_id} running {job_id}: up to {remaining} dates")
+    
+    def progress(result):
+        results.append(result)
+        storage.update_job(job_id, runner_id, 'RUNNING', job_progress(results))
+    
+    try:
+        processed = run_batch(remaining, progress=progress, deadline=deadline)
+    except Exception as e:
+        logger.error(f"Job {job_id} failed: {str(e)}")
+        storage.update_job(job_id, runner_id, 'FAILED', job_progress(results, str(e)))
+        return jsonify({'success': False, 'job_id': job_id, 'error': str(e)})
+    
+    failed = [r for r in results if not r.get('success')]
+    if failed:
+        status = 'FAILED'
+        error = failed[0].get('error') or failed[0].get('message')
+    elif len(processed) < remaining and time.monotonic() >= deadline:
+        status, error = 'QUEUED', None
+    else:
+        status, error = 'COMPLETED', None
+    storage.update_job(job_id, runner_id, status, job_progress(results, error))
+    if status == 'QUEUED':
+        queue_job(job_id, results)
+    
+    return jsonify({'success': True, 'job_id': job_id, 'status': status, 'dates_processed': len(processed)})
+
+@app.route('/smart-backfill', methods=['POST'])
+def smart_backfill():
+    """Process every unprocessed date in a range with one source scan"""
+    try:
+        data = request.get_json() or {}
+        start_date = data.get('start_date')
+        end_date = data.get('end_date')
+        if not start_date or not end_date:
+            return jsonify({'success': False, 'error': 'start_date and end_date required'}), 400
+        
+        result = smart_backfill_range(start_date, end_date)
+        
+        return jsonify({
+            'success': True,
+            'worker_id': result['worker_id'],
+            'dates_processed': sum(1 for r in result['dates'] if r['success']),
+            'results': result['dates']
+        })
+    except Exception as e:
+        logger.error(f"Error in smart backfill: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/smart-shard-plan', methods=['POST'])
+def smart_shard_plan():
+    """Split the next unprocessed dates into (date, syndrome) shards"""
+    try:
+        max_dates = request.json.get('max_dates', SHARD_PLAN_DATES) if request.json else SHARD_PLAN_DATES
+        result = plan_shards(max_dates)
+        
+        return jsonify({
+            'success': True,
+            'worker_id': result['worker_id'],
+            'shards_created': len(result['shards']),
+            'shards': result['shards'],
+            'failed_dates': result['failed_dates'],
+            'completed_dates': result['completed_dates']
+        })
+    except Exception as e:
+        logger.error(f"Error in shard planning: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/smart-shard-process', methods=['POST'])
+def smart_shard_process():
+    """Process the earliest runnable shard
+    
+    Shards of different syndromes, or of dates more than
+    MAX_CLUSTER_AGE_DAYS apart, are independent: call this from as many
+    workers or instances as there are runnable shards.
+    """
+    with profiled() as profile:
+        try:
+            result = run_next_shard()
+            if result is None:
+                return jsonify({
+                    'success': True,
+                    'message': 'No runnable shards',
+                    'shard_processed': None
+                })
+            
+            profile_summary = profile.summary()
+            log_profile('smart_shard_process', profile_summary, date=result['date'], syndrome=result['syndrome'], worker_id=result['worker_id'], success=True)
+            return jsonify({
+                'success': True,
+                'message': 'Shard processing complete',
+                'shard_processed': {'date': result['date'], 'syndrome': result['syndrome']},
+                **result,
+                'profile': profile_summary,
+                'timestamp': datetime.now(timezone.utc).isoformat()
+            })
+        
+        except Exception as e:
+            logger.error(f"Error in shard processing: {str(e)}")
+            profile_summary = profile.summary()
+            log_profile('smart_shard_process', profile_summary, success=False, error=str(e))
+            return jsonify({
+                'success': False,
+                'error': str(e),
+                'profile': profile_summary
+            }), 500
+
+@app.route('/smart-shard-batch', methods=['POST'])
+def smart_shard_batch():
+    """Process runnable shards until none is left or max_shards are done"""
     try:
-        max_dates = request.json.get('max_dates', 5) if request.json else 5
+        max_shards = request.json.get('max_shards', 20) if request.json else 20
         
         results = []
-        for i in range(max_dates):
-            result = smart_process()
-            if not result.get_json().get('success') or not result.get_json().get('date_processed'):
+        for i in range(max_shards):
+            response = smart_shard_process()
+            response, status = response if isinstance(response, tuple) else (response, 200)
+            result = response.get_json()
+            if not result.get('success'):
+                # Stop on the failed shard, keeping the shards already done
+                return jsonify({
+                    'success': False,
+                    'error': result.get('error'),
+                    'shards_processed': len(results),
+                    'results': results
+                }), status
+            if not result.get('shard_processed'):
                 break
-            results.append(result.get_json())
+            results.append(result)
         
         return jsonify({
             'success': True,
-            'dates_processed': len(results),
+            'shards_processed': len(results),
             'results': results
         })
     except Exception as e:
@@ -1228,6 +3554,9 @@ def smart_config():
                 'max_cluster_radius': MAX_CLUSTER_RADIUS,
                 'min_cluster_size': MIN_CLUSTER_SIZE,
                 'dbscan_epsilon_m': DBSCAN_EPSILON_M,
+                'dbscan_workers': DBSCAN_WORKERS,
+                'dbscan_partition_by_state': DBSCAN_PARTITION_BY_STATE,
+                'gis_clustering_engine': GIS_CLUSTERING_ENGINE,
                 'geocoding_threshold': GEOCODING_THRESHOLD,
                 'auto_accept_radius': AUTO_ACCEPT_RADIUS_THRESHOLD
             },
@@ -1240,17 +3569,86 @@ def smart_config():
             'message': 'Configuration updates require service restart'
         }), 400
 
+@app.route('/smart-telemetry', methods=['GET'])
+def smart_telemetry():
+    """BigQuery cost and latency per service, endpoint and stage label
+    
+    Query parameters: hours (window, default 24), top (number of most
+    expensive jobs listed, default 10) and service (one service label).
+    """
+    if STORAGE_BACKEND != 'bigquery':
+        return jsonify({'success': False, 'error': 'Telemetry needs the bigquery storage backend'}), 400
+    
+    try:
+        hours = min(int(request.args.get('hours', 24)), 24 * 180)
+        top = min(int(request.args.get('top', 10)), 100)
+    except ValueError:
+        return jsonify({'success': False, 'error': 'hours and top must be integers'}), 400
+    service = request.args.get('service') or None
+    
+    try:
+        parameters = [('hours', 'INT64', hours), ('service', 'STRING', service)]
+        labels_df = execute_query(JOB_LABEL_TELEMETRY_QUERY.format(jobs_table=JOBS_TABLE), parameters)
+        top_df = execute_query(TOP_EXPENSIVE_QUERIES.format(jobs_table=JOBS_TABLE), parameters + [('top', 'INT64', top)])
+        
+        numeric_columns = ['jobs', 'bytes_processed', 'bytes_billed', 'slot_ms', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms']
+        by_stage = labels_df['stage'].notna()
+        
+        return jsonify({
+            'success': True,
+            'window_hours': hours,
+            'service': service,
+            'by_endpoint': frame_to_records(labels_df[~by_stage].drop(columns=['stage']), int_columns=numeric_columns),
+            'by_stage': frame_to_records(labels_df[by_stage], int_columns=numeric_columns),
+            'top_queries': frame_to_records(
+                top_df, timestamp_columns=['creation_time'], int_columns=['duration_ms', 'bytes_billed', 'slot_ms']
+            ),
+            'timestamp': datetime.now(timezone.utc).isoformat()
+        })
+        
+    except Exception as e:
+        logger.error(f"Error getting telemetry: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/smart-clusters', methods=['GET'])
 def smart_clusters():
-    """Get smart clusters with optional date filtering"""
+    """Get smart clusters, newest first, with optional filters
+    
+    Filters: days (created in the last N days, today included), algorithm,
+    status, syndrome, start_date/end_date (creation date) and min_patients.
+    fields limits the columns returned (smart_cluster_id and created_at
+    always are). One page of limit clusters (CLUSTERS_PAGE_SIZE by default)
+    is returned along with a next_cursor to pass back as cursor; pages are
+    keyed on (created_at, smart_cluster_id), so each costs the same however
+    much history there is.
+    
+    format=arrow or parquet (or the matching Accept type) returns the
+    columns as BigQuery's Arrow result, with next_cursor in the schema
+    metadata. Responses are served from cluster_cache until cluster state
+    changes, with an ETag so unchanged polls get 304 Not Modified.
+    """
     try:
+        response_format = negotiated_format()
+        if response_format is None:
+            return unsupported_format()
+        
+        cache_key = (response_format,) + tuple(sorted(request.args.items(multi=True)))
+        cached = cluster_cache.get(cache_key)
+        if cached:
+            return vary_on_accept(conditional_response(*cached, mimetype=RESPONSE_FORMATS[response_format]))
+        generation = cluster_cache.generation
+        
         days = request.args.get('days', type=int)
+        limit = request.args.get('limit', CLUSTERS_PAGE_SIZE, type=int)
+        if not 1 <= limit <= CLUSTERS_PAGE_MAX:
+            return jsonify({'success': False, 'error': f'limit must be between 1 and {CLUSTERS_PAGE_MAX}'}), 400
+        
+        fields = [f.strip() for f in request.args.get('fields', '').split(',') if f.strip()]
+        unknown = [f for f in fields if f not in CLUSTER_LIST_FIELDS]
+        if unknown:
+            return jsonify({'success': False, 'error': f"Unknown fields: {', '.join(unknown)}"}), 400
+        fields = [f for f in CLUSTER_LIST_FIELDS if f in fields or f in ('smart_cluster_id', 'created_at') or not fields]
         
-        # Always use the query with site_code calculation
-        if days:
-            date_filter = f"AND c.original_creation_date >= (SELECT DISTINCT original_creation_date FROM `{SMART_CLUSTERS_TABLE}` ORDER BY original_creation_date DESC LIMIT 1 OFFSET {days-1})"
-        else:
-            date_filter = ""
         # Check if override table exists
         override_table = f"{PROJECT_ID}.{DATASET_ID}.cluster_status_overrides"
         try:
@@ -1258,125 +3656,94 @@ def smart_clusters():
             use_override = True
         except:
             use_override = False
+        status_column = "COALESCE(o.new_status, c.accept_status)" if use_override else "c.accept_status"
+        override_join = f"LEFT JOIN `{override_table}` o ON c.smart_cluster_id = o.smart_cluster_id" if use_override else ""
         
-        if use_override:
-            query = f"""
-            WITH cluster_sites AS (
-                SELECT 
-                    a.smart_cluster_id,
-                    p.site_code,
-                    COUNT(*) as site_count,
-                    ROW_NUMBER() OVER (PARTITION BY a.smart_cluster_id ORDER BY COUNT(*) DESC) as rn
-                FROM `{SMART_ASSIGNMENTS_TABLE}` a
-                JOIN `{SOURCE_TABLE}` p ON a.unique_id = p.unique_id
-                WHERE p.site_code IS NOT NULL
-                GROUP BY a.smart_cluster_id, p.site_code
-            )
-            SELECT 
-                c.smart_cluster_id,
-                c.algorithm_type,
-                c.input_date,
-                c.original_creation_date,
-                c.actual_cluster_radius,
-                COALESCE(o.new_status, c.accept_status) as accept_status,
-                c.patient_count,
-                c.primary_syndrome,
-                c.centroid_lat,
-                c.centroid_lon,
-                c.village_name,
-                c.expansion_count,
-                c.created_at,
-                cs.site_code as most_common_site_code
-            FROM `{SMART_CLUSTERS_TABLE}` c
-            LEFT JOIN cluster_sites cs ON c.smart_cluster_id = cs.smart_cluster_id AND cs.rn = 1
-            LEFT JOIN `{override_table}` o ON c.smart_cluster_id = o.smart_cluster_id
-            WHERE 1=1 {date_filter}
-            ORDER BY c.created_at DESC
-            """
-        else:
-            query = f"""
-            WITH cluster_sites AS (
-                SELECT 
-                    a.smart_cluster_id,
-                    p.site_code,
-                    COUNT(*) as site_count,
-                    ROW_NUMBER() OVER (PARTITION BY a.smart_cluster_id ORDER BY COUNT(*) DESC) as rn
-                FROM `{SMART_ASSIGNMENTS_TABLE}` a
-                JOIN `{SOURCE_TABLE}` p ON a.unique_id = p.unique_id
-                WHERE p.site_code IS NOT NULL
-                GROUP BY a.smart_cluster_id, p.site_code
-            )
-            SELECT 
-                c.smart_cluster_id,
-                c.algorithm_type,
-                c.input_date,
-                c.original_creation_date,
-                c.actual_cluster_radius,
-                c.accept_status,
-                c.patient_count,
-                c.primary_syndrome,
-                c.centroid_lat,
-                c.centroid_lon,
-                c.village_name,
-                c.expansion_count,
-                c.created_at,
-                cs.site_code as most_common_site_code
-            FROM `{SMART_CLUSTERS_TABLE}` c
-            LEFT JOIN cluster_sites cs ON c.smart_cluster_id = cs.smart_cluster_id AND cs.rn = 1
-            WHERE 1=1 {date_filter}
-            ORDER BY c.created_at DESC
-            """
+        filters = []
+        parameters = []
+        if days:
+            filters.append("c.original_creation_date >= DATE_SUB(CURRENT_DATE(), INTERVAL @days - 1 DAY)")
+            parameters.append(('days', 'INT64', days))
+        if request.args.get('algorithm'):
+            filters.append("c.algorithm_type = @algorithm")
+            parameters.append(('algorithm', 'STRING', request.args['algorithm'].upper()))
+        if request.args.get('status'):
+            filters.append(f"LOWER({status_column}) = LOWER(@status)")
+            parameters.append(('status', 'STRING', request.args['status']))
+        if request.args.get('syndrome'):
+            filters.append("c.primary_syndrome = @syndrome")
+            parameters.append(('syndrome', 'STRING', request.args['syndrome']))
+        try:
+            start_date = to_date(request.args['start_date']) if request.args.get('start_date') else None
+            end_date = to_date(request.args['end_date']) if request.args.get('end_date') else None
+        except ValueError:
+            return jsonify({'success': False, 'error': 'start_date and end_date must be YYYY-MM-DD'}), 400
+        if start_date:
+            filters.append("c.original_creation_date >= @start_date")
+            parameters.append(('start_date', 'DATE', start_date))
+        if end_date:
+            filters.append("c.original_creation_date <= @end_date")
+            parameters.append(('end_date', 'DATE', end_date))
+        if request.args.get('min_patients', type=int):
+            filters.append("c.patient_count >= @min_patients")
+            parameters.append(('min_patients', 'INT64', request.args.get('min_patients', type=int)))
+        if request.args.get('cursor'):
+            try:
+                cursor_created_at, cursor_id = decode_cluster_cursor(request.args['cursor'])
+            except Exception:
+                return jsonify({'success': False, 'error': 'Invalid cursor'}), 400
+            filters.append("(c.created_at < @cursor_created_at OR (c.created_at = @cursor_created_at AND c.smart_cluster_id < @cursor_id))")
+            parameters.append(('cursor_created_at', 'TIMESTAMP', cursor_created_at))
+            parameters.append(('cursor_id', 'STRING', cursor_id))
         
-        df = client.query(query).to_dataframe()
+        columns = ',\n            '.join(
+            f"{status_column} as accept_status" if f == 'accept_status' else f"c.{f}" for f in fields
+        )
+        query = f"""
+        SELECT 
+            {columns}
+        FROM `{SMART_CLUSTERS_TABLE}` c
+        {override_join}
+        WHERE {' AND '.join(filters) or 'TRUE'}
+        ORDER BY c.created_at DESC, c.smart_cluster_id DESC
+        LIMIT {limit + 1}
+        """
         
-        df = client.query(query).to_dataframe()
+        if response_format != 'json':
+            table = execute_query(query, parameters, arrow=True)
+            next_cursor = None
+            if table.num_rows > limit:
+                table = table.slice(0, limit)
+                next_cursor = encode_cluster_cursor(table['created_at'][-1].as_py(), table['smart_cluster_id'][-1].as_py())
+            body = table_body(table, response_format, next_cursor=next_cursor)
+            return vary_on_accept(conditional_response(body, cluster_cache.put(cache_key, body, generation), RESPONSE_FORMATS[response_format]))
         
-        if len(df) == 0:
-            return jsonify({
-                'success': True,
-                'clusters': [],
-                'total_count': 0
-            })
+        df = execute_query(query, parameters)
         
-        clusters = []
-        for _, row in df.iterrows():
-            clusters.append({
-                'smart_cluster_id': row['smart_cluster_id'],
-                'algorithm_type': row['algorithm_type'],
-                'input_date': row['input_date'].isoformat() if pd.notna(row['input_date']) else None,
-                'original_creation_date': row['original_creation_date'].isoformat() if pd.notna(row['original_creation_date']) else None,
-                'actual_cluster_radius': float(row['actual_cluster_radius']) if pd.notna(row['actual_cluster_radius']) else None,
-                'accept_status': row['accept_status'],
-                'patient_count': int(row['patient_count']),
-                'primary_syndrome': row['primary_syndrome'],
-                'centroid_lat': float(row['centroid_lat']) if pd.notna(row['centroid_lat']) else None,
-                'centroid_lon': float(row['centroid_lon']) if pd.notna(row['centroid_lon']) else None,
-                'village_name': row['village_name'] if pd.notna(row['village_name']) else None,
-                'expansion_count': int(row['expansion_count']),
-                'created_at': row['created_at'].isoformat() if pd.notna(row['created_at']) else None,
-                'most_common_site_code': row['most_common_site_code'] if pd.notna(row['most_common_site_code']) else None
-            })
+        next_cursor = None
+        if len(df) > limit:
+            df = df.iloc[:limit]
+            next_cursor = encode_cluster_cursor(df.created_at.iloc[-1], df.smart_cluster_id.iloc[-1])
         
-        return jsonify({
+        clusters = frame_to_records(
+            df,
+            date_columns=[c for c in ('input_date', 'original_creation_date') if c in fields],
+            timestamp_columns=['created_at']
+        ) if len(df) else []
+        
+        body = jsonify({
             'success': True,
             'clusters': clusters,
-            'total_count': len(clusters)
-        })
+            'count': len(clusters),
+            'next_cursor': next_cursor
+        }).get_data()
+        return vary_on_accept(conditional_response(body, cluster_cache.put(cache_key, body, generation)))
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
-@app.route('/smart-cluster-patients', methods=['GET'])
-def smart_cluster_patients():
-    """Get patients in a specific cluster"""
-    try:
-        cluster_id = request.args.get('cluster_id')
-        if not cluster_id:
-            return jsonify({'success': False, 'error': 'cluster_id parameter required'}), 400
-        
-        query = f"""
-        SELECT 
-            p.unique_id,
+# Member columns returned by /smart-cluster-patients and its bulk form
+CLUSTER_PATIENT_COLUMNS = """p.unique_id,
             p.patient_entry_date,
             p.patient_name,
             p.pat_age,
@@ -1390,7 +3757,36 @@ def smart_cluster_patients():
             p.site_code,
             a.addition_type,
             a.expansion_date,
-            a.assigned_at
+            a.assigned_at"""
+
+def cluster_patient_records(df):
+    """JSON-ready member records from a cluster patients query result"""
+    return frame_to_records(
+        df,
+        date_columns=['patient_entry_date', 'expansion_date'],
+        timestamp_columns=['assigned_at'],
+        int_columns=['pat_age']
+    )
+
+@app.route('/smart-cluster-patients', methods=['GET'])
+def smart_cluster_patients():
+    """Get patients in a specific cluster
+    
+    format=arrow or parquet (or the matching Accept type) returns
+    BigQuery's Arrow result as is instead of JSON records.
+    """
+    try:
+        cluster_id = request.args.get('cluster_id')
+        if not cluster_id:
+            return jsonify({'success': False, 'error': 'cluster_id parameter required'}), 400
+        
+        response_format = negotiated_format()
+        if response_format is None:
+            return unsupported_format()
+        
+        query = f"""
+        SELECT 
+            {CLUSTER_PATIENT_COLUMNS}
         FROM `{SMART_ASSIGNMENTS_TABLE}` a
         JOIN `{SOURCE_TABLE}` p ON a.unique_id = p.unique_id
         WHERE a.smart_cluster_id = @cluster_id
@@ -1403,41 +3799,108 @@ def smart_cluster_patients():
             ]
         )
         
+        if response_format != 'json':
+            table = client.query(query, job_config=job_config).to_arrow()
+            return vary_on_accept(app.response_class(
+                table_body(table, response_format, cluster_id=cluster_id),
+                mimetype=RESPONSE_FORMATS[response_format]
+            ))
+        
         df = client.query(query, job_config=job_config).to_dataframe()
         
         if len(df) == 0:
-            return jsonify({
+            return vary_on_accept(jsonify({
                 'success': True,
                 'patients': [],
                 'patient_count': 0
-            })
+            }))
         
-        patients = []
-        for _, row in df.iterrows():
-            patients.append({
-                'unique_id': row['unique_id'],
-                'patient_entry_date': row['patient_entry_date'].isoformat() if pd.notna(row['patient_entry_date']) else None,
-                'patient_name': row['patient_name'] if pd.notna(row['patient_name']) else None,
-                'pat_age': int(row['pat_age']) if pd.notna(row['pat_age']) else None,
-                'pat_sex': row['pat_sex'] if pd.notna(row['pat_sex']) else None,
-                'villagename': row['villagename'] if pd.notna(row['villagename']) else None,
-                'statename': row['statename'] if pd.notna(row['statename']) else None,
-                'districtname': row['districtname'] if pd.notna(row['districtname']) else None,
-                'clini_primary_syn': row['clini_primary_syn'] if pd.notna(row['clini_primary_syn']) else None,
-                'latitude': float(row['latitude']) if pd.notna(row['latitude']) else None,
-                'longitude': float(row['longitude']) if pd.notna(row['longitude']) else None,
-                'site_code': row['site_code'] if pd.notna(row['site_code']) else None,
-                'addition_type': row['addition_type'],
-                'expansion_date': row['expansion_date'].isoformat() if pd.notna(row['expansion_date']) else None,
-                'assigned_at': row['assigned_at'].isoformat() if pd.notna(row['assigned_at']) else None
-            })
+        patients = cluster_patient_records(df)
         
-        return jsonify({
+        return vary_on_accept(jsonify({
             'success': True,
             'patients': patients,
             'patient_count': len(patients),
             'cluster_id': cluster_id
-        })
+        }))
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/smart-cluster-patients/bulk', methods=['GET', 'POST'])
+def smart_cluster_patients_bulk():
+    """Members of many clusters from one query, streamed grouped by cluster
+    
+    Clusters are chosen by cluster_ids (a JSON list in a POST body, or
+    comma separated in the query string) and/or start_date/end_date
+    (creation date) and algorithm. The response is NDJSON with one line
+    per cluster holding its patients, or, with format=arrow or parquet (or
+    the matching Accept type), an Arrow IPC stream or Parquet file of one
+    row per member sorted by cluster.
+    """
+    try:
+        response_format = negotiated_format()
+        if response_format is None:
+            return unsupported_format()
+        
+        data = request.get_json(silent=True) or {}
+        args = {**request.args.to_dict(), **data}
+        cluster_ids = data.get('cluster_ids') or [c for c in request.args.get('cluster_ids', '').split(',') if c]
+        
+        # Check if override table exists
+        override_table = f"{PROJECT_ID}.{DATASET_ID}.cluster_status_overrides"
+        try:
+            client.get_table(override_table)
+            use_override = True
+        except:
+            use_override = False
+        status_column = "COALESCE(o.new_status, c.accept_status)" if use_override else "c.accept_status"
+        override_join = f"LEFT JOIN `{override_table}` o ON c.smart_cluster_id = o.smart_cluster_id" if use_override else ""
+        
+        filters = []
+        query_parameters = []
+        if cluster_ids:
+            filters.append("a.smart_cluster_id IN UNNEST(@cluster_ids)")
+            query_parameters.append(bigquery.ArrayQueryParameter('cluster_ids', 'STRING', list(cluster_ids)))
+        try:
+            start_date = to_date(args['start_date']) if args.get('start_date') else None
+            end_date = to_date(args['end_date']) if args.get('end_date') else None
+        except ValueError:
+            return jsonify({'success': False, 'error': 'start_date and end_date must be YYYY-MM-DD'}), 400
+        if start_date:
+            filters.append("c.original_creation_date >= @start_date")
+            query_parameters.append(bigquery.ScalarQueryParameter('start_date', 'DATE', start_date))
+        if end_date:
+            filters.append("c.original_creation_date <= @end_date")
+            query_parameters.append(bigquery.ScalarQueryParameter('end_date', 'DATE', end_date))
+        if not filters:
+            return jsonify({'success': False, 'error': 'cluster_ids or start_date/end_date required'}), 400
+        if args.get('algorithm'):
+            filters.append("c.algorithm_type = @algorithm")
+            query_parameters.append(bigquery.ScalarQueryParameter('algorithm', 'STRING', args['algorithm'].upper()))
+        
+        query = f"""
+        SELECT 
+            a.smart_cluster_id,
+            c.algorithm_type,
+            {status_column} as cluster_status,
+            {CLUSTER_PATIENT_COLUMNS}
+        FROM `{SMART_ASSIGNMENTS_TABLE}` a
+        JOIN `{SMART_CLUSTERS_TABLE}` c ON a.smart_cluster_id = c.smart_cluster_id
+        {override_join}
+        JOIN `{SOURCE_TABLE}` p ON a.unique_id = p.unique_id
+        WHERE {' AND '.join(filters)}
+        ORDER BY a.smart_cluster_id, a.assigned_at
+        """
+        
+        job_config = bigquery.QueryJobConfig(query_parameters=query_parameters)
+        
+        # Wait for the job here, so query errors are still a JSON 500
+        rows = client.query(query, job_config=job_config).result(page_size=BULK_PATIENTS_PAGE_ROWS)
+        
+        if response_format != 'json':
+            return vary_on_accept(app.response_class(table_stream(rows, response_format), mimetype=RESPONSE_FORMATS[response_format]))
+        return vary_on_accept(app.response_class(ndjson_clusters(rows), mimetype='application/x-ndjson'))
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -1494,7 +3957,7 @@ def accept_cluster():
                 'error': f'Cluster {cluster_id} is already {current_status}'
             }), 400
         
-        # Insert into status override table (avoids streaming buffer issues)
+        # Record the status in the override table rather than updating the cluster
         status_override_table = f"{PROJECT_ID}.{DATASET_ID}.cluster_status_overrides"
         
         # Create override table if not exists
@@ -1509,16 +3972,14 @@ def accept_cluster():
             table = bigquery.Table(status_override_table, schema=schema)
             client.create_table(table)
         
-        # Insert status override
-        override_record = {
-            'smart_cluster_id': cluster_id,
-            'new_status': 'Accepted',
-            'updated_at': datetime.now(timezone.utc).isoformat()
-        }
-        
-        errors = client.insert_rows_json(client.get_table(status_override_table), [override_record])
-        if errors:
-            raise Exception(f"Failed to insert status override: {errors}")
+        # Insert status override with DML (no streaming buffer, so the row
+        # can be updated or deleted straight away)
+        insert_query = f"""
+        INSERT INTO `{status_override_table}` (smart_cluster_id, new_status, updated_at)
+        VALUES (@cluster_id, 'Accepted', CURRENT_TIMESTAMP())
+        """
+        client.query(insert_query, job_config=job_config).result()
+        cluster_cache.invalidate()
         
         # Status override inserted successfully
         return jsonify({
@@ -1562,8 +4023,10 @@ def reject_cluster():
             ]
         )
         
-        client.query(delete_assignments_query, job_config=job_config)
-        client.query(delete_cluster_query, job_config=job_config)
+        # Wait for both deletes, so the cache is not refilled from a read that misses them
+        client.query(delete_assignments_query, job_config=job_config).result()
+        client.query(delete_cluster_query, job_config=job_config).result()
+        cluster_cache.invalidate()
         
         return jsonify({
             'success': True,
@@ -1595,7 +4058,9 @@ def smart_truncate():
             SMART_CLUSTERS_TABLE,
             SMART_ASSIGNMENTS_TABLE,
             SMART_MERGE_HISTORY_TABLE,
-            f"{PROJECT_ID}.{DATASET_ID}.smart_processing_status",
+            SMART_PROCESSING_STATUS_TABLE,
+            SMART_DATE_LEDGER_TABLE,
+            SMART_SHARD_LEDGER_TABLE,
             f"{PROJECT_ID}.{DATASET_ID}.cluster_status_overrides",
             SOURCE_TABLE
         ]
@@ -1608,6 +4073,7 @@ def smart_truncate():
                 logger.info(f"Truncated table: {table_name}")
             except Exception as e:
                 logger.warning(f"Could not truncate {table_name}: {str(e)}")
+        cluster_cache.invalidate()
         
         return jsonify({
             'success': True,
@@ -0,0 +1,544 @@
+#!/usr/bin/env python3
+"""
+Synthetic-data benchmark for the smart clustering engine
+
+Generates patient records with every column of the patient_records schema
+(Reference/excel.json) plus unique_id, built the way the data import page
+builds it. Rural patients are spread over a village hierarchy with
+Zipf-distributed village sizes. Urban patients are scattered around city
+neighbourhoods, with some snapped to the neighbourhood centre (geocoder
+fallbacks) and a few left ungeocoded. On top of that background, outbreaks
+are planted as bursts of one syndrome in one village or within a couple of
+hundred metres of one point.
+
+Each size is written to Parquet and processed by the real engine code on
+the local storage backend (STORAGE_BACKEND=local), in its own process.
+Engine stages are timed by wrapping the engine's functions and storage
+methods; times are inclusive, so a stage includes the stages it calls.
+
+    python benchmark.py --rows 10000 100000 1000000 10000000 --output results.json
+    python benchmark.py --rows 100000 --mode backfill --gis-engine grid
+    python benchmark.py --rows 1000000 --generate-only ./local_data
+
+Results are printed one JSON object per size and, with --output, written
+as one JSON document. Needs duckdb (pip install -r requirements-dev.txt).
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta, timezone
+from functools import wraps
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+ENGINE_DIR = os.path.dirname(os.path.abspath(__file__))
+SCHEMA_PATH = os.path.join(ENGINE_DIR, '..', '..', 'Reference', 'excel.json')
+
+DEFAULT_ROWS = [10_000, 100_000, 1_000_000, 10_000_000]
+DEFAULT_DAYS = 30
+DEFAULT_START_DATE = '2025-01-01'
+
+# Share of patients recorded as urban, of urban patients geocoded to their
+# neighbourhood centre instead of their address, and of urban patients the
+# geocoder could not place at all (kept under 1 - GEOCODING_THRESHOLD so
+# every date passes the quality check)
+URBAN_SHARE = 0.5
+CENTRE_SNAP_SHARE = 0.08
+UNGEOCODED_SHARE = 0.04
+
+# Spread of neighbourhoods around their city centre and of addresses around
+# their neighbourhood centre, in metres
+NEIGHBOURHOOD_SPREAD_M = 8000
+ADDRESS_SPREAD_M = 400
+
+# Zipf exponent for village and neighbourhood popularity
+ZIPF_EXPONENT = 1.1
+
+# Villages per subdistrict and subdistricts per district
+VILLAGES_PER_SUBDISTRICT = 20
+SUBDISTRICTS_PER_DISTRICT = 8
+
+# Syndrome names as recorded in clini_primary_syn, with their share of patients
+SYNDROMES = {
+    'Acute Undifferentiated Febrile Illness (AUFI) for > 7 days': 0.30,
+    'Acute Diarrheal Disease': 0.25,
+    'Jaundice of < 4 weeks with fever and/or other abdominal symptoms': 0.10,
+    'Fever with Rash for 7 days': 0.08,
+    'Acute Encephalitic Syndrome (AES)': 0.07,
+    'Hemorrhagic fever': 0.05,
+    'Acute Flaccid Paralysis': 0.03,
+    'Others': 0.12,
+}
+
+# (state, city, latitude, longitude, share of urban patients)
+CITIES = [
+    ('Tamil Nadu', 'Chennai', 13.0827, 80.2707, 0.25),
+    ('Karnataka', 'Bengaluru', 12.9716, 77.5946, 0.20),
+    ('Maharashtra', 'Mumbai', 19.0760, 72.8777, 0.20),
+    ('Delhi', 'New Delhi', 28.6139, 77.2090, 0.15),
+    ('West Bengal', 'Kolkata', 22.5726, 88.3639, 0.10),
+    ('Telangana', 'Hyderabad', 17.3850, 78.4867, 0.10),
+]
+
+# Arrow types of the schema's data types; columns the generator does not
+# model get a cheap value of their type (null for strings and floats)
+ARROW_TYPES = {
+    'INT64': pa.int64(),
+    'FLOAT64': pa.float64(),
+    'STRING': pa.string(),
+    'BOOL': pa.bool_(),
+    'DATE': pa.date32(),
+}
+
+METRES_PER_DEGREE = 111320
+
+# Engine functions, class methods and storage methods timed as stages
+TIMED_FUNCTIONS = [
+    'check_data_quality', 'select_abc_patients', 'select_gis_patients',
+    'smart_abc_clustering', 'expand_abc_cluster', 'create_new_abc_cluster',
+    'smart_gis_clustering', 'run_dbscan_by_syndrome', 'summarize_dbscan_clusters',
+    'query_gis_cluster_index', 'expand_gis_cluster', 'create_new_gis_cluster',
+    'build_assignments',
+]
+TIMED_METHODS = [
+    ('PatientWindow', 'load'), ('PatientWindow', 'prefetch'),
+    ('ClusterState', '__init__'), ('ClusterState', 'load_members'), ('ClusterState', 'load_gis_members'),
+    ('WriteBuffer', 'flush'),
+]
+TIMED_STORAGE_METHODS = [
+    'fetch_patient_days', 'fetch_date_quality',
+    'load_active_abc_clusters', 'load_active_gis_clusters',
+    'load_cluster_members', 'load_gis_cluster_members',
+    'write_date',
+    'claim_next_date', 'claim_date_range', 'mark_date_completed', 'mark_dates_completed',
+]
+
+
+def load_schema(path=SCHEMA_PATH):
+    """(column_name, data_type) pairs of patient_records in ordinal order"""
+    with open(path) as f:
+        columns = json.load(f)
+    columns.sort(key=lambda column: int(column['ordinal_position']))
+    return [(column['column_name'], column['data_type']) for column in columns]
+
+
+def _zipf_weights(count, rng):
+    """Zipf popularity weights over count items, in random order"""
+    weights = 1.0 / np.arange(1, count + 1) ** ZIPF_EXPONENT
+    rng.shuffle(weights)
+    return weights / weights.sum()
+
+
+def _metres_to_degrees(north_m, east_m, latitude):
+    return north_m / METRES_PER_DEGREE, east_m / (METRES_PER_DEGREE * np.cos(np.radians(latitude)))
+
+
+class Geography:
+    """Villages, city neighbourhoods and sites, scaled to the dataset size
+
+    Larger datasets cover more villages and neighbourhoods rather than
+    packing more patients into the same ones.
+    """
+
+    def __init__(self, rows, rng):
+        state_names = [city[0] for city in CITIES]
+
+        village_count = int(np.clip(rows // 200, 200, 50_000))
+        villages = np.arange(village_count)
+        subdistricts = villages // VILLAGES_PER_SUBDISTRICT
+        districts = subdistricts // SUBDISTRICTS_PER_DISTRICT
+        self.village_state = np.array(state_names, dtype=object)[districts % len(state_names)]
+        self.village_district = np.array([f"District {d}" for d in districts], dtype=object)
+        self.village_subdistrict = np.array([f"Subdistrict {s}" for s in subdistricts], dtype=object)
+        self.village_name = np.array([f"Village {v}" for v in villages], dtype=object)
+        self.village_weights = _zipf_weights(village_count, rng)
+
+        city_weights = np.array([city[4] for city in CITIES])
+        per_city = int(np.clip(rows // 2000, 20, 2000))
+        self.neighbourhood_city = np.repeat(np.arange(len(CITIES)), per_city)
+        city_lat = np.array([city[2] for city in CITIES])[self.neighbourhood_city]
+        city_lon = np.array([city[3] for city in CITIES])[self.neighbourhood_city]
+        dlat, dlon = _metres_to_degrees(
+            rng.normal(0, NEIGHBOURHOOD_SPREAD_M, len(city_lat)),
+            rng.normal(0, NEIGHBOURHOOD_SPREAD_M, len(city_lat)),
+            city_lat
+        )
+        self.neighbourhood_lat = city_lat + dlat
+        self.neighbourhood_lon = city_lon + dlon
+        self.neighbourhood_weights = np.concatenate([
+            _zipf_weights(per_city, rng) * weight for weight in city_weights
+        ])
+        self.neighbourhood_weights /= self.neighbourhood_weights.sum()
+
+        self.site_codes = np.array([f"SITE{i:03d}" for i in range(max(10, rows // 100_000 * 5))], dtype=object)
+        self.syndromes = np.array(list(SYNDROMES), dtype=object)
+        self.syndrome_weights = np.array(list(SYNDROMES.values()))
+
+
+def plant_outbreaks(count, days, geography, rng):
+    """Outbreak specs: a start day, duration, size, syndrome and place"""
+    outbreaks = []
+    for outbreak_id in range(count):
+        duration = int(rng.integers(2, 6))
+        outbreak = {
+            'outbreak_id': outbreak_id,
+            'area_type': 'Rural' if rng.random() < 1 - URBAN_SHARE else 'Urban',
+            'first_day': int(rng.integers(0, max(1, days - duration))),
+            'duration': duration,
+            'cases': int(rng.integers(5, 31)),
+            'syndrome': str(rng.choice(geography.syndromes)),
+        }
+        if outbreak['area_type'] == 'Rural':
+            outbreak['village'] = int(rng.integers(0, len(geography.village_name)))
+        else:
+            neighbourhood = int(rng.choice(len(geography.neighbourhood_lat), p=geography.neighbourhood_weights))
+            outbreak['neighbourhood'] = neighbourhood
+            outbreak['latitude'] = float(geography.neighbourhood_lat[neighbourhood])
+            outbreak['longitude'] = float(geography.neighbourhood_lon[neighbourhood])
+            outbreak['spread_m'] = float(rng.uniform(50, 150))
+        outbreaks.append(outbreak)
+    return outbreaks
+
+
+def _day_table(schema, day, count, first_patient_id, geography, outbreaks, day_index, rng):
+    """One day of patient records as an Arrow table, plus its outbreak cases"""
+    urban = rng.random(count) < URBAN_SHARE
+    village = rng.choice(len(geography.village_name), size=count, p=geography.village_weights)
+    syndrome = rng.choice(len(geography.syndromes), size=count, p=geography.syndrome_weights)
+    syndrome_name = geography.syndromes[syndrome]
+
+    neighbourhood = rng.choice(len(geography.neighbourhood_lat), size=count, p=geography.neighbourhood_weights)
+    centre_lat = geography.neighbourhood_lat[neighbourhood]
+    centre_lon = geography.neighbourhood_lon[neighbourhood]
+    dlat, dlon = _metres_to_degrees(
+        rng.normal(0, ADDRESS_SPREAD_M, count), rng.normal(0, ADDRESS_SPREAD_M, count), centre_lat
+    )
+    latitude = centre_lat + dlat
+    longitude = centre_lon + dlon
+    placement = rng.random(count)
+    snapped = placement < CENTRE_SNAP_SHARE
+    latitude[snapped] = centre_lat[snapped]
+    longitude[snapped] = centre_lon[snapped]
+    ungeocoded = placement > 1 - UNGEOCODED_SHARE
+    latitude[ungeocoded] = 0.0
+    longitude[ungeocoded] = 0.0
+
+    state = geography.village_state[village]
+    district = geography.village_district[village]
+    subdistrict = geography.village_subdistrict[village]
+    village_name = geography.village_name[village]
+
+    # Replace the first rows of the day with today's outbreak cases
+    case_ids = []
+    position = 0
+    for outbreak in outbreaks:
+        offset = day_index - outbreak['first_day']
+        if not 0 <= offset < outbreak['duration']:
+            continue
+        cases = outbreak['cases'] // outbreak['duration'] + (offset < outbreak['cases'] % outbreak['duration'])
+        cases = min(cases, count - position)
+        rows = slice(position, position + cases)
+        syndrome_name[rows] = outbreak['syndrome']
+        if outbreak['area_type'] == 'Rural':
+            urban[rows] = False
+            state[rows] = geography.village_state[outbreak['village']]
+            district[rows] = geography.village_district[outbreak['village']]
+            subdistrict[rows] = geography.village_subdistrict[outbreak['village']]
+            village_name[rows] = geography.village_name[outbreak['village']]
+        else:
+            urban[rows] = True
+            neighbourhood[rows] = outbreak['neighbourhood']
+            dlat, dlon = _metres_to_degrees(
+                rng.normal(0, outbreak['spread_m'], cases), rng.normal(0, outbreak['spread_m'], cases), outbreak['latitude']
+            )
+            latitude[rows] = outbreak['latitude'] + dlat
+            longitude[rows] = outbreak['longitude'] + dlon
+        case_ids.extend((outbreak['outbreak_id'], first_patient_id + i) for i in range(position, position + cases))
+        position += cases
+
+    # Urban patients keep their city's state; rural patients have no coordinates
+    city_state = np.array([city[0] for city in CITIES], dtype=object)[geography.neighbourhood_city[neighbourhood]]
+    state = np.where(urban, city_state, state)
+    latitude = np.where(urban, np.round(latitude, 6), np.nan)
+    longitude = np.where(urban, np.round(longitude, 6), np.nan)
+
+    patient_id = np.arange(first_patient_id, first_patient_id + count)
+    site_code = geography.site_codes[rng.integers(0, len(geography.site_codes), count)]
+    modelled = {
+        'patient_id': pa.array(patient_id),
+        'site_code': pa.array(site_code, pa.string()),
+        'patient_entry_date': pa.array(np.full(count, day), pa.date32()),
+        'pat_age': pa.array(rng.integers(0, 90, count)),
+        'pat_sex': pa.array(rng.integers(1, 3, count)),
+        'statename': pa.array(state, pa.string()),
+        'districtname': pa.array(district, pa.string()),
+        'subdistrictname': pa.array(subdistrict, pa.string()),
+        'villagename': pa.array(village_name, pa.string()),
+        'latitude': pa.array(latitude, pa.float64(), from_pandas=True),
+        'longitude': pa.array(longitude, pa.float64(), from_pandas=True),
+        'pat_street': pa.array(np.where(urban, 'Main Street', None), pa.string()),
+        'pat_areatype': pa.array(np.where(urban, 'Urban', 'Rural'), pa.string()),
+        'clini_primary_syn': pa.array(syndrome_name, pa.string()),
+    }
+
+    columns = {}
+    for name, data_type in schema:
+        if name in modelled:
+            columns[name] = modelled[name]
+        elif data_type == 'INT64':
+            columns[name] = pa.array(rng.integers(0, 3, count))
+        elif data_type == 'BOOL':
+            columns[name] = pa.array(rng.random(count) < 0.2)
+        else:
+            columns[name] = pa.nulls(count, ARROW_TYPES[data_type])
+
+    # unique_id as the data import page builds it: patient_id_site_code_date
+    columns['unique_id'] = pc.binary_join_element_wise(
+        pc.cast(columns['patient_id'], pa.string()), columns['site_code'], day.isoformat(), '_'
+    )
+    return pa.table(columns), case_ids
+
+
+def generate_patients(path, rows, days=DEFAULT_DAYS, start_date=DEFAULT_START_DATE, outbreaks=None, seed=0, schema_path=SCHEMA_PATH):
+    """Write rows synthetic patient records over days dates to a Parquet file
+
+    Returns the planted outbreaks, each with the unique_ids of its cases.
+    """
+    rng = np.random.default_rng(seed)
+    schema = load_schema(schema_path)
+    geography = Geography(rows, rng)
+    if outbreaks is None:
+        outbreaks = int(np.clip(rows // 10_000, 5, 1000))
+    planted = plant_outbreaks(outbreaks, days, geography, rng)
+    for outbreak in planted:
+        outbreak['unique_ids'] = []
+
+    first_day = date.fromisoformat(start_date)
+    day_counts = rng.multinomial(rows, np.full(days, 1 / days))
+    first_patient_id = 1
+    writer = None
+    try:
+        for day_index, count in enumerate(day_counts):
+            day = first_day + timedelta(days=day_index)
+            table, case_ids = _day_table(schema, day, int(count), first_patient_id, geography, planted, day_index, rng)
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema)
+            writer.write_table(table)
+
+            unique_ids = table.column('unique_id')
+            for outbreak_id, patient_id in case_ids:
+                planted[outbreak_id]['unique_ids'].append(unique_ids[patient_id - first_patient_id].as_py())
+            first_patient_id += int(count)
+    finally:
+        if writer is not None:
+            writer.close()
+    return planted
+
+
+def _timed(stages, name, func):
+    """func, adding its calls and wall time to stages[name]"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stage = stages.setdefault(name, {'calls': 0, 'seconds': 0.0})
+            stage['calls'] += 1
+            stage['seconds'] += time.perf_counter() - start
+    return wrapper
+
+
+def instrument(engine):
+    """Wrap the engine's stages with timers; returns the dict they fill"""
+    stages = {}
+    for name in TIMED_FUNCTIONS:
+        setattr(engine, name, _timed(stages, name, getattr(engine, name)))
+    for class_name, name in TIMED_METHODS:
+        cls = getattr(engine, class_name)
+        setattr(cls, name, _timed(stages, f"{class_name}.{name}", getattr(cls, name)))
+    for name in TIMED_STORAGE_METHODS:
+        setattr(engine.storage, name, _timed(stages, f"storage.{name}", getattr(engine.storage, name)))
+    return stages
+
+
+def outbreak_recovery(engine, planted):
+    """Planted outbreaks with at least half their cases in a single cluster"""
+    cases = [(o['outbreak_id'], unique_id) for o in planted for unique_id in o['unique_ids']]
+    if not cases:
+        return 0
+    import pandas as pd
+    outbreak_cases = pd.DataFrame(cases, columns=['outbreak_id', 'unique_id'])
+    best = engine.storage.query("""
+    SELECT outbreak_id, MAX(assigned) as assigned
+    FROM (
+        SELECT o.outbreak_id, a.smart_cluster_id, COUNT(*) as assigned
+        FROM outbreak_cases o
+        JOIN smart_cluster_assignments a ON a.unique_id = o.unique_id
+        GROUP BY o.outbreak_id, a.smart_cluster_id
+    )
+    GROUP BY outbreak_id
+    """, outbreak_cases=outbreak_cases)
+    assigned = dict(zip(best['outbreak_id'], best['assigned']))
+    return sum(1 for o in planted if o['unique_ids'] and assigned.get(o['outbreak_id'], 0) * 2 >= len(o['unique_ids']))
+
+
+def run_size(rows, args):
+    """Generate, process and time one dataset size in this process"""
+    data_dir = os.path.join(args.data_dir, f"rows_{rows}")
+    shutil.rmtree(data_dir, ignore_errors=True)
+    os.makedirs(data_dir)
+    source_path = os.path.join(data_dir, 'patient_records.parquet')
+
+    start = time.perf_counter()
+    planted = generate_patients(source_path, rows, args.days, args.start_date, args.outbreaks, args.seed, args.schema)
+    generate_seconds = time.perf_counter() - start
+
+    os.environ['STORAGE_BACKEND'] = 'local'
+    os.environ['LOCAL_DATA_DIR'] = data_dir
+    os.environ['LOCAL_SOURCE_PATH'] = source_path
+    os.environ['GIS_CLUSTERING_ENGINE'] = args.gis_engine
+    sys.path.insert(0, ENGINE_DIR)
+    import app as engine
+    logging.getLogger().setLevel(args.log_level)
+
+    stages = instrument(engine)
+    start = time.perf_counter()
+    with engine.app.app_context():
+        if args.mode == 'backfill':
+            last_day = date.fromisoformat(args.start_date) + timedelta(days=args.days - 1)
+            dates = engine.smart_backfill_range(args.start_date, last_day.isoformat())['dates']
+            processed = sum(1 for result in dates if result['success'])
+        else:
+            patient_window = engine.PatientWindow()
+            processed = 0
+            while True:
+                response = engine.smart_process(patient_window)
+                if isinstance(response, tuple):
+                    raise RuntimeError(response[0].get_json()['error'])
+                result = response.get_json()
+                if not result['date_processed']:
+                    break
+                processed += result['success']
+    total_seconds = time.perf_counter() - start
+
+    counts = engine.storage.query("""
+    SELECT
+        (SELECT COUNT(*) FROM smart_clusters WHERE algorithm_type = 'ABC') as abc_clusters,
+        (SELECT COUNT(*) FROM smart_clusters WHERE algorithm_type = 'GIS') as gis_clusters,
+        (SELECT COUNT(*) FROM smart_cluster_assignments) as assignments
+    """).iloc[0]
+
+    return {
+        'rows': rows,
+        'days': args.days,
+        'seed': args.seed,
+        'mode': args.mode,
+        'gis_engine': args.gis_engine,
+        'generate_seconds': round(generate_seconds, 3),
+        'parquet_bytes': os.path.getsize(source_path),
+        'process_seconds': round(total_seconds, 3),
+        'dates_processed': int(processed),
+        'abc_clusters': int(counts['abc_clusters']),
+        'gis_clusters': int(counts['gis_clusters']),
+        'assignments': int(counts['assignments']),
+        'outbreaks_planted': len(planted),
+        'outbreaks_recovered': outbreak_recovery(engine, planted),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'stages': {
+            name: {'calls': stage['calls'], 'seconds': round(stage['seconds'], 4)}
+            for name, stage in sorted(stages.items())
+        },
+    }
+
+
+def _size_command(rows, args):
+    """Command line running one size in a fresh process"""
+    command = [
+        sys.executable, os.path.abspath(__file__), '--single', str(rows),
+        '--days', str(args.days), '--start-date', args.start_date, '--seed', str(args.seed),
+        '--mode', args.mode, '--gis-engine', args.gis_engine,
+        '--data-dir', args.data_dir, '--schema', args.schema, '--log-level', args.log_level,
+    ]
+    if args.outbreaks is not None:
+        command += ['--outbreaks', str(args.outbreaks)]
+    return command
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the smart clustering engine on synthetic patients")
+    parser.add_argument('--rows', type=int, nargs='+', default=DEFAULT_ROWS)
+    parser.add_argument('--days', type=int, default=DEFAULT_DAYS)
+    parser.add_argument('--start-date', default=DEFAULT_START_DATE)
+    parser.add_argument('--outbreaks', type=int, default=None, help="Default: rows / 10000, between 5 and 1000")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mode', choices=['process', 'backfill'], default='process',
+                        help="process: /smart-process date by date with one patient window; backfill: one in-memory replay")
+    parser.add_argument('--gis-engine', choices=['sklearn', 'grid'], default=os.environ.get('GIS_CLUSTERING_ENGINE', 'sklearn'))
+    parser.add_argument('--data-dir', default=None, help="Where datasets are written (default: a temporary directory)")
+    parser.add_argument('--keep-data', action='store_true')
+    parser.add_argument('--schema', default=SCHEMA_PATH)
+    parser.add_argument('--output', default=None, help="Write all results to this JSON file")
+    parser.add_argument('--generate-only', metavar='DIR', default=None,
+                        help="Write patient_records.parquet for the first --rows size to DIR and exit")
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--single', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level)
+
+    if args.generate_only:
+        os.makedirs(args.generate_only, exist_ok=True)
+        path = os.path.join(args.generate_only, 'patient_records.parquet')
+        planted = generate_patients(path, args.rows[0], args.days, args.start_date, args.outbreaks, args.seed, args.schema)
+        print(json.dumps({'path': path, 'rows': args.rows[0], 'outbreaks': [
+            {k: v for k, v in outbreak.items() if k != 'unique_ids'} for outbreak in planted
+        ]}))
+        return
+
+    if args.single is not None:
+        print(json.dumps(run_size(args.single, args)))
+        return
+
+    started_at = datetime.now(timezone.utc).isoformat()
+    temporary = args.data_dir is None
+    if temporary:
+        args.data_dir = tempfile.mkdtemp(prefix='smart-benchmark-')
+    results = []
+    try:
+        for rows in args.rows:
+            completed = subprocess.run(_size_command(rows, args), stdout=subprocess.PIPE, text=True)
+            if completed.returncode != 0:
+                result = {'rows': rows, 'error': f"exit status {completed.returncode}"}
+            else:
+                result = json.loads(completed.stdout.strip().splitlines()[-1])
+            print(json.dumps(result), flush=True)
+            results.append(result)
+    finally:
+        if temporary and not args.keep_data:
+            shutil.rmtree(args.data_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'started_at': started_at,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'results': results,
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,9 +5,19 @@
 PROJECT_ID="sentinel-h-5"
 SERVICE_NAME="smart-cluster-engine"
 REGION="asia-south1"
+JOBS_QUEUE="smart-jobs"
+SERVICE_URL="https://$SERVICE_NAME-196547645490.$REGION.run.app"
 
 echo "Deploying Smart Clustering Engine..."
 
+# Cloud Tasks queue that runs async /smart-batch and /smart-process jobs
+gcloud tasks queues describe $JOBS_QUEUE --location $REGION --project $PROJECT_ID > /dev/null 2>&1 || \
+  gcloud tasks queues create $JOBS_QUEUE \
+    --location $REGION \
+    --project $PROJECT_ID \
+    --max-attempts 10 \
+    --min-backoff 60s
+
 gcloud run deploy $SERVICE_NAME \
   --source . \
   --platform managed \
@@ -19,7 +29,7 @@ gcloud run deploy $SERVICE_NAME \
   --timeout 900 \
   --concurrency 1 \
   --max-instances 10 \
-  --set-env-vars="GCP_PROJECT_ID=$PROJECT_ID,DATASET_ID=sentinel_h_5"
+  --set-env-vars="GCP_PROJECT_ID=$PROJECT_ID,DATASET_ID=sentinel_h_5,SMART_JOBS_QUEUE=projects/$PROJECT_ID/locations/$REGION/queues/$JOBS_QUEUE,SMART_JOBS_URL=$SERVICE_URL"
 
 echo "Deployment complete!"
-echo "Service URL: https://$SERVICE_NAME-196547645490.$REGION.run.app"
\ No newline at end of file
+echo "Service URL: $SERVICE_URL"
\ No newline at end of file
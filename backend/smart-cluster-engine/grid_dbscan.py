@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Grid-hash DBSCAN for haversine distances at the few-hundred-metre scale
+
+Points are bucketed on a local equirectangular grid of half-epsilon cells,
+so every haversine neighbour of a point lies within two cells of its own.
+Cells small enough that all their points are neighbours skip pairwise checks
+entirely; other candidate pairs are checked with the exact haversine
+distance. Core points are joined with a vectorized union-find and labels are
+numbered the way sklearn's DBSCAN numbers them.
+The result matches DBSCAN(metric='haversine') label for label, up to
+floating-point ties at exactly epsilon.
+
+Run this file directly to benchmark it against sklearn on synthetic
+urban points.
+"""
+
+import numpy as np
+
+# Grid cells per epsilon along each axis; with half-epsilon cells every
+# neighbour of a point lies within two cells of its own
+CELLS_PER_EPS = 2
+
+# Cells are made slightly wider than epsilon / CELLS_PER_EPS so projection
+# error can never push a true neighbour outside the 5x5 block of cells
+CELL_MARGIN = 1.001
+
+# Candidate pairs checked per vectorized block
+PAIR_BLOCK_SIZE = 4_000_000
+
+# Points per cell tried first when linking neighbouring cells of core points
+LINK_SAMPLE = 4
+
+# Cell offsets reaching every possible neighbour, and the half of them
+# covering each unordered pair of distinct cells once
+NEIGHBOURHOOD = [
+    (dx, dy) for dx in range(-CELLS_PER_EPS, CELLS_PER_EPS + 1)
+    for dy in range(-CELLS_PER_EPS, CELLS_PER_EPS + 1)
+]
+HALF_NEIGHBOURHOOD = [(dx, dy) for dx, dy in NEIGHBOURHOOD if dx > 0 or (dx == 0 and dy > 0)]
+
+
+def grid_dbscan(coords_rad, eps_rad, min_samples):
+    """DBSCAN labels for [lat, lon] radian coordinates with haversine eps_rad"""
+    coords_rad = np.asarray(coords_rad, dtype=float)
+    n = len(coords_rad)
+    labels = np.full(n, -1, dtype=int)
+    if n == 0:
+        return labels
+
+    lat = coords_rad[:, 0]
+    lon = coords_rad[:, 1]
+
+    # Project with the smallest cos(latitude) in the data so projected
+    # east-west distances never exceed the true ones
+    cos_ref = np.cos(np.abs(lat).max())
+    cell = eps_rad * CELL_MARGIN / CELLS_PER_EPS
+    cx = np.floor(lon * cos_ref / cell).astype(np.int64)
+    cy = np.floor(lat / cell).astype(np.int64)
+    cx -= cx.min() - CELLS_PER_EPS
+    cy -= cy.min() - CELLS_PER_EPS
+    stride = cy.max() + CELLS_PER_EPS + 1
+    keys = cx * stride + cy
+
+    # Sort points by cell so each cell is a contiguous slice; everything
+    # below works on sorted positions until labels are written back
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    cell_keys, cell_start, cell_count = np.unique(sorted_keys, return_index=True, return_counts=True)
+    n_cells = len(cell_keys)
+    cell_of = np.repeat(np.arange(n_cells), cell_count)
+    sorted_lat = lat[order]
+    sorted_lon = lon[order]
+
+    # A cell is compact when its bounding box fits inside epsilon, so all
+    # of its points are neighbours of each other without checking pairs
+    compact = _box_span(
+        np.minimum.reduceat(sorted_lat, cell_start), np.maximum.reduceat(sorted_lat, cell_start),
+        np.minimum.reduceat(sorted_lon, cell_start), np.maximum.reduceat(sorted_lon, cell_start)
+    ) <= eps_rad
+
+    def members(mask):
+        """Sorted positions selected by mask, grouped per cell as (positions, start, count)"""
+        positions = np.flatnonzero(mask)
+        count = np.bincount(cell_of[positions], minlength=n_cells)
+        return positions, np.cumsum(count) - count, count
+
+    def cell_pairs(offsets, a, b):
+        """(cell, cell) pairs at the given offsets with members of a and b"""
+        pairs_a, pairs_b = [], []
+        for dx, dy in offsets:
+            target = cell_keys + dx * stride + dy
+            pos = np.minimum(np.searchsorted(cell_keys, target), n_cells - 1)
+            found = (cell_keys[pos] == target) & (a[2] > 0)
+            found &= b[2][pos] > 0
+            pairs_a.append(np.flatnonzero(found))
+            pairs_b.append(pos[found])
+        return np.concatenate(pairs_a), np.concatenate(pairs_b)
+
+    def close_pairs(ca, cb, a, b, limit=None):
+        """Yield (i, j) blocks of distinct sorted positions within eps_rad between cells ca[k] and cb[k]"""
+        a_count, b_count = a[2][ca], b[2][cb]
+        if limit is not None:
+            a_count, b_count = np.minimum(a_count, limit), np.minimum(b_count, limit)
+        pair_counts = a_count * b_count
+        for lo, hi in _blocks(pair_counts):
+            counts = pair_counts[lo:hi]
+            owner = np.repeat(np.arange(lo, hi), counts)
+            local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            i = a[0][a[1][ca[owner]] + local // b_count[owner]]
+            j = b[0][b[1][cb[owner]] + local % b_count[owner]]
+            close = _haversine(sorted_lat[i], sorted_lon[i], sorted_lat[j], sorted_lon[j]) <= eps_rad
+            close &= i != j
+            yield i[close], j[close]
+
+    # Pass 1: core points. Compact cells with enough points are all core;
+    # everything else counts its neighbours (itself included, as in sklearn)
+    is_core = (compact & (cell_count >= min_samples))[cell_of]
+    everyone = members(np.ones(n, dtype=bool))
+    undecided = members(~is_core)
+    degree = np.ones(n, dtype=np.int64)
+    for i, j in close_pairs(*cell_pairs(NEIGHBOURHOOD, undecided, everyone), undecided, everyone):
+        degree += np.bincount(i, minlength=n)
+    is_core |= degree >= min_samples
+
+    # Pass 2: union core-core edges on original indices, hooking larger
+    # roots under smaller ones so each root ends up the component's
+    # smallest core index
+    parent = np.arange(n)
+    cores = members(is_core)
+    core_positions, core_start, core_count = cores
+
+    # Cores sharing a compact cell are all linked to the cell's first core
+    linked = compact & (core_count > 0)
+    first_core = np.full(n_cells, -1)
+    first_core[linked] = core_positions[core_start[linked]]
+    in_linked = core_positions[linked[cell_of[core_positions]]]
+    _union(parent, order[in_linked], order[first_core[cell_of[in_linked]]])
+
+    # Neighbouring cells, plus loose cells against themselves
+    ca, cb = cell_pairs(HALF_NEIGHBOURHOOD, cores, cores)
+    loose = np.flatnonzero(~compact & (core_count > 1))
+    ca, cb = np.concatenate([ca, loose]), np.concatenate([cb, loose])
+
+    # A few sampled pairs link most dense neighbouring cells cheaply
+    for i, j in close_pairs(ca, cb, cores, cores, limit=LINK_SAMPLE):
+        _union(parent, order[i], order[j])
+
+    # Check every pair only where the cells may still be apart
+    pair_counts = core_count[ca] * core_count[cb]
+    for lo, hi in _blocks(pair_counts):
+        block_a, block_b = ca[lo:hi], cb[lo:hi]
+        _compress(parent)
+        settled = linked[block_a] & linked[block_b]
+        settled &= parent[order[first_core[block_a]]] == parent[order[first_core[block_b]]]
+        for i, j in close_pairs(block_a[~settled], block_b[~settled], cores, cores):
+            _union(parent, order[i], order[j])
+    _compress(parent)
+
+    # sklearn numbers clusters in order of their first core point
+    core_mask = np.zeros(n, dtype=bool)
+    core_mask[order] = is_core
+    roots = parent[core_mask]
+    labels[core_mask] = np.searchsorted(np.unique(roots), roots)
+
+    # Pass 3: border points join the earliest-numbered cluster among their
+    # core neighbours
+    border = members(~is_core)
+    best = np.full(n, np.iinfo(np.int64).max, dtype=np.int64)
+    for i, j in close_pairs(*cell_pairs(NEIGHBOURHOOD, border, cores), border, cores):
+        np.minimum.at(best, order[i], labels[order[j]])
+    assigned = best < np.iinfo(np.int64).max
+    labels[assigned] = best[assigned]
+
+    return labels
+
+
+def _haversine(lat1, lon1, lat2, lon2):
+    """Haversine distance in radians, as sklearn computes it"""
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * np.arcsin(np.sqrt(a))
+
+
+def _box_span(lat_lo, lat_hi, lon_lo, lon_hi):
+    """Upper bound on the haversine distance between two points of a lat/lon box"""
+    cos_max = np.where((lat_lo <= 0) & (lat_hi >= 0), 1.0, np.maximum(np.cos(lat_lo), np.cos(lat_hi)))
+    a = np.sin((lat_hi - lat_lo) / 2) ** 2 + (cos_max * np.sin((lon_hi - lon_lo) / 2)) ** 2
+    return 2 * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def _blocks(pair_counts):
+    """(lo, hi) slices of pair_counts holding about PAIR_BLOCK_SIZE pairs each"""
+    ends = np.cumsum(pair_counts)
+    lo = 0
+    while lo < len(pair_counts):
+        base = ends[lo - 1] if lo else 0
+        hi = max(int(np.searchsorted(ends, base + PAIR_BLOCK_SIZE, side='right')), lo + 1)
+        yield lo, hi
+        lo = hi
+
+
+def _compress(parent):
+    """Point every node straight at its root"""
+    while True:
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            return
+        parent[:] = grandparent
+
+
+def _union(parent, i, j):
+    """Merge the components of each (i, j) edge, keeping the smaller root"""
+    while len(i):
+        _compress(parent)
+        ri, rj = parent[i], parent[j]
+        differ = ri != rj
+        if not differ.any():
+            return
+        ri, rj = ri[differ], rj[differ]
+        np.minimum.at(parent, np.maximum(ri, rj), np.minimum(ri, rj))
+        i, j = i[differ], j[differ]
+
+
+# ============================================================================
+# BENCHMARK
+# ============================================================================
+
+def synthetic_urban_points(n, seed=0):
+    """Points scattered around a few Indian city centres, with dense hotspots"""
+    rng = np.random.default_rng(seed)
+    cities = np.array([
+        [28.61, 77.21], [19.08, 72.88], [12.97, 77.59], [13.08, 80.27],
+        [22.57, 88.36], [17.39, 78.49], [23.02, 72.57], [18.52, 73.86]
+    ])
+    city = rng.integers(0, len(cities), n)
+    # About 4 km spread per city, plus 5% of points packed into 300 m hotspots
+    spread = np.where(rng.random(n) < 0.05, 0.003, 0.04)
+    lat = cities[city, 0] + rng.normal(0, 1, n) * spread
+    lon = cities[city, 1] + rng.normal(0, 1, n) * spread
+    return np.radians(np.column_stack([lat, lon]))
+
+
+def benchmark(sizes, eps_m=500, min_samples=2, repeat=1):
+    """Time grid_dbscan against sklearn's haversine DBSCAN and compare labels"""
+    import time
+    from sklearn.cluster import DBSCAN
+
+    eps_rad = eps_m / 6371000
+    results = []
+    for n in sizes:
+        coords = synthetic_urban_points(n)
+        row = {'points': n, 'eps_m': eps_m, 'min_samples': min_samples}
+
+        for engine in ('grid', 'sklearn'):
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                if engine == 'grid':
+                    labels = grid_dbscan(coords, eps_rad, min_samples)
+                else:
+                    labels = DBSCAN(eps=eps_rad, min_samples=min_samples, metric='haversine').fit_predict(coords)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            row[f'{engine}_seconds'] = round(best, 3)
+            row[f'{engine}_labels'] = labels
+
+        row['clusters'] = int(row['grid_labels'].max() + 1)
+        row['identical_labels'] = bool(np.array_equal(row.pop('grid_labels'), row.pop('sklearn_labels')))
+        row['speedup'] = round(row['sklearn_seconds'] / row['grid_seconds'], 1)
+        results.append(row)
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Benchmark grid-hash DBSCAN against sklearn")
+    parser.add_argument('--points', type=int, nargs='+', default=[100_000, 1_000_000])
+    parser.add_argument('--eps-m', type=float, default=500)
+    parser.add_argument('--min-samples', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args()
+
+    for result in benchmark(args.points, args.eps_m, args.min_samples, args.repeat):
+        print(json.dumps(result))
@@ -0,0 +1,700 @@
+"""
+Local storage backend for the smart clustering engine
+
+Implements the same methods as BigQueryStorage in app.py on an embedded
+DuckDB database, so the engine can be profiled, benchmarked and replayed on
+a laptop without a Google Cloud project. It needs duckdb, which is not
+part of the service image but is pinned in requirements-dev.txt:
+
+    pip install -r requirements-dev.txt
+    STORAGE_BACKEND=local LOCAL_DATA_DIR=./local_data python app.py
+
+Patient records are read from LOCAL_SOURCE_PATH (a Parquet file or glob,
+LOCAL_DATA_DIR/patient_records*.parquet by default). Clusters, assignments,
+merge history and the processing ledger live in
+LOCAL_DATA_DIR/smart_clusters.duckdb.
+"""
+
+import logging
+import os
+import uuid
+from datetime import datetime, timezone
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# BigQuery schema field types and their DuckDB equivalents
+DUCKDB_TYPES = {
+    'STRING': 'VARCHAR',
+    'DATE': 'DATE',
+    'TIMESTAMP': 'TIMESTAMPTZ',
+    'FLOAT': 'DOUBLE',
+    'INTEGER': 'BIGINT',
+}
+
+# Ledger dates a worker may claim: never claimed, failed, or leased by a
+# worker whose lease has run out
+CLAIMABLE_DATE = """(
+    status IN ('PENDING', 'FAILED')
+    OR (status = 'IN_PROGRESS'
+        AND COALESCE(lease_expires_at, claimed_at + to_seconds($lease_seconds)) < $timestamp)
+)"""
+
+LEASE_CLAIM = """
+    status = 'IN_PROGRESS',
+    worker_id = $worker_id,
+    claimed_at = $timestamp,
+    heartbeat_at = $timestamp,
+    lease_expires_at = $timestamp + to_seconds($lease_seconds)
+"""
+
+
+class LocalStorage:
+    """Every read and write the clustering engine makes, against DuckDB and Parquet
+
+    schemas maps each engine table name to its BigQuery schema; columns
+    maps the engine's logical patient columns (unique_id, entry_date,
+    area_type, state, district, subdistrict, village, syndrome, latitude,
+    longitude) to the source column names.
+    """
+
+    def __init__(self, data_dir, source_path, schemas, columns, max_cluster_age_days=7, lookback_days=7, lease_seconds=300, job_lease_seconds=900):
+        self.data_dir = data_dir
+        self.source_path = source_path
+        self.schemas = schemas
+        self.columns = columns
+        self.max_cluster_age_days = max_cluster_age_days
+        self.lookback_days = lookback_days
+        self.lease_seconds = lease_seconds
+        self.job_lease_seconds = job_lease_seconds
+        self._connection = None
+        try:
+            import duckdb
+        except ImportError:
+            raise RuntimeError("STORAGE_BACKEND=local needs duckdb: pip install -r requirements-dev.txt") from None
+        self._duckdb = duckdb
+
+    @property
+    def connection(self):
+        """DuckDB connection, opened (and tables created) on first use"""
+        if self._connection is None:
+            os.makedirs(self.data_dir, exist_ok=True)
+            self._connection = self._duckdb.connect(os.path.join(self.data_dir, 'smart_clusters.duckdb'))
+            self.create_tables()
+        return self._connection
+
+    def query(self, sql, parameters=None, **frames):
+        """Run sql with $name parameters; keyword DataFrames are visible as tables"""
+        connection = self.connection
+        for name, frame in frames.items():
+            connection.register(name, frame)
+        try:
+            return connection.execute(sql, parameters or {}).df()
+        finally:
+            for name in frames:
+                connection.unregister(name)
+
+    def create_tables(self):
+        """Create the engine tables (adding any missing columns) and the source view"""
+        for table, schema in self.schemas.items():
+            columns = ', '.join(f"{field.name} {DUCKDB_TYPES[field.field_type]}" for field in schema)
+            self.query(f"CREATE TABLE IF NOT EXISTS {table} ({columns})")
+            for field in schema:
+                self.query(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {field.name} {DUCKDB_TYPES[field.field_type]}")
+
+        try:
+            self.query(f"""
+            CREATE OR REPLACE VIEW patient_records AS
+            SELECT * FROM read_parquet('{self.source_path}', union_by_name = true)
+            """)
+            self.refresh_date_ledger()
+        except Exception as e:
+            logger.warning(f"No patient records at {self.source_path}: {str(e)}")
+        logger.info(f"Local storage ready in {self.data_dir}")
+
+    def refresh_date_ledger(self):
+        """Bring the date ledger's row and quality counts up to date with the Parquet files
+
+        Locally there are no ingest or geocoding functions to maintain the
+        ledger, so the source is counted once per connection instead. New dates take the
+        best status they reached in smart_processing_status, or PENDING.
+        """
+        c = self.columns
+        timestamp = datetime.now(timezone.utc)
+        self.query(f"""
+        CREATE OR REPLACE TEMP TABLE source_dates AS
+        SELECT
+            {c['entry_date']} as date,
+            COUNT(*) as row_count,
+            COUNT(*) FILTER (WHERE {c['area_type']} = 'Urban') as total_urban,
+            COUNT(*) FILTER (WHERE {c['area_type']} = 'Urban'
+                AND {c['latitude']} IS NOT NULL AND {c['longitude']} IS NOT NULL
+                AND {c['latitude']} != 0 AND {c['longitude']} != 0) as geocoded_urban
+        FROM patient_records
+        WHERE {c['entry_date']} IS NOT NULL
+        GROUP BY date
+        """)
+        self.query("""
+        UPDATE smart_date_ledger l
+        SET row_count = s.row_count, total_urban = s.total_urban, geocoded_urban = s.geocoded_urban,
+            last_ingested_at = $timestamp
+        FROM source_dates s
+        WHERE l.date = s.date
+          AND (l.row_count IS DISTINCT FROM s.row_count
+               OR l.total_urban IS DISTINCT FROM s.total_urban
+               OR l.geocoded_urban IS DISTINCT FROM s.geocoded_urban)
+        """, {'timestamp': timestamp})
+        self.query("""
+        INSERT INTO smart_date_ledger (date, row_count, total_urban, geocoded_urban, status, worker_id, first_ingested_at, last_ingested_at, claimed_at, completed_at)
+        SELECT s.date, s.row_count, s.total_urban, s.geocoded_urban, COALESCE(p.status, 'PENDING'), p.worker_id, $timestamp, $timestamp, p.started_at, p.completed_at
+        FROM source_dates s
+        LEFT JOIN (
+            SELECT date, status, worker_id, started_at, completed_at
+            FROM smart_processing_status
+            QUALIFY row_number() OVER (
+                PARTITION BY date
+                ORDER BY CASE status WHEN 'COMPLETED' THEN 0 WHEN 'IN_PROGRESS' THEN 1 ELSE 2 END, started_at DESC
+            ) = 1
+        ) p ON s.date = p.date
+        WHERE s.date NOT IN (SELECT date FROM smart_date_ledger)
+        """, {'timestamp': timestamp})
+        self.query("DROP TABLE source_dates")
+
+    def catch_up_date_ledger(self):
+        """Add source dates missing from the date ledger; returns how many were added"""
+        before = self.query("SELECT COUNT(*) as n FROM smart_date_ledger").n[0]
+        self.refresh_date_ledger()
+        return int(self.query("SELECT COUNT(*) as n FROM smart_date_ledger").n[0] - before)
+
+    # ------------------------------------------------------------------
+    # Patient reads
+    # ------------------------------------------------------------------
+
+    def fetch_patient_days(self, days, syndrome=None):
+        """Fetch clustering candidates entered on the given days in one query,
+        optionally only those with one primary syndrome"""
+        c = self.columns
+        df = self.query(f"""
+        SELECT
+            {c['unique_id']},
+            {c['entry_date']},
+            {c['area_type']},
+            {c['state']},
+            {c['district']},
+            {c['subdistrict']},
+            {c['village']},
+            {c['syndrome']},
+            {c['latitude']},
+            {c['longitude']}
+        FROM patient_records
+        WHERE
+            {c['entry_date']} BETWEEN $start_date AND $end_date
+            AND list_contains($days, {c['entry_date']})
+            AND (CAST($syndrome AS VARCHAR) IS NULL OR {c['syndrome']} = $syndrome)
+            AND (
+                ({c['area_type']} = 'Rural' AND {c['village']} IS NOT NULL)
+                OR (
+                    {c['area_type']} = 'Urban'
+                    AND {c['latitude']} BETWEEN 8 AND 37
+                    AND {c['longitude']} BETWEEN 68 AND 97
+                    AND {c['latitude']} != 0.0
+                    AND {c['longitude']} != 0.0
+                    AND (pat_street IS NOT NULL AND pat_street != '' OR villagename IS NOT NULL AND villagename != '')
+                )
+            )
+        """, {'start_date': min(days), 'end_date': max(days), 'days': sorted(days), 'syndrome': syndrome})
+        return _as_dates(df, c['entry_date'])
+
+    def fetch_date_quality(self, start_date, end_date):
+        """Per-date status and urban geocoding counts over a date range, from the date ledger"""
+        df = self.query("""
+        SELECT
+            date,
+            status,
+            COALESCE(total_urban, 0) as total_urban,
+            COALESCE(geocoded_urban, 0) as geocoded_urban
+        FROM smart_date_ledger
+        WHERE date BETWEEN CAST($start_date AS DATE) AND CAST($end_date AS DATE)
+        ORDER BY date
+        """, {'start_date': start_date, 'end_date': end_date})
+        return _as_dates(df, 'date')
+
+    def fetch_pending_date_quality(self):
+        """Status, row count and urban geocoding counts of every claimable date"""
+        df = self.query(f"""
+        SELECT
+            date,
+            status,
+            row_count,
+            COALESCE(total_urban, 0) as total_urban,
+            COALESCE(geocoded_urban, 0) as geocoded_urban
+        FROM smart_date_ledger
+        WHERE {CLAIMABLE_DATE}
+        ORDER BY date
+        """, {'timestamp': datetime.now(timezone.utc), 'lease_seconds': self.lease_seconds})
+        return _as_dates(df, 'date')
+
+    # ------------------------------------------------------------------
+    # Cluster reads
+    # ------------------------------------------------------------------
+
+    def load_active_abc_clusters(self, processing_date):
+        """Load every ABC cluster young enough to be merged with, in one query"""
+        df = self.query("""
+        SELECT
+            smart_cluster_id,
+            original_creation_date,
+            patient_count,
+            expansion_count,
+            village_name,
+            primary_syndrome,
+            created_at
+        FROM smart_clusters
+        WHERE algorithm_type = 'ABC'
+          AND date_diff('day', original_creation_date, CAST($processing_date AS DATE)) <= $max_age_days
+        """, {'processing_date': processing_date, 'max_age_days': self.max_cluster_age_days})
+        return _as_dates(df, 'original_creation_date')
+
+    def load_active_gis_clusters(self, processing_date):
+        """Load every GIS cluster young enough to be merged with, in one query"""
+        df = self.query("""
+        SELECT
+            smart_cluster_id,
+            original_creation_date,
+            patient_count,
+            expansion_count,
+            centroid_lat,
+            centroid_lon,
+            actual_cluster_radius,
+            primary_syndrome,
+            created_at
+        FROM smart_clusters
+        WHERE algorithm_type = 'GIS'
+          AND centroid_lat IS NOT NULL
+          AND centroid_lon IS NOT NULL
+          AND date_diff('day', original_creation_date, CAST($processing_date AS DATE)) <= $max_age_days
+        """, {'processing_date': processing_date, 'max_age_days': self.max_cluster_age_days})
+        return _as_dates(df, 'original_creation_date')
+
+    def load_cluster_members(self, cluster_ids):
+        """Load the assigned unique_ids of many clusters in one query"""
+        members = {cluster_id: set() for cluster_id in cluster_ids}
+        if not members:
+            return members
+
+        df = self.query("""
+        SELECT smart_cluster_id, unique_id
+        FROM smart_cluster_assignments
+        WHERE list_contains($cluster_ids, smart_cluster_id)
+        """, {'cluster_ids': sorted(members)})
+        for cluster_id, unique_ids in df.groupby('smart_cluster_id')['unique_id']:
+            members[cluster_id].update(unique_ids)
+        return members
+
+    def load_gis_cluster_members(self, cluster_ids):
+        """Existing members of many GIS clusters with their coordinates, in one query"""
+        latitude, longitude = self.columns['latitude'], self.columns['longitude']
+        columns = ['unique_id', latitude, longitude]
+        members = {cluster_id: pd.DataFrame(columns=columns) for cluster_id in cluster_ids}
+        if not members:
+            return members
+
+        df = self.query(f"""
+        SELECT smart_cluster_id, unique_id, latitude AS {latitude}, longitude AS {longitude}
+        FROM smart_cluster_assignments
+        WHERE list_contains($cluster_ids, smart_cluster_id)
+          AND latitude IS NOT NULL AND longitude IS NOT NULL
+        """, {'cluster_ids': sorted(members)})
+        for cluster_id, coords in df.groupby('smart_cluster_id'):
+            members[cluster_id] = coords[columns].reset_index(drop=True)
+        return members
+
+    # ------------------------------------------------------------------
+    # Cluster writes
+    # ------------------------------------------------------------------
+
+    def write_date(self, clusters, assignments, merge_history, cluster_updates):
+        """Write one date's clusters, assignments, merge history and expansions in one transaction"""
+        connection = self.connection
+        connection.begin()
+        try:
+            self._write_clusters(clusters)
+            self._write_assignments(assignments)
+            self._write_merge_history(merge_history)
+            self._apply_cluster_updates(cluster_updates)
+            self._refresh_site_codes(
+                [row['smart_cluster_id'] for row in clusters] + [u['smart_cluster_id'] for u in cluster_updates]
+            )
+        except Exception:
+            connection.rollback()
+            raise
+        connection.commit()
+
+    def _write_clusters(self, rows):
+        """Append new cluster rows"""
+        if rows:
+            self.query("INSERT INTO smart_clusters BY NAME SELECT * FROM new_rows", new_rows=pd.DataFrame(rows))
+
+    def _write_assignments(self, frame):
+        """Append a frame of assignment rows"""
+        if frame is not None and len(frame) > 0:
+            self.query("INSERT INTO smart_cluster_assignments BY NAME SELECT * FROM new_rows", new_rows=frame)
+
+    def _write_merge_history(self, rows):
+        """Append merge-history rows"""
+        if rows:
+            self.query("INSERT INTO smart_merge_history BY NAME SELECT * FROM new_rows", new_rows=pd.DataFrame(rows))
+
+    def _apply_cluster_updates(self, updates):
+        """Apply buffered expansions to existing clusters in one statement"""
+        if not updates:
+            return
+
+        columns = ['smart_cluster_id', 'patient_count', 'expansion_count', 'input_date',
+                   'centroid_lat', 'centroid_lon', 'actual_cluster_radius']
+        self.query("""
+        UPDATE smart_clusters c SET
+            patient_count = c.patient_count + u.patient_count,
+            expansion_count = c.expansion_count + u.expansion_count,
+            input_date = CAST(u.input_date AS DATE),
+            centroid_lat = COALESCE(u.centroid_lat, c.centroid_lat),
+            centroid_lon = COALESCE(u.centroid_lon, c.centroid_lon),
+            actual_cluster_radius = COALESCE(u.actual_cluster_radius, c.actual_cluster_radius)
+        FROM updates u
+        WHERE c.smart_cluster_id = u.smart_cluster_id
+        """, updates=pd.DataFrame(updates).reindex(columns=columns).astype({
+            'centroid_lat': float, 'centroid_lon': float, 'actual_cluster_radius': float
+        }))
+
+    def _refresh_site_codes(self, cluster_ids):
+        """Recompute most_common_site_code of clusters that gained members
+
+        Skipped when the patient records have no site_code column.
+        """
+        if not cluster_ids or 'site_code' not in self.query("SELECT * FROM patient_records LIMIT 0").columns:
+            return
+
+        self.query(f"""
+        UPDATE smart_clusters c
+        SET most_common_site_code = s.site_code
+        FROM (
+            SELECT a.smart_cluster_id, p.site_code
+            FROM smart_cluster_assignments a
+            JOIN patient_records p ON a.unique_id = p.{self.columns['unique_id']}
+            WHERE list_contains($cluster_ids, a.smart_cluster_id) AND p.site_code IS NOT NULL
+            GROUP BY a.smart_cluster_id, p.site_code
+            QUALIFY row_number() OVER (PARTITION BY a.smart_cluster_id ORDER BY COUNT(*) DESC, p.site_code) = 1
+        ) s
+        WHERE c.smart_cluster_id = s.smart_cluster_id
+        """, {'cluster_ids': sorted(cluster_ids)})
+
+    # ------------------------------------------------------------------
+    # Date ledger and processing status
+    # ------------------------------------------------------------------
+
+    def claim_next_date(self):
+        """Lease the earliest claimable date in the date ledger"""
+        worker_id = f"worker-{uuid.uuid4().hex[:8]}"
+        parameters = self._lease_parameters(worker_id)
+
+        claimed = self.query(f"""
+        UPDATE smart_date_ledger
+        SET {LEASE_CLAIM}
+        WHERE date = (SELECT MIN(date) FROM smart_date_ledger WHERE {CLAIMABLE_DATE})
+          AND {CLAIMABLE_DATE}
+        RETURNING date
+        """, parameters)
+        if len(claimed) == 0:
+            return None, None
+
+        self._log_claims(claimed, worker_id, parameters['timestamp'])
+        next_date = pd.Timestamp(claimed['date'][0]).strftime('%Y-%m-%d')
+        logger.info(f"Worker {worker_id} claimed date {next_date}")
+        return next_date, worker_id
+
+    def claim_date_range(self, start_date, end_date):
+        """Lease every claimable ledger date in a range for one backfill worker"""
+        worker_id = f"backfill-{uuid.uuid4().hex[:8]}"
+        parameters = self._lease_parameters(worker_id)
+
+        claimed = self.query(f"""
+        UPDATE smart_date_ledger
+        SET {LEASE_CLAIM}
+        WHERE date BETWEEN CAST($start_date AS DATE) AND CAST($end_date AS DATE)
+          AND {CLAIMABLE_DATE}
+        RETURNING date
+        """, {**parameters, 'start_date': start_date, 'end_date': end_date})
+
+        self._log_claims(claimed, worker_id, parameters['timestamp'])
+        return sorted(pd.to_datetime(claimed['date']).dt.strftime('%Y-%m-%d')), worker_id
+
+    def _lease_parameters(self, worker_id):
+        """Query parameters for a claim or renewal made now by worker_id"""
+        return {'worker_id': worker_id, 'timestamp': datetime.now(timezone.utc), 'lease_seconds': self.lease_seconds}
+
+    def _log_claims(self, claimed, worker_id, timestamp):
+        """Close log rows left IN_PROGRESS by expired leases and append an
+        IN_PROGRESS row for each claimed date"""
+        parameters = {'worker_id': worker_id, 'timestamp': timestamp}
+        self.query("""
+        UPDATE smart_processing_status
+        SET status = 'FAILED', completed_at = $timestamp
+        WHERE status = 'IN_PROGRESS' AND worker_id != $worker_id AND date IN (SELECT date FROM claimed)
+        """, parameters, claimed=claimed)
+        self.query("""
+        INSERT INTO smart_processing_status (date, status, worker_id, started_at)
+        SELECT date, 'IN_PROGRESS', $worker_id, $timestamp FROM claimed
+        """, parameters, claimed=claimed)
+
+    def renew_leases(self, dates, worker_id):
+        """Extend worker_id's lease on dates; returns how many it no longer holds
+
+        Runs on its own cursor, as the heartbeat calls it from another thread.
+        """
+        cursor = self.connection.cursor()
+        try:
+            renewed = cursor.execute("""
+            UPDATE smart_date_ledger
+            SET heartbeat_at = $timestamp, lease_expires_at = $timestamp + to_seconds($lease_seconds)
+            WHERE list_contains($dates, CAST(date AS VARCHAR)) AND worker_id = $worker_id AND status = 'IN_PROGRESS'
+            RETURNING date
+            """, {**self._lease_parameters(worker_id), 'dates': [str(d) for d in set(dates)]}).fetchall()
+        finally:
+            cursor.close()
+        return len(set(dates)) - len(renewed)
+
+    def date_ledger_status(self):
+        """Next claimable date, claimable date count, expired leases and watermark from the ledger"""
+        return self.query(f"""
+        SELECT
+            MIN(date) FILTER (WHERE {CLAIMABLE_DATE}) as next_date,
+            COUNT(*) FILTER (WHERE {CLAIMABLE_DATE}) as pending_dates,
+            COUNT(*) FILTER (WHERE status = 'IN_PROGRESS' AND {CLAIMABLE_DATE}) as expired_leases,
+            MAX(date) FILTER (WHERE status = 'COMPLETED' AND date < first_open) as watermark
+        FROM smart_date_ledger
+        CROSS JOIN (
+            SELECT COALESCE(MIN(date), DATE '9999-12-31') as first_open
+            FROM smart_date_ledger
+            WHERE status != 'COMPLETED'
+        )
+        """, {'timestamp': datetime.now(timezone.utc), 'lease_seconds': self.lease_seconds})
+
+    def mark_date_completed(self, processing_date, worker_id):
+        """Mark date as completed"""
+        self.mark_dates_completed([processing_date], worker_id)
+
+    def mark_dates_completed(self, dates, worker_id):
+        """Mark many dates as completed in the ledger and the status log"""
+        if not dates:
+            return
+        parameters = {'dates': [str(d) for d in dates], 'worker_id': worker_id, 'timestamp': datetime.now(timezone.utc)}
+        for table in ('smart_date_ledger', 'smart_processing_status'):
+            self.query(f"""
+            UPDATE {table} SET status = 'COMPLETED', completed_at = $timestamp
+            WHERE list_contains($dates, CAST(date AS VARCHAR)) AND worker_id = $worker_id
+            """, parameters)
+
+    def mark_date_failed(self, processing_date, worker_id, error_message):
+        """Mark date as failed with error details"""
+        parameters = {'date': processing_date, 'worker_id': worker_id, 'timestamp': datetime.now(timezone.utc)}
+        for table in ('smart_date_ledger', 'smart_processing_status'):
+            self.query(f"""
+            UPDATE {table} SET status = 'FAILED', completed_at = $timestamp
+            WHERE date = CAST($date AS DATE) AND worker_id = $worker_id
+            """, parameters)
+        logger.error(f"Processing failed for {processing_date} by {worker_id}: {error_message}")
+
+    # ------------------------------------------------------------------
+    # Shards
+    # ------------------------------------------------------------------
+
+    def claim_next_dates(self, count):
+        """Lease the earliest count claimable dates for one shard planner"""
+        worker_id = f"planner-{uuid.uuid4().hex[:8]}"
+        parameters = self._lease_parameters(worker_id)
+
+        claimed = self.query(f"""
+        UPDATE smart_date_ledger
+        SET {LEASE_CLAIM}
+        WHERE {CLAIMABLE_DATE}
+          AND date IN (SELECT date FROM smart_date_ledger WHERE {CLAIMABLE_DATE} ORDER BY date LIMIT $count)
+        RETURNING date
+        """, {**parameters, 'count': count})
+
+        self._log_claims(claimed, worker_id, parameters['timestamp'])
+        return sorted(pd.to_datetime(claimed['date']).dt.strftime('%Y-%m-%d')), worker_id
+
+    def shard_dates(self, dates, worker_id):
+        """Split dates leased by worker_id into (date, syndrome) shards
+
+        Each date gets one PENDING shard per primary syndrome in its patient
+        window and becomes SHARDED, in one transaction. Returns the shards.
+        """
+        c = self.columns
+        parameters = {'dates': [str(d) for d in dates], 'worker_id': worker_id}
+        self.query("BEGIN TRANSACTION")
+        try:
+            self.query(f"""
+            INSERT INTO smart_shard_ledger (date, syndrome, patient_count, status)
+            SELECT d.date, p.{c['syndrome']}, COUNT(*), 'PENDING'
+            FROM patient_records p
+            JOIN smart_date_ledger d
+              ON p.{c['entry_date']} BETWEEN d.date - CAST($lookback_days AS INTEGER) AND d.date - 1
+            WHERE list_contains($dates, CAST(d.date AS VARCHAR)) AND d.worker_id = $worker_id AND d.status = 'IN_PROGRESS'
+              AND p.{c['syndrome']} IS NOT NULL
+              AND d.date NOT IN (SELECT date FROM smart_shard_ledger)
+            GROUP BY d.date, p.{c['syndrome']}
+            """, {**parameters, 'lookback_days': self.lookback_days})
+            self.query("""
+            UPDATE smart_date_ledger
+            SET status = 'SHARDED'
+            WHERE list_contains($dates, CAST(date AS VARCHAR)) AND worker_id = $worker_id AND status = 'IN_PROGRESS'
+              AND date IN (SELECT date FROM smart_shard_ledger)
+            """, parameters)
+            self.query("COMMIT")
+        except Exception:
+            self.query("ROLLBACK")
+            raise
+
+        return _as_dates(self.query("""
+        SELECT date, syndrome, patient_count
+        FROM smart_shard_ledger
+        WHERE list_contains($dates, CAST(date AS VARCHAR))
+        ORDER BY date, syndrome
+        """, {'dates': parameters['dates']}), 'date')
+
+    def claim_next_shard(self):
+        """Lease the earliest runnable shard (see BigQueryStorage.claim_next_shard)"""
+        worker_id = f"shard-{uuid.uuid4().hex[:8]}"
+        parameters = self._lease_parameters(worker_id)
+
+        claimed = self.query(f"""
+        UPDATE smart_shard_ledger
+        SET {LEASE_CLAIM}
+        WHERE {CLAIMABLE_DATE}
+          AND (date, syndrome) = (
+            SELECT (c.date, c.syndrome)
+            FROM smart_shard_ledger c
+            WHERE {CLAIMABLE_DATE}
+              AND NOT EXISTS (
+                SELECT 1 FROM smart_shard_ledger p
+                WHERE p.syndrome = c.syndrome AND p.status != 'COMPLETED'
+                  AND p.date BETWEEN c.date - CAST($max_age_days AS INTEGER) AND c.date - 1
+              )
+              AND NOT EXISTS (
+                SELECT 1 FROM smart_date_ledger d
+                WHERE d.status NOT IN ('SHARDED', 'COMPLETED')
+                  AND d.date BETWEEN c.date - CAST($max_age_days AS INTEGER) AND c.date - 1
+              )
+            ORDER BY c.date, c.syndrome
+            LIMIT 1
+          )
+        RETURNING date, syndrome
+        """, {**parameters, 'max_age_days': self.max_cluster_age_days})
+        if len(claimed) == 0:
+            return None, None, None
+
+        shard_date = pd.Timestamp(claimed['date'][0]).strftime('%Y-%m-%d')
+        logger.info(f"Worker {worker_id} claimed shard {shard_date}/{claimed['syndrome'][0]}")
+        return shard_date, claimed['syndrome'][0], worker_id
+
+    def renew_shard_leases(self, dates, worker_id, syndrome):
+        """Extend worker_id's lease on a syndrome's shards; returns how many it no longer holds"""
+        cursor = self.connection.cursor()
+        try:
+            renewed = cursor.execute("""
+            UPDATE smart_shard_ledger
+            SET heartbeat_at = $timestamp, lease_expires_at = $timestamp + to_seconds($lease_seconds)
+            WHERE list_contains($dates, CAST(date AS VARCHAR)) AND syndrome = $syndrome
+              AND worker_id = $worker_id AND status = 'IN_PROGRESS'
+            RETURNING date
+            """, {**self._lease_parameters(worker_id), 'dates': [str(d) for d in set(dates)], 'syndrome': syndrome}).fetchall()
+        finally:
+            cursor.close()
+        return len(set(dates)) - len(renewed)
+
+    def mark_shard_completed(self, shard_date, syndrome, worker_id):
+        """Mark a shard completed; its date (and the planner's log row)
+        completes with its last shard"""
+        timestamp = datetime.now(timezone.utc)
+        self.query("""
+        UPDATE smart_shard_ledger SET status = 'COMPLETED', completed_at = $timestamp
+        WHERE date = CAST($date AS DATE) AND syndrome = $syndrome AND worker_id = $worker_id
+        """, {'date': shard_date, 'syndrome': syndrome, 'worker_id': worker_id, 'timestamp': timestamp})
+
+        remaining = self.query("""
+        SELECT COUNT(*) as remaining FROM smart_shard_ledger
+        WHERE date = CAST($date AS DATE) AND status != 'COMPLETED'
+        """, {'date': shard_date})
+        if remaining['remaining'][0] == 0:
+            parameters = {'date': shard_date, 'timestamp': timestamp}
+            self.query("""
+            UPDATE smart_processing_status SET status = 'COMPLETED', completed_at = $timestamp
+            WHERE date = CAST($date AS DATE) AND status = 'IN_PROGRESS'
+              AND worker_id IN (SELECT worker_id FROM smart_date_ledger WHERE date = CAST($date AS DATE) AND status = 'SHARDED')
+            """, parameters)
+            self.query("""
+            UPDATE smart_date_ledger SET status = 'COMPLETED', completed_at = $timestamp
+            WHERE date = CAST($date AS DATE) AND status = 'SHARDED'
+            """, parameters)
+
+    def mark_shard_failed(self, shard_date, syndrome, worker_id, error_message):
+        """Mark a shard failed; it can be claimed again"""
+        self.query("""
+        UPDATE smart_shard_ledger SET status = 'FAILED', completed_at = $timestamp
+        WHERE date = CAST($date AS DATE) AND syndrome = $syndrome AND worker_id = $worker_id
+        """, {'date': shard_date, 'syndrome': syndrome, 'worker_id': worker_id, 'timestamp': datetime.now(timezone.utc)})
+        logger.error(f"Processing failed for shard {shard_date}/{syndrome} by {worker_id}: {error_message}")
+
+    # ------------------------------------------------------------------
+    # Async jobs
+    # ------------------------------------------------------------------
+
+    def create_job(self, job_id, max_dates):
+        """Record a QUEUED job"""
+        self.query("""
+        INSERT INTO smart_jobs (job_id, status, max_dates, dates_processed, submitted_at)
+        VALUES ($job_id, 'QUEUED', $max_dates, 0, $timestamp)
+        """, {'job_id': job_id, 'max_dates': max_dates, 'timestamp': datetime.now(timezone.utc)})
+
+    def claim_job(self, job_id, runner_id):
+        """Lease a QUEUED job, or a RUNNING one whose runner has gone quiet;
+        returns the job row, or None if it is finished, unknown or held"""
+        claimed = self.query("""
+        UPDATE smart_jobs
+        SET status = 'RUNNING', runner_id = $runner_id, started_at = COALESCE(started_at, $timestamp),
+            heartbeat_at = $timestamp, lease_expires_at = $timestamp + to_seconds($lease_seconds)
+        WHERE job_id = $job_id
+          AND (status = 'QUEUED' OR (status = 'RUNNING' AND lease_expires_at < $timestamp))
+        RETURNING *
+        """, {'job_id': job_id, 'runner_id': runner_id, 'timestamp': datetime.now(timezone.utc), 'lease_seconds': self.job_lease_seconds})
+        return claimed.iloc[0] if len(claimed) else None
+
+    def update_job(self, job_id, runner_id, status, progress):
+        """Record runner_id's progress on a job and renew its lease"""
+        self.query("""
+        UPDATE smart_jobs
+        SET status = $status, dates_processed = $dates_processed, last_date = CAST($last_date AS DATE),
+            results = $results, error = $error,
+            runner_id = CASE WHEN $status = 'QUEUED' THEN NULL ELSE runner_id END,
+            heartbeat_at = $timestamp, lease_expires_at = $timestamp + to_seconds($lease_seconds),
+            finished_at = CASE WHEN $status IN ('COMPLETED', 'FAILED') THEN $timestamp END
+        WHERE job_id = $job_id AND runner_id = $runner_id
+        """, {'job_id': job_id, 'runner_id': runner_id, 'status': status, **progress,
+              'timestamp': datetime.now(timezone.utc), 'lease_seconds': self.job_lease_seconds})
+
+    def fetch_job(self, job_id):
+        """A job's row (no rows if there is no such job)"""
+        return self.query("SELECT * FROM smart_jobs WHERE job_id = $job_id", {'job_id': job_id})
+
+    def list_jobs(self, limit):
+        """The most recent jobs, newest first, without their results"""
+        return self.query("SELECT * EXCLUDE (results) FROM smart_jobs ORDER BY submitted_at DESC LIMIT $limit", {'limit': limit})
+
+
+def _as_dates(df, *columns):
+    """Turn DuckDB's datetime64 DATE columns into datetime.date values, as BigQuery returns them"""
+    for column in columns:
+        df[column] = pd.to_datetime(df[column]).dt.date
+    return df
@@ -97,23 +97,69 @@ WHERE a.smart_cluster_id = @cluster_id
   AND DATE(a.assigned_at) >= DATE_SUB(CURRENT_DATE(), INTERVAL 30 DAY)
 """
 
-# Performance monitoring query
+# Performance monitoring query: every labelled job in the last @hours hours,
+# one row per job with its service, endpoint and stage labels.
+# {jobs_table} is the region's INFORMATION_SCHEMA.JOBS_BY_PROJECT view.
 PERFORMANCE_MONITORING_QUERY = """
 SELECT 
     job_id,
+    job_type,
     creation_time,
     start_time,
     end_time,
     TIMESTAMP_DIFF(end_time, start_time, MILLISECOND) as duration_ms,
-    total_bytes_processed,
-    total_slot_ms,
+    IFNULL(total_bytes_processed, 0) as total_bytes_processed,
+    IFNULL(total_bytes_billed, 0) as total_bytes_billed,
+    IFNULL(total_slot_ms, 0) as total_slot_ms,
+    (SELECT value FROM UNNEST(labels) WHERE key = 'service') as service,
+    IFNULL((SELECT value FROM UNNEST(labels) WHERE key = 'endpoint'), 'none') as endpoint,
+    IFNULL((SELECT value FROM UNNEST(labels) WHERE key = 'stage'), 'none') as stage,
     query
-FROM `sentinel-h-5.region-us.INFORMATION_SCHEMA.JOBS_BY_PROJECT`
-WHERE creation_time >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 1 HOUR)
-  AND job_type = 'QUERY'
-  AND query LIKE '%smart_clusters%'
-ORDER BY creation_time DESC
-LIMIT 10
+FROM `{jobs_table}`
+WHERE creation_time >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL @hours HOUR)
+  AND state = 'DONE'
+  AND EXISTS (SELECT 1 FROM UNNEST(labels) WHERE key = 'service')
+"""
+
+# Duration percentiles, bytes billed and slot-ms per (service, endpoint) and
+# per (service, endpoint, stage); stage is NULL on the endpoint rows
+JOB_LABEL_TELEMETRY_QUERY = f"""
+WITH jobs AS ({PERFORMANCE_MONITORING_QUERY})
+SELECT 
+    service,
+    endpoint,
+    stage,
+    COUNT(*) as jobs,
+    SUM(total_bytes_processed) as bytes_processed,
+    SUM(total_bytes_billed) as bytes_billed,
+    SUM(total_slot_ms) as slot_ms,
+    APPROX_QUANTILES(duration_ms, 100)[OFFSET(50)] as p50_ms,
+    APPROX_QUANTILES(duration_ms, 100)[OFFSET(90)] as p90_ms,
+    APPROX_QUANTILES(duration_ms, 100)[OFFSET(99)] as p99_ms,
+    MAX(duration_ms) as max_ms
+FROM jobs
+WHERE @service IS NULL OR service = @service
+GROUP BY GROUPING SETS ((service, endpoint), (service, endpoint, stage))
+ORDER BY bytes_billed DESC, slot_ms DESC
+"""
+
+# The @top most expensive labelled jobs, by bytes billed then slot-ms
+TOP_EXPENSIVE_QUERIES = f"""
+WITH jobs AS ({PERFORMANCE_MONITORING_QUERY})
+SELECT 
+    job_id,
+    service,
+    endpoint,
+    stage,
+    creation_time,
+    duration_ms,
+    total_bytes_billed as bytes_billed,
+    total_slot_ms as slot_ms,
+    LEFT(query, 1000) as query
+FROM jobs
+WHERE @service IS NULL OR service = @service
+ORDER BY total_bytes_billed DESC, total_slot_ms DESC
+LIMIT @top
 """
 
 def get_optimization_recommendations():
@@ -0,0 +1,115 @@
+"""Shared fixtures: the engine on LocalStorage over synthetic patient records"""
+
+import os
+import sys
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as engine
+
+START_DATE = date(2024, 1, 1)
+
+
+def make_patients(n_days=14, seed=0, start=START_DATE):
+    """Synthetic patient records: rural patients spread over a few villages
+    (ABC) and urban patients around a few hotspots with some outliers (GIS)"""
+    rng = np.random.default_rng(seed)
+    rows = []
+    for day_offset in range(n_days):
+        day = start + timedelta(days=day_offset)
+        for _ in range(rng.integers(30, 60)):
+            row = {
+                'unique_id': f"p{len(rows) + 1}",
+                'patient_entry_date': day,
+                'statename': 'S',
+                'districtname': 'D',
+                'subdistrictname': 'SD',
+                'clini_primary_syn': rng.choice(['AFI', 'ADD', 'SARI']),
+                'pat_street': 'street',
+            }
+            if rng.random() < 0.5:
+                row.update(pat_areatype='Rural', villagename=f"V{rng.integers(0, 8)}", latitude=0.0, longitude=0.0)
+            else:
+                hotspot = rng.integers(0, 6)
+                latitude = 12.9 + hotspot * 0.02 + rng.normal(0, 0.002)
+                longitude = 77.5 + hotspot * 0.02 + rng.normal(0, 0.002)
+                if rng.random() < 0.1:
+                    latitude, longitude = 13.5, 78.0
+                row.update(pat_areatype='Urban', villagename='X', latitude=round(latitude, 5), longitude=round(longitude, 5))
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+@pytest.fixture
+def local_engine(tmp_path, monkeypatch):
+    """Factory pointing the engine at a fresh LocalStorage over the given patients
+
+    Each call starts from empty cluster tables in its own directory and
+    returns the engine module.
+    """
+    storages = []
+
+    def make(patients):
+        data_dir = tmp_path / f"run{len(storages)}"
+        data_dir.mkdir()
+        patients.to_parquet(data_dir / 'patient_records.parquet')
+        monkeypatch.setattr(engine, 'STORAGE_BACKEND', 'local')
+        monkeypatch.setattr(engine, 'LOCAL_DATA_DIR', str(data_dir))
+        monkeypatch.setattr(engine, 'LOCAL_SOURCE_PATH', str(data_dir / 'patient_records.parquet'))
+        monkeypatch.setattr(engine, 'storage', engine.create_storage())
+        storages.append(engine.storage)
+        engine.cluster_cache.invalidate()
+        return engine
+
+    yield make
+    for storage in storages:
+        storage.connection.close()
+    engine.cluster_cache.invalidate()
+
+
+def process_all(engine):
+    """POST /smart-process until no date is left; the responses in order"""
+    responses = []
+    with engine.app.test_client() as client:
+        while True:
+            response = client.post('/smart-process').get_json()
+            if not response.get('date_processed'):
+                return responses
+            responses.append(response)
+
+
+def cluster_summary(storage):
+    """Clusters and assignments keyed by member set instead of generated ids
+
+    Two runs that form the same clusters give equal summaries.
+    """
+    clusters = storage.query("SELECT * FROM smart_clusters")
+    assignments = storage.query("SELECT * FROM smart_cluster_assignments")
+    members = {
+        cluster_id: tuple(sorted(group['unique_id']))
+        for cluster_id, group in assignments.groupby('smart_cluster_id')
+    }
+
+    clusters['members'] = clusters['smart_cluster_id'].map(members)
+    for column in ['input_date', 'original_creation_date']:
+        clusters[column] = pd.to_datetime(clusters[column]).dt.date.astype(str)
+    for column in ['centroid_lat', 'centroid_lon', 'actual_cluster_radius']:
+        clusters[column] = clusters[column].astype(float).round(6)
+    cluster_rows = sorted(
+        clusters[[
+            'members', 'algorithm_type', 'input_date', 'original_creation_date', 'patient_count',
+            'expansion_count', 'primary_syndrome', 'village_name', 'centroid_lat', 'centroid_lon',
+            'actual_cluster_radius', 'accept_status'
+        ]].astype(str).itertuples(index=False)
+    )
+
+    assignment_rows = sorted(
+        (members[row.smart_cluster_id], row.unique_id, row.addition_type, str(row.expansion_date)[:10])
+        for row in assignments.itertuples(index=False)
+    )
+    return cluster_rows, assignment_rows
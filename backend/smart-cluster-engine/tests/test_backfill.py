@@ -0,0 +1,82 @@
+"""/smart-backfill forms the same clusters as processing one date at a time"""
+
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+import pytest
+
+import app
+from conftest import cluster_summary, make_patients, process_all
+
+
+def backfill(engine, start_date, end_date):
+    with engine.app.test_client() as client:
+        response = client.post('/smart-backfill', json={'start_date': start_date, 'end_date': end_date}).get_json()
+    assert response['success'], response
+    return response['results']
+
+
+@pytest.mark.parametrize('flush_days', [3, 30])
+def test_backfill_matches_per_date_processing(local_engine, monkeypatch, flush_days):
+    patients = make_patients(n_days=10, seed=1)
+    engine = local_engine(patients)
+    assert all(response['success'] for response in process_all(engine))
+    expected = cluster_summary(engine.storage)
+
+    monkeypatch.setattr(engine, 'BACKFILL_FLUSH_DAYS', flush_days)
+    engine = local_engine(patients)
+    results = backfill(engine, '2024-01-01', '2024-01-10')
+
+    assert [r['date'] for r in results if r['success']] == [f"2024-01-{day:02d}" for day in range(1, 11)]
+    assert cluster_summary(engine.storage) == expected
+
+
+def test_backfill_stops_at_date_leased_by_another_worker(local_engine):
+    patients = make_patients(n_days=6, seed=2)
+    engine = local_engine(patients)
+    assert all(response['success'] for response in process_all(engine))
+    expected = cluster_summary(engine.storage)
+
+    engine = local_engine(patients)
+    leased, _ = engine.storage.claim_date_range('2024-01-03', '2024-01-03')
+    assert leased == ['2024-01-03']
+
+    results = backfill(engine, '2024-01-01', '2024-01-06')
+    assert [(r['date'], r['success'], r.get('waiting_for')) for r in results] == [
+        ('2024-01-01', True, None),
+        ('2024-01-02', True, None),
+        ('2024-01-04', False, '2024-01-03'),
+        ('2024-01-05', False, '2024-01-03'),
+        ('2024-01-06', False, '2024-01-03'),
+    ]
+
+    # The other worker dies; its date is reclaimed and finished, then the
+    # rest of the range is backfilled on top of it
+    engine.storage.query(
+        "UPDATE smart_date_ledger SET lease_expires_at = $expired WHERE date = DATE '2024-01-03'",
+        {'expired': datetime.now(timezone.utc) - timedelta(hours=1)}
+    )
+    with engine.app.test_client() as client:
+        assert client.post('/smart-process').get_json()['date_processed'] == '2024-01-03'
+    results = backfill(engine, '2024-01-01', '2024-01-06')
+    assert [r['date'] for r in results if r['success']] == ['2024-01-04', '2024-01-05', '2024-01-06']
+
+    assert cluster_summary(engine.storage) == expected
+
+
+def test_split_backfill_runs_at_completed_and_leased_dates():
+    ledger = pd.DataFrame({
+        'date': pd.date_range('2024-01-01', periods=7).date,
+        'status': ['IN_PROGRESS', 'COMPLETED', 'IN_PROGRESS', 'IN_PROGRESS', 'IN_PROGRESS', 'IN_PROGRESS', 'IN_PROGRESS'],
+    })
+    claimed = ['2024-01-01', '2024-01-03', '2024-01-04', '2024-01-06', '2024-01-07']
+
+    runs, waiting, leased_date = app.split_backfill_runs(claimed, ledger)
+
+    assert runs == [['2024-01-01'], ['2024-01-03', '2024-01-04']]
+    assert waiting == ['2024-01-06', '2024-01-07']
+    assert leased_date == '2024-01-05'
+
+    runs, waiting, leased_date = app.split_backfill_runs(claimed[:3], ledger[:4])
+    assert runs == [['2024-01-01'], ['2024-01-03', '2024-01-04']]
+    assert (waiting, leased_date) == ([], None)
@@ -0,0 +1,225 @@
+"""The batched engine forms the same clusters as the per-query algorithm
+
+The reference below is the engine as it was before merge lookups were
+batched (ClusterState, the ABC hash index and the GIS BallTree), DBSCAN
+summaries vectorized and writes buffered: one lookup query per ABC group or
+GIS candidate, a DataFrame slice and distance matrix per DBSCAN label, and
+every write made straight away. Both run on LocalStorage over the same
+synthetic patients.
+"""
+
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.cluster import DBSCAN
+from sklearn.metrics.pairwise import haversine_distances
+
+from conftest import cluster_summary, make_patients, process_all
+
+# Great-circle distance in metres between a cluster's centroid and ($lat, $lon)
+CENTROID_DISTANCE_M = """
+2 * 6371000 * asin(sqrt(
+    pow(sin(radians($lat - c.centroid_lat) / 2), 2)
+    + cos(radians(c.centroid_lat)) * cos(radians($lat)) * pow(sin(radians($lon - c.centroid_lon) / 2), 2)
+))
+"""
+
+
+class PerQueryClustering:
+    """One date at a time, one query per lookup, every write made at once"""
+
+    def __init__(self, engine, patients):
+        self.engine = engine
+        self.storage = engine.storage
+        self.patients = patients
+
+    def run(self, dates):
+        for processing_date in dates:
+            day = pd.Timestamp(processing_date).date()
+            entry_dates = self.patients['patient_entry_date']
+            window = self.patients[
+                (entry_dates >= day - timedelta(days=self.engine.LOOKBACK_DAYS))
+                & (entry_dates <= day - timedelta(days=1))
+            ]
+            self.abc(processing_date, window)
+            self.gis(processing_date, window)
+
+    # ABC
+
+    def abc(self, processing_date, window):
+        rural = window[(window['pat_areatype'] == 'Rural') & window['villagename'].notna()]
+        keys = ['statename', 'districtname', 'subdistrictname', 'villagename', 'clini_primary_syn']
+        for (_, _, _, village, syndrome), group in rural.groupby(keys):
+            if len(group) < self.engine.MIN_CLUSTER_SIZE:
+                continue
+            existing = self.storage.query("""
+            SELECT * FROM smart_clusters c
+            WHERE algorithm_type = 'ABC' AND village_name = $village AND primary_syndrome = $syndrome
+              AND date_diff('day', original_creation_date, CAST($date AS DATE)) <= $max_age
+            ORDER BY original_creation_date, created_at
+            LIMIT 1
+            """, {'village': village, 'syndrome': syndrome, 'date': processing_date, 'max_age': self.engine.MAX_CLUSTER_AGE_DAYS})
+            if len(existing):
+                self.expand(existing.iloc[0], group, processing_date, 'ABC')
+            else:
+                self.create(group, processing_date, 'ABC', syndrome, village=village)
+
+    # GIS
+
+    def gis(self, processing_date, window):
+        urban = window[
+            (window['pat_areatype'] == 'Urban')
+            & window['latitude'].between(8, 37) & window['longitude'].between(68, 97)
+            & (window['latitude'] != 0) & (window['longitude'] != 0)
+        ]
+        assigned = set()
+        for syndrome in urban['clini_primary_syn'].unique():
+            syndrome_df = urban[urban['clini_primary_syn'] == syndrome]
+            if len(syndrome_df) < self.engine.MIN_CLUSTER_SIZE:
+                continue
+            labels = DBSCAN(
+                eps=self.engine.DBSCAN_EPSILON_RADIANS, min_samples=self.engine.MIN_CLUSTER_SIZE, metric='haversine'
+            ).fit_predict(np.radians(syndrome_df[['latitude', 'longitude']].values))
+            for label in sorted(set(labels) - {-1}):
+                cluster_patients = syndrome_df[labels == label]
+                centroid_lat = cluster_patients['latitude'].mean()
+                centroid_lon = cluster_patients['longitude'].mean()
+                radius = self.radius(cluster_patients[['latitude', 'longitude']].values, centroid_lat, centroid_lon)
+                if radius > self.engine.MAX_CLUSTER_RADIUS:
+                    continue
+                self.merge_or_create_gis(cluster_patients, processing_date, syndrome, centroid_lat, centroid_lon, radius)
+                assigned.update(cluster_patients['unique_id'])
+
+        unassigned = urban[~urban['unique_id'].isin(assigned)]
+        for syndrome in unassigned['clini_primary_syn'].unique():
+            syndrome_df = unassigned[unassigned['clini_primary_syn'] == syndrome]
+            for (lat, lon), group in syndrome_df.groupby(['latitude', 'longitude']):
+                if len(group) >= self.engine.MIN_CLUSTER_SIZE:
+                    self.merge_or_create_gis(group, processing_date, syndrome, lat, lon, 0.0)
+
+    def merge_or_create_gis(self, patients, processing_date, syndrome, centroid_lat, centroid_lon, radius):
+        existing = self.storage.query(f"""
+        SELECT * FROM smart_clusters c
+        WHERE algorithm_type = 'GIS' AND primary_syndrome = $syndrome
+          AND date_diff('day', original_creation_date, CAST($date AS DATE)) <= $max_age
+          AND {CENTROID_DISTANCE_M} <= $epsilon_m
+        ORDER BY original_creation_date, created_at
+        LIMIT 1
+        """, {
+            'syndrome': syndrome, 'date': processing_date, 'max_age': self.engine.MAX_CLUSTER_AGE_DAYS,
+            'lat': float(centroid_lat), 'lon': float(centroid_lon), 'epsilon_m': self.engine.DBSCAN_EPSILON_M
+        })
+        if len(existing):
+            self.expand(existing.iloc[0], patients, processing_date, 'GIS', centroid_lat, centroid_lon)
+        else:
+            self.create(patients, processing_date, 'GIS', syndrome, centroid_lat=centroid_lat, centroid_lon=centroid_lon, radius=radius)
+
+    @staticmethod
+    def radius(coords, centroid_lat, centroid_lon):
+        return float((haversine_distances(np.radians(coords), np.radians([[centroid_lat, centroid_lon]])) * 6371000).max())
+
+    # Writes
+
+    def create(self, patients, processing_date, algorithm_type, syndrome, village=None, centroid_lat=None, centroid_lon=None, radius=0.0):
+        cluster_id = f"REF-{algorithm_type}-{uuid.uuid4().hex}"
+        self.insert('smart_clusters', [{
+            'smart_cluster_id': cluster_id,
+            'algorithm_type': algorithm_type,
+            'input_date': processing_date,
+            'original_creation_date': processing_date,
+            'actual_cluster_radius': float(radius),
+            'accept_status': 'Pending' if algorithm_type == 'GIS' and radius >= self.engine.AUTO_ACCEPT_RADIUS_THRESHOLD else 'Accepted',
+            'patient_count': len(patients),
+            'primary_syndrome': syndrome,
+            'centroid_lat': None if centroid_lat is None else float(centroid_lat),
+            'centroid_lon': None if centroid_lon is None else float(centroid_lon),
+            'village_name': village,
+            'expansion_count': 0,
+            'created_at': datetime.now(timezone.utc),
+        }])
+        self.insert_assignments(cluster_id, patients, algorithm_type == 'GIS')
+
+    def expand(self, cluster, patients, processing_date, algorithm_type, centroid_lat=None, centroid_lon=None):
+        cluster_id = cluster['smart_cluster_id']
+        existing = self.storage.query(
+            "SELECT unique_id, latitude, longitude FROM smart_cluster_assignments WHERE smart_cluster_id = $cluster_id",
+            {'cluster_id': cluster_id}
+        )
+        new_patients = patients[~patients['unique_id'].isin(existing['unique_id'])]
+        if len(new_patients) == 0:
+            return
+
+        update = {'cluster_id': cluster_id, 'added': len(new_patients), 'date': processing_date}
+        if algorithm_type == 'GIS':
+            total = cluster['patient_count'] + len(new_patients)
+            update['lat'] = (cluster['centroid_lat'] * cluster['patient_count'] + centroid_lat * len(new_patients)) / total
+            update['lon'] = (cluster['centroid_lon'] * cluster['patient_count'] + centroid_lon * len(new_patients)) / total
+            coords = np.vstack([
+                existing.dropna(subset=['latitude', 'longitude'])[['latitude', 'longitude']].values,
+                new_patients[['latitude', 'longitude']].values
+            ]).astype(float)
+            update['radius'] = self.radius(coords, update['lat'], update['lon'])
+            if update['radius'] > 1000:
+                return
+
+        self.insert_assignments(cluster_id, new_patients, algorithm_type == 'GIS', cluster['original_creation_date'], processing_date)
+        self.storage.query(f"""
+        UPDATE smart_clusters SET
+            patient_count = patient_count + $added,
+            expansion_count = expansion_count + 1,
+            input_date = CAST($date AS DATE)
+            {', centroid_lat = $lat, centroid_lon = $lon, actual_cluster_radius = $radius' if algorithm_type == 'GIS' else ''}
+        WHERE smart_cluster_id = $cluster_id
+        """, update)
+        self.insert('smart_merge_history', [{
+            'merge_id': f"{algorithm_type}-EXP-{cluster_id}-{processing_date.replace('-', '')}",
+            'target_cluster_id': cluster_id,
+            'source_cluster_id': f"NEW-{processing_date}",
+            'merge_reason': 'GEOGRAPHIC_PROXIMITY' if algorithm_type == 'GIS' else 'TIME_CONTINUITY',
+            'cases_added': len(new_patients),
+            'overlap_cases_removed': len(patients) - len(new_patients),
+            'performed_at': datetime.now(timezone.utc),
+        }])
+
+    def insert_assignments(self, cluster_id, patients, with_coords, original_creation_date=None, processing_date=None):
+        rows = []
+        for patient in patients.to_dict('records'):
+            original = original_creation_date is None or patient['patient_entry_date'] < pd.Timestamp(original_creation_date).date()
+            rows.append({
+                'assignment_id': str(uuid.uuid4()),
+                'smart_cluster_id': cluster_id,
+                'unique_id': patient['unique_id'],
+                'assigned_at': datetime.now(timezone.utc),
+                'addition_type': 'ORIGINAL' if original else 'EXPANSION',
+                'expansion_date': None if original else processing_date,
+                'latitude': patient['latitude'] if with_coords else None,
+                'longitude': patient['longitude'] if with_coords else None,
+            })
+        self.insert('smart_cluster_assignments', rows)
+
+    def insert(self, table, rows):
+        self.storage.query(f"INSERT INTO {table} BY NAME SELECT * FROM new_rows", new_rows=pd.DataFrame(rows))
+
+
+@pytest.mark.parametrize('seed', [0, 3])
+def test_engine_matches_per_query_clustering(local_engine, monkeypatch, seed):
+    patients = make_patients(n_days=10, seed=seed)
+    dates = [d.strftime('%Y-%m-%d') for d in sorted(patients['patient_entry_date'].unique())]
+
+    engine = local_engine(patients)
+    PerQueryClustering(engine, patients).run(dates)
+    expected = cluster_summary(engine.storage)
+
+    for gis_engine in ['sklearn', 'grid']:
+        monkeypatch.setattr(engine, 'GIS_CLUSTERING_ENGINE', gis_engine)
+        engine = local_engine(patients)
+        responses = process_all(engine)
+        assert [r['date_processed'] for r in responses if r['success']] == dates
+
+        # The data exercises creation and expansion of both cluster types
+        assert sum(r['abc_clusters'] for r in responses) and sum(r['abc_expansions'] for r in responses)
+        assert sum(r['gis_clusters'] for r in responses) and sum(r['gis_expansions'] for r in responses)
+        assert cluster_summary(engine.storage) == expected, gis_engine
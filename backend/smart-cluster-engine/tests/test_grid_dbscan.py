@@ -0,0 +1,66 @@
+"""grid_dbscan gives the same labels as sklearn's haversine DBSCAN"""
+
+import numpy as np
+import pytest
+from sklearn.cluster import DBSCAN
+
+from grid_dbscan import grid_dbscan
+
+EARTH_RADIUS_M = 6371000
+EPS_RAD = 500 / EARTH_RADIUS_M
+
+
+def hotspots(rng, n, lat_range, lon_range, spread_m=300, n_hotspots=20):
+    """Points around random hotspots plus uniform background noise, in degrees"""
+    centres = np.column_stack([rng.uniform(*lat_range, n_hotspots), rng.uniform(*lon_range, n_hotspots)])
+    clustered = centres[rng.integers(0, n_hotspots, n * 3 // 4)]
+    clustered[:, 0] += rng.normal(0, spread_m / 111000, len(clustered))
+    clustered[:, 1] += rng.normal(0, spread_m / 111000, len(clustered)) / np.cos(np.radians(clustered[:, 0]))
+    noise = np.column_stack([rng.uniform(*lat_range, n - len(clustered)), rng.uniform(*lon_range, n - len(clustered))])
+    return np.vstack([clustered, noise])
+
+
+def city(rng):
+    return hotspots(rng, 2000, (12.8, 13.2), (77.4, 77.8))
+
+
+def wide_latitudes(rng):
+    """Hotspots from the southern high latitudes to near the north pole in one set"""
+    return np.vstack([
+        hotspots(rng, 600, (-75, -60), (10, 40)),
+        hotspots(rng, 600, (-5, 5), (10, 40)),
+        hotspots(rng, 600, (60, 85), (10, 40)),
+    ])
+
+
+def duplicates(rng):
+    """Many patients geocoded to the very same coordinates"""
+    points = city(rng)[:1000]
+    repeated = points[rng.integers(0, len(points), 1000)]
+    return rng.permutation(np.vstack([points, repeated]))
+
+
+def sklearn_labels(coords_rad, min_samples):
+    return DBSCAN(eps=EPS_RAD, min_samples=min_samples, metric='haversine').fit_predict(coords_rad)
+
+
+@pytest.mark.parametrize('dataset', [city, wide_latitudes, duplicates])
+@pytest.mark.parametrize('min_samples', [1, 2, 3, 5])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_labels_match_sklearn(dataset, min_samples, seed):
+    coords_rad = np.radians(dataset(np.random.default_rng(seed)))
+    expected = sklearn_labels(coords_rad, min_samples)
+    assert expected.max() > 10
+
+    np.testing.assert_array_equal(grid_dbscan(coords_rad, EPS_RAD, min_samples), expected)
+
+
+def test_single_cell_of_identical_points():
+    coords_rad = np.radians(np.full((50, 2), [12.97, 77.59]))
+
+    for min_samples in [1, 50, 51]:
+        np.testing.assert_array_equal(grid_dbscan(coords_rad, EPS_RAD, min_samples), sklearn_labels(coords_rad, min_samples))
+
+
+def test_empty_input():
+    assert len(grid_dbscan(np.empty((0, 2)), EPS_RAD, 2)) == 0
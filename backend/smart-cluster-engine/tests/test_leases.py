@@ -0,0 +1,65 @@
+"""Date leases: a live lease keeps its date, an expired one is reclaimed"""
+
+import time
+
+import pytest
+
+import app
+from conftest import make_patients
+
+LEASE_SECONDS = 2
+
+
+@pytest.fixture
+def engine(local_engine, monkeypatch):
+    monkeypatch.setattr(app, 'CLAIM_LEASE_SECONDS', LEASE_SECONDS)
+    return local_engine(make_patients(n_days=4))
+
+
+def test_live_lease_is_not_reclaimed(engine):
+    first_date, first_worker = engine.storage.claim_next_date()
+    second_date, second_worker = engine.storage.claim_next_date()
+
+    assert (first_date, second_date) == ('2024-01-01', '2024-01-02')
+    assert first_worker != second_worker
+
+
+def test_expired_lease_is_reclaimed(engine):
+    crashed_date, crashed_worker = engine.storage.claim_next_date()
+    time.sleep(LEASE_SECONDS + 0.5)
+
+    reclaimed_date, worker = engine.storage.claim_next_date()
+
+    assert reclaimed_date == crashed_date
+    assert worker != crashed_worker
+    log = engine.storage.query("SELECT worker_id, status FROM smart_processing_status ORDER BY started_at")
+    assert log.values.tolist() == [[crashed_worker, 'FAILED'], [worker, 'IN_PROGRESS']]
+
+    # The stalled worker finds out before writing results
+    with pytest.raises(Exception, match='expired'):
+        engine.LeaseHeartbeat([crashed_date], crashed_worker).check()
+    engine.LeaseHeartbeat([reclaimed_date], worker).check()
+
+
+def test_heartbeat_keeps_the_lease_alive(engine):
+    claimed_date, worker = engine.storage.claim_next_date()
+    heartbeat = engine.LeaseHeartbeat([claimed_date], worker)
+    for _ in range(3):
+        time.sleep(LEASE_SECONDS / 2)
+        heartbeat.renew()
+
+    assert engine.storage.claim_next_date()[0] == '2024-01-02'
+    heartbeat.check()
+
+
+def test_crashed_date_is_processed_by_the_next_worker(engine):
+    crashed_date, _ = engine.storage.claim_next_date()
+
+    with engine.app.test_client() as client:
+        assert client.post('/smart-process').get_json()['date_processed'] == '2024-01-02'
+        time.sleep(LEASE_SECONDS + 0.5)
+        response = client.post('/smart-process').get_json()
+
+    assert response['success'] and response['date_processed'] == crashed_date
+    ledger = engine.storage.query("SELECT date, status FROM smart_date_ledger WHERE date <= DATE '2024-01-02' ORDER BY date")
+    assert ledger['status'].tolist() == ['COMPLETED', 'COMPLETED']
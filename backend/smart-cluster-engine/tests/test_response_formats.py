@@ -0,0 +1,81 @@
+"""Arrow and Parquet responses of the read endpoints"""
+
+import io
+import os
+import sys
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from google.cloud import bigquery
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as engine
+
+
+class EmptyRows:
+    """A query result with no rows, whose iterator can only be started once"""
+
+    schema = [
+        bigquery.SchemaField('smart_cluster_id', 'STRING'),
+        bigquery.SchemaField('unique_id', 'STRING'),
+        bigquery.SchemaField('patient_entry_date', 'DATE'),
+        bigquery.SchemaField('latitude', 'FLOAT'),
+    ]
+
+    def __init__(self):
+        self.started = False
+
+    def to_arrow_iterable(self):
+        self.started = True
+        return iter(())
+
+    def to_arrow(self):
+        if self.started:
+            raise ValueError('Iterator has already started')
+        return pa.table({})
+
+
+class EmptyJob:
+    def result(self, page_size=None):
+        return EmptyRows()
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(engine, 'client', type('Client', (), {
+        'query': lambda self, query, job_config=None: EmptyJob(),
+        'get_table': lambda self, table: None,
+    })())
+    with engine.app.test_client() as test_client:
+        yield test_client
+
+
+def read_table(response):
+    if response.mimetype == engine.PARQUET_MIMETYPE:
+        return pq.read_table(io.BytesIO(response.data))
+    return pa.ipc.open_stream(response.data).read_all()
+
+
+@pytest.mark.parametrize('response_format', ['arrow', 'parquet'])
+def test_bulk_patients_empty_result_is_an_empty_table(client, response_format):
+    response = client.get('/smart-cluster-patients/bulk', query_string={
+        'cluster_ids': 'SMART-GIS-NONE',
+        'format': response_format,
+    })
+
+    assert response.status_code == 200
+    assert response.mimetype == engine.RESPONSE_FORMATS[response_format]
+    table = read_table(response)
+    assert table.num_rows == 0
+    assert table.schema.names == [field.name for field in EmptyRows.schema]
+    assert table.schema.types == [pa.string(), pa.string(), pa.date32(), pa.float64()]
+
+
+def test_bulk_patients_vary_on_accept(client):
+    response = client.get('/smart-cluster-patients/bulk', query_string={'cluster_ids': 'SMART-GIS-NONE'},
+                          headers={'Accept': engine.ARROW_STREAM_MIMETYPE})
+
+    assert response.mimetype == engine.ARROW_STREAM_MIMETYPE
+    assert 'Accept' in response.vary
@@ -0,0 +1,101 @@
+"""Shards wait for earlier unfinished work of their syndrome within MAX_CLUSTER_AGE_DAYS"""
+
+import app
+from conftest import make_patients
+
+
+def plan(engine, max_dates):
+    with engine.app.test_client() as client:
+        response = client.post('/smart-shard-plan', json={'max_dates': max_dates}).get_json()
+    assert response['success'], response
+    return response
+
+
+def claim(engine):
+    return engine.storage.claim_next_shard()
+
+
+def test_shard_waits_for_earlier_shard_of_its_syndrome(local_engine):
+    engine = local_engine(make_patients(n_days=6))
+    assert plan(engine, 4)['completed_dates'] == ['2024-01-01']
+
+    # Every syndrome of the first sharded date is independent of the others
+    running = [claim(engine) for _ in range(3)]
+    assert [shard[:2] for shard in running] == [
+        ('2024-01-02', 'ADD'), ('2024-01-02', 'AFI'), ('2024-01-02', 'SARI')
+    ]
+
+    # The next date's shards are blocked while their syndrome's is unfinished
+    assert claim(engine) == (None, None, None)
+
+    engine.storage.mark_shard_completed(*running[1])
+    assert claim(engine)[:2] == ('2024-01-03', 'AFI')
+    assert claim(engine) == (None, None, None)
+
+
+def test_failed_shard_keeps_blocking_until_it_completes(local_engine):
+    engine = local_engine(make_patients(n_days=6))
+    plan(engine, 3)
+    running = [claim(engine) for _ in range(3)]
+
+    engine.storage.mark_shard_failed(*running[0], 'boom')
+    retried = claim(engine)
+    assert retried[:2] == ('2024-01-02', 'ADD')
+    assert claim(engine) == (None, None, None)
+
+    engine.storage.mark_shard_completed(*retried)
+    assert claim(engine)[:2] == ('2024-01-03', 'ADD')
+
+
+def test_shard_waits_for_earlier_unplanned_date(local_engine):
+    engine = local_engine(make_patients(n_days=6))
+
+    # A /smart-process worker holds the first date while the next ones are sharded
+    held_date, worker = engine.storage.claim_next_date()
+    plan(engine, 3)
+    assert claim(engine) == (None, None, None)
+
+    engine.storage.mark_date_completed(held_date, worker)
+    assert claim(engine)[:2] == ('2024-01-02', 'ADD')
+
+
+def test_dates_further_apart_than_max_cluster_age_are_independent(local_engine, monkeypatch):
+    monkeypatch.setattr(app, 'MAX_CLUSTER_AGE_DAYS', 1)
+    patients = make_patients(n_days=6)
+    engine = local_engine(patients[patients['patient_entry_date'].astype(str) != '2024-01-03'])
+    plan(engine, 4)
+
+    running = [claim(engine) for _ in range(3)]
+    assert {shard[0] for shard in running} == {'2024-01-02'}
+
+    # 2024-01-04 has no ledger date within a day before it, so it need not
+    # wait for 2024-01-02; 2024-01-05 waits for 2024-01-04
+    independent = [claim(engine) for _ in range(3)]
+    assert [shard[:2] for shard in independent] == [
+        ('2024-01-04', 'ADD'), ('2024-01-04', 'AFI'), ('2024-01-04', 'SARI')
+    ]
+    assert claim(engine) == (None, None, None)
+
+
+def test_shard_processing_skips_blocked_syndrome(local_engine):
+    engine = local_engine(make_patients(n_days=6))
+    plan(engine, 4)
+    held = claim(engine)
+    assert held[:2] == ('2024-01-02', 'ADD')
+
+    processed = []
+    with engine.app.test_client() as client:
+        while True:
+            response = client.post('/smart-shard-process').get_json()
+            assert response['success'], response
+            if not response['shard_processed']:
+                break
+            processed.append((response['date'], response['syndrome']))
+
+    assert processed == [
+        ('2024-01-02', 'AFI'), ('2024-01-02', 'SARI'),
+        ('2024-01-03', 'AFI'), ('2024-01-03', 'SARI'),
+        ('2024-01-04', 'AFI'), ('2024-01-04', 'SARI'),
+    ]
+    pending = engine.storage.query("SELECT CAST(date AS VARCHAR) AS date, status FROM smart_shard_ledger WHERE syndrome = 'ADD' ORDER BY date")
+    assert pending.values.tolist() == [['2024-01-02', 'IN_PROGRESS'], ['2024-01-03', 'PENDING'], ['2024-01-04', 'PENDING']]
@@ -0,0 +1,35 @@
+"""WriteBuffer.flush writes a date all at once or not at all"""
+
+import pytest
+
+from conftest import cluster_summary, make_patients, process_all
+
+
+@pytest.mark.parametrize('failing_flush', [1, 3])
+def test_failed_flush_retried_without_duplicates(local_engine, monkeypatch, failing_flush):
+    patients = make_patients(n_days=6)
+    engine = local_engine(patients)
+    assert all(response['success'] for response in process_all(engine))
+    expected = cluster_summary(engine.storage)
+
+    # Fail the expansion update of one flush that has expansions, after its
+    # new clusters and assignments were written
+    engine = local_engine(patients)
+    storage_class = type(engine.storage)
+    apply_cluster_updates = storage_class._apply_cluster_updates
+    calls = []
+
+    def failing_updates(self, updates):
+        if updates:
+            calls.append(updates)
+            if len(calls) == failing_flush:
+                raise RuntimeError('cluster update failed')
+        return apply_cluster_updates(self, updates)
+
+    monkeypatch.setattr(storage_class, '_apply_cluster_updates', failing_updates)
+    responses = process_all(engine)
+
+    failed = [response for response in responses if not response['success']]
+    assert [response['error'] for response in failed] == ['cluster update failed']
+    assert failed[0]['date_processed'] in [response['date_processed'] for response in responses if response['success']]
+    assert cluster_summary(engine.storage) == expected